@@ -0,0 +1,79 @@
+from adrf.views import APIView
+from asgiref.sync import sync_to_async
+from django.db import close_old_connections
+from rest_framework import status
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.response import Response
+
+from core.throttling import ConcurrencyLimitMixin, UserBucketThrottle
+
+from .compact import compact_context, users_table
+from .membership import is_member
+from .models import Message
+from .notify import await_messages
+from .pagination import MessageCursorPagination
+from .serializers import MessageCreateSerializer, MessageSerializer
+from .throttling import ConversationBucketThrottle
+from .views import (
+    IsAuthenticated, conversation_messages, longpoll_wait, release_connections, send_message,
+)
+
+
+class AsyncMessageListView(APIView):
+    """
+    نسخه‌ی async از MessageListView (زیر ASGI): صفحه با ORM async خوانده می‌شود
+    و worker در انتظار دیتابیس بلاک نمی‌شود. خروجی (و long-poll با wait) دقیقاً مثل نسخه‌ی sync است.
+    """
+    permission_classes = [IsAuthenticated]
+
+    async def get(self, request, conversation_id):
+        # روی cache miss به دیتابیس می‌رود، پس sync است
+        member = await sync_to_async(is_member)(request.user.id, conversation_id)
+        queryset = conversation_messages(conversation_id) if member else Message.objects.none()
+
+        paginator = MessageCursorPagination()
+        rows = await paginator.apaginate_queryset(queryset, request, view=self)
+        wait = longpoll_wait(request)
+        if member and wait and not rows and paginator.direction == "after":
+            # انتظار async روی event loop؛ هیچ threadی در این مدت گرفته نمی‌شود
+            # و اتصال دیتابیس (در thread همگام ORM) هم مثل نسخه‌ی sync آزاد می‌شود
+            await sync_to_async(release_connections)()
+            news = await await_messages({conversation_id: paginator.position}, wait)
+            if news:
+                rows = await paginator.apaginate_queryset(queryset, request, view=self)
+        # همه‌چیز prefetch شده؛ سریالایز کردن کوئری نمی‌زند
+        context = {"request": request, "view": self, **compact_context(request)}
+        data = MessageSerializer(rows, many=True, context=context).data
+        response = paginator.get_paginated_response(data)
+        if "users" in context:
+            response.data["users"] = users_table(context["users"])
+        return response
+
+
+class AsyncMessageSendView(ConcurrencyLimitMixin, APIView):
+    """
+    نسخه‌ی async از MessageSendView. تراکنش و نوشتن فایل‌ها در یک thread
+    جدا (thread_sensitive=False) اجرا می‌شود تا event loop و بقیه‌ی درخواست‌ها منتظر نمانند.
+    """
+    permission_classes = [IsAuthenticated]
+    parser_classes = [MultiPartParser, FormParser, JSONParser]
+    throttle_classes = [UserBucketThrottle, ConversationBucketThrottle]
+    throttle_scope = "send"
+    concurrency_scope = "send"
+
+    async def post(self, request):
+        serializer = MessageCreateSerializer(data=request.data, context={"request": request})
+        await sync_to_async(serializer.is_valid)(raise_exception=True)
+        data = await sync_to_async(send_in_worker, thread_sensitive=False)(
+            request, serializer.validated_data
+        )
+        return Response(data, status=status.HTTP_201_CREATED)
+
+
+def send_in_worker(request, validated_data):
+    # اتصال دیتابیس این thread خارج از چرخه‌ی request است؛ مثل پایان request مدیریتش کن
+    close_old_connections()
+    try:
+        return send_message(request, validated_data)
+    finally:
+        close_old_connections()
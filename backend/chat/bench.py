@@ -0,0 +1,68 @@
+import gzip
+import statistics
+import time
+
+# Shared by the loadtest / benchmark management commands.
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[index], 2)
+
+
+def summarize(latencies_ms, wall_seconds, errors=0):
+    """Latency percentiles (ms) and throughput for one endpoint/scenario."""
+    return {
+        "requests": len(latencies_ms),
+        "errors": errors,
+        "rps": round(len(latencies_ms) / wall_seconds, 1) if wall_seconds else None,
+        "mean_ms": round(statistics.fmean(latencies_ms), 2) if latencies_ms else None,
+        "p50_ms": percentile(latencies_ms, 50),
+        "p90_ms": percentile(latencies_ms, 90),
+        "p95_ms": percentile(latencies_ms, 95),
+        "p99_ms": percentile(latencies_ms, 99),
+        "max_ms": round(max(latencies_ms), 2) if latencies_ms else None,
+    }
+
+
+def compare(current, baseline, threshold):
+    """
+    Scenarios whose p95 grew by more than ``threshold`` (0.2 = 20%) or that
+    now run more queries per request than in ``baseline``.
+    """
+    regressions = []
+    for name, now in current.items():
+        before = baseline.get(name)
+        if not before:
+            continue
+        if before.get("p95_ms") and now["p95_ms"] and now["p95_ms"] > before["p95_ms"] * (1 + threshold):
+            regressions.append(f"{name}: p95 {before['p95_ms']}ms -> {now['p95_ms']}ms")
+        if "queries_max" in before and now.get("queries_max", 0) > before["queries_max"]:
+            regressions.append(f"{name}: queries/request {before['queries_max']} -> {now['queries_max']}")
+    return regressions
+
+
+def measure_payload(serialize, render, iterations):
+    """
+    Median serialize / render time (ms) of one response body over
+    ``iterations`` runs, and its size raw and gzipped.
+    """
+    serialize_ms, render_ms = [], []
+    body = b""
+    for _ in range(iterations):
+        started = time.perf_counter()
+        data = serialize()
+        serialized = time.perf_counter()
+        body = render(data)
+        serialize_ms.append((serialized - started) * 1000)
+        render_ms.append((time.perf_counter() - serialized) * 1000)
+    return {
+        "bytes": len(body),
+        "gzip_bytes": len(gzip.compress(body)),
+        "serialize_ms": round(statistics.median(serialize_ms), 3),
+        "render_ms": round(statistics.median(render_ms), 3),
+        "total_ms": round(statistics.median(s + r for s, r in zip(serialize_ms, render_ms)), 3),
+    }
@@ -0,0 +1,120 @@
+from collections import Counter
+
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.db.models import Count, Exists, F, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+
+from .membership import get_conversation_ids
+from .models import Blob, MessageAttachment, Upload, blob_path
+
+
+def store_blob(content, sha256, size, content_type=""):
+    """
+    The blob for ``sha256``; ``content`` (a File) is written to storage only
+    if no blob has that hash yet. ``sha256`` must already be verified.
+    """
+    blob = Blob.objects.filter(sha256=sha256).first()
+    if blob is not None:
+        return blob
+
+    blob = Blob(sha256=sha256, size=size, content_type=content_type)
+    name = blob_path(blob, "")
+    # فایلی که از یک ارسال ناتمام یا رقیب همزمان مانده، اگر کامل است دوباره نوشته نمی‌شود
+    if default_storage.exists(name) and default_storage.size(name) == size:
+        blob.file.name = name
+    else:
+        default_storage.delete(name)
+        blob.file.save(name, content, save=False)
+    try:
+        with transaction.atomic():
+            blob.save()
+    except IntegrityError:
+        # رقیب همزمان زودتر ثبت کرد؛ کپی ما (اگر نام دیگری گرفته) اضافی است
+        if blob.file.name != name:
+            blob.file.delete(save=False)
+        return Blob.objects.get(sha256=sha256)
+    return blob
+
+
+def add_refs(blob_ids):
+    for blob_id, count in Counter(filter(None, blob_ids)).items():
+        Blob.objects.filter(pk=blob_id).update(
+            ref_count=F("ref_count") + count, updated_at=timezone.now()
+        )
+
+
+def release_refs(blob_ids):
+    for blob_id, count in Counter(filter(None, blob_ids)).items():
+        Blob.objects.filter(pk=blob_id).update(
+            ref_count=Greatest(F("ref_count") - count, 0), updated_at=timezone.now()
+        )
+
+
+def accessible_blobs(user, hashes):
+    """
+    ``{sha256: Blob}`` for the hashes ``user`` may send without uploading:
+    blobs they uploaded themselves or can already read as an attachment in
+    one of their conversations. Knowing a hash alone is not enough.
+    """
+    if not hashes:
+        return {}
+    return Blob.objects.filter(sha256__in=set(hashes)).filter(
+        Exists(Upload.objects.filter(blob=OuterRef("pk"), user=user))
+        | Exists(
+            MessageAttachment.objects.filter(
+                blob=OuterRef("pk"), message__conversation_id__in=get_conversation_ids(user.id)
+            )
+        )
+    ).in_bulk(field_name="sha256")
+
+
+def orphaned_blobs(before):
+    """Blobs unused since ``before``: no attachment and no unattached upload points at them."""
+    return (
+        Blob.objects.filter(ref_count=0, updated_at__lt=before)
+        .exclude(Exists(MessageAttachment.objects.filter(blob=OuterRef("pk"))))
+        .exclude(Exists(Upload.objects.filter(~Q(status=Upload.ATTACHED), blob=OuterRef("pk"))))
+    )
+
+
+def recount_refs():
+    """Recompute every ``ref_count`` from the attachments (repairs drift)."""
+    counts = (
+        MessageAttachment.objects.filter(blob=OuterRef("pk"))
+        .order_by()
+        .values("blob")
+        .annotate(n=Count("id"))
+        .values("n")
+    )
+    return Blob.objects.update(ref_count=Coalesce(Subquery(counts), 0))
+
+
+def stray_files(before, batch_size=500):
+    """
+    Names of files under ``blobs/`` with no Blob row, last modified before
+    ``before`` - left behind when a send failed after the file was written.
+    """
+    def candidates():
+        for first in default_storage.listdir("blobs")[0]:
+            for second in default_storage.listdir(f"blobs/{first}")[0]:
+                for name in default_storage.listdir(f"blobs/{first}/{second}")[1]:
+                    yield f"blobs/{first}/{second}/{name}"
+
+    if not default_storage.exists("blobs"):
+        return
+    batch = []
+    for path in candidates():
+        batch.append(path)
+        if len(batch) >= batch_size:
+            yield from _unknown(batch, before)
+            batch = []
+    yield from _unknown(batch, before)
+
+
+def _unknown(paths, before):
+    known = set(Blob.objects.filter(file__in=paths).values_list("file", flat=True))
+    for path in paths:
+        if path not in known and default_storage.get_modified_time(path) < before:
+            yield path
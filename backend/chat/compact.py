@@ -0,0 +1,84 @@
+"""
+Opt-in trimming of list responses for mobile clients.
+
+``?fields=id,text`` keeps only those fields of each top-level item (nested
+objects such as ``last_message`` stay whole). ``?compact=1`` drops the
+embedded user objects (``sender_detail``, ``members_detail``) and returns
+every user they would have repeated once, in a ``users`` side table next to
+``results``; items keep the ids (``sender``, ``members``) to look them up.
+Both only apply to GET requests, so what sends and broadcasts carry is
+unchanged.
+"""
+from users.serializers import SimpleUserSerializer
+
+TRUE = ("1", "true", "yes")
+
+
+def compact_context(request):
+    """Serializer context entries for the ``fields`` / ``compact`` query params."""
+    if request.method != "GET":
+        return {}
+    context = {}
+    fields = request.query_params.get("fields")
+    if fields:
+        context["fields"] = frozenset(name.strip() for name in fields.split(",") if name.strip())
+    if request.query_params.get("compact", "").lower() in TRUE:
+        context["users"] = {}
+    return context
+
+
+def users_table(users):
+    return SimpleUserSerializer(sorted(users.values(), key=lambda user: user.pk), many=True).data
+
+
+class SelectableFieldsMixin:
+    """
+    For serializers listed by the compact endpoints. ``user_fields`` maps an
+    embedded user field to the id field (and model attribute) it details.
+    """
+
+    user_fields = {}
+
+    def get_fields(self):
+        fields = super().get_fields()
+        if "users" in self.context:
+            for name in self.user_fields:
+                fields.pop(name, None)
+        wanted = self.context.get("fields")
+        if wanted and self.is_top_level():
+            fields = {name: field for name, field in fields.items() if name in wanted}
+        return fields
+
+    def is_top_level(self):
+        parent = self.parent
+        if parent is not None and getattr(parent, "child", None) is self:
+            parent = parent.parent
+        return parent is None
+
+    def to_representation(self, instance):
+        data = super().to_representation(instance)
+        users = self.context.get("users")
+        if users is not None:
+            for source in self.user_fields.values():
+                if source not in self.fields:
+                    continue
+                value = getattr(instance, source)
+                for user in value.all() if hasattr(value, "all") else [value]:
+                    users[user.pk] = user
+        return data
+
+
+class CompactListMixin:
+    """For generic list views: wires the query params in and appends the ``users`` table."""
+
+    def get_serializer_context(self):
+        context = super().get_serializer_context()
+        context.update(compact_context(self.request))
+        self.compact_users = context.get("users")
+        return context
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if getattr(self, "compact_users", None) is not None:
+            response.data["users"] = users_table(self.compact_users)
+        return response
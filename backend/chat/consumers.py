@@ -0,0 +1,110 @@
+from asgiref.sync import sync_to_async
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+
+from .events import conversation_group, presence_event, typing_event, user_group
+from .membership import get_contact_ids, get_conversation_ids
+from .presence import allow_typing, disconnect, heartbeat
+
+
+class ChatConsumer(AsyncJsonWebsocketConsumer):
+    """
+    سوکت زنده‌ی کاربر: پیام‌های جدید همه‌ی گفتگوهایش را push می‌کند
+    (جایگزین polling روی MessageListView با after_id).
+    حضور: اتصال و هر ping، heartbeat است؛ {"type": "typing", "conversation": id, "typing": bool}
+    وضعیت تایپ را (با ادغام و سقف نرخ) به اعضای گفتگو می‌رساند. هیچ‌کدام به دیتابیس نمی‌رود.
+    عضوی که از گفتگو حذف شود (یا گفتگو حذف شود) {"type": "removed", "conversation": id}
+    می‌گیرد و سوکتش دیگر رویدادهای آن گفتگو را نمی‌گیرد.
+    """
+
+    async def connect(self):
+        user = self.scope.get("user")
+        if user is None or not user.is_authenticated:
+            await self.close(code=4401)
+            return
+
+        self.user = user
+        self.groups_joined = set()
+        self.conversation_ids = set()
+        await self.join(user_group(user.id))
+        for conv_id in await self.get_conversation_ids():
+            await self.join_conversation(conv_id)
+        await self.accept()
+
+        if await sync_to_async(heartbeat, thread_sensitive=False)(user.id, self.channel_name):
+            await self.broadcast_presence(True)
+
+    async def disconnect(self, code):
+        if hasattr(self, "user"):
+            if await sync_to_async(disconnect, thread_sensitive=False)(self.user.id, self.channel_name):
+                await self.broadcast_presence(False)
+        for group in getattr(self, "groups_joined", ()):
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        kind = content.get("type")
+        if kind == "ping":
+            if await sync_to_async(heartbeat, thread_sensitive=False)(self.user.id, self.channel_name):
+                await self.broadcast_presence(True)
+            await self.send_json({"type": "pong"})
+        elif kind == "typing":
+            await self.typing(content.get("conversation"), content.get("typing", True) is not False)
+
+    async def typing(self, conv_id, typing):
+        # عضویت از گروه‌هایی که سوکت به آن‌ها پیوسته، نه کوئری
+        if conv_id not in self.conversation_ids:
+            return
+        if await sync_to_async(allow_typing, thread_sensitive=False)(self.user.id, conv_id, typing):
+            await self.channel_layer.group_send(
+                conversation_group(conv_id), typing_event(conv_id, self.user.id, typing)
+            )
+
+    async def broadcast_presence(self, online):
+        # هر مخاطب یک‌بار، هر چند گفتگوی مشترک داشته باشند
+        event = presence_event(self.user.id, online)
+        for user_id in await database_sync_to_async(get_contact_ids)(self.user.id):
+            if user_id != self.user.id:
+                await self.channel_layer.group_send(user_group(user_id), event)
+
+    async def join(self, group):
+        await self.channel_layer.group_add(group, self.channel_name)
+        self.groups_joined.add(group)
+
+    async def join_conversation(self, conv_id):
+        await self.join(conversation_group(conv_id))
+        self.conversation_ids.add(conv_id)
+
+    @database_sync_to_async
+    def get_conversation_ids(self):
+        return get_conversation_ids(self.user.id)
+
+    # ---- رویدادهای channel layer ----
+
+    async def chat_message(self, event):
+        await self.send_json({"type": "message", "message": event["message"]})
+
+    async def chat_conversation(self, event):
+        conversation = event["conversation"]
+        await self.join_conversation(conversation["id"])
+        await self.send_json({"type": "conversation", "conversation": conversation})
+
+    async def chat_removed(self, event):
+        conv_id = event["conversation"]
+        group = conversation_group(conv_id)
+        await self.channel_layer.group_discard(group, self.channel_name)
+        self.groups_joined.discard(group)
+        self.conversation_ids.discard(conv_id)
+        await self.send_json({"type": "removed", "conversation": conv_id})
+
+    async def chat_typing(self, event):
+        if event["user"] != self.user.id:
+            await self.send_json({
+                "type": "typing",
+                "conversation": event["conversation"],
+                "user": event["user"],
+                "typing": event["typing"],
+                "expires_in": event["expires_in"],
+            })
+
+    async def chat_presence(self, event):
+        await self.send_json({"type": "presence", "user": event["user"], "online": event["online"]})
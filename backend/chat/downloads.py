@@ -0,0 +1,155 @@
+import mimetypes
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+
+from core.streaming import is_asgi, streaming_body
+
+from .uploads import CHUNK_SIZE
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def attachment_etag(attachment):
+    return f'"{attachment.pk}-{attachment.size}-{int(attachment.uploaded_at.timestamp())}"'
+
+
+def parse_range(header, size):
+    """
+    Parse a single ``bytes=`` range. Returns ``(start, end)`` (inclusive),
+    ``None`` when the header should be ignored (absent, malformed or
+    multi-range), or ``False`` when it is unsatisfiable.
+    """
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":
+        # suffix range: the last N bytes
+        length = int(last)
+        if length == 0:
+            return False
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        return False
+    return start, end
+
+
+def if_range_matches(request, etag, last_modified):
+    if_range = request.headers.get("If-Range")
+    if not if_range:
+        return True
+    if if_range.startswith(('"', "W/")):
+        return if_range == etag
+    return parse_http_date_safe(if_range) == last_modified
+
+
+def iter_range(fh, start, length):
+    try:
+        fh.seek(start)
+        while length > 0:
+            data = fh.read(min(CHUNK_SIZE, length))
+            if not data:
+                break
+            length -= len(data)
+            yield data
+    finally:
+        fh.close()
+
+
+def serve_attachment(request, attachment, as_attachment=False):
+    """Download response for an attachment the caller may read."""
+    return serve_file(
+        request,
+        attachment.file,
+        content_type=attachment.content_type,
+        etag=attachment_etag(attachment),
+        last_modified=int(attachment.uploaded_at.timestamp()),
+        as_attachment=as_attachment,
+        filename=attachment.name,
+    )
+
+
+def serve_variant(request, variant, as_attachment=False):
+    """Download response for a resized image variant."""
+    return serve_file(
+        request,
+        variant.file,
+        content_type=variant.content_type,
+        etag=f'"{variant.attachment_id}-{variant.name}-{variant.size}"',
+        last_modified=int(variant.created_at.timestamp()),
+        as_attachment=as_attachment,
+    )
+
+
+def serve_file(request, fieldfile, content_type, etag, last_modified, as_attachment=False, filename=""):
+    """
+    Handles ETag / Last-Modified validators (304), single byte ranges (206)
+    and, when ``ATTACHMENT_SENDFILE`` is set, hands the body to the front
+    proxy (``nginx`` → X-Accel-Redirect, ``xsendfile`` → X-Sendfile) so no
+    Python worker is held for the transfer. Without a proxy, bodies are
+    streamed in CHUNK_SIZE blocks under both WSGI and ASGI.
+    """
+    not_modified = get_conditional_response(request, etag=etag, last_modified=last_modified)
+    if not_modified is not None:
+        return not_modified
+
+    # blobها با hash ذخیره می‌شوند؛ نام اصلی جدا نگه داشته شده
+    name = filename or fieldfile.name.rsplit("/", 1)[-1]
+    content_type = content_type or mimetypes.guess_type(name)[0] or "application/octet-stream"
+    headers = {
+        "ETag": etag,
+        "Last-Modified": http_date(last_modified),
+        "Accept-Ranges": "bytes",
+        "Cache-Control": "private, max-age=86400",
+        "Content-Disposition": content_disposition_header(as_attachment, name),
+    }
+
+    backend = getattr(settings, "ATTACHMENT_SENDFILE", "")
+    if backend:
+        response = HttpResponse(content_type=content_type, headers=headers)
+        if backend == "nginx":
+            # nginx serves the internal location itself, Range included
+            response["X-Accel-Redirect"] = settings.ATTACHMENT_ACCEL_PREFIX + fieldfile.name
+        else:
+            response["X-Sendfile"] = fieldfile.path
+        return response
+
+    size = fieldfile.size
+    byte_range = None
+    if if_range_matches(request, etag, last_modified):
+        byte_range = parse_range(request.headers.get("Range"), size)
+
+    if byte_range is False:
+        response = HttpResponse(status=416, headers=headers)
+        response["Content-Range"] = f"bytes */{size}"
+        return response
+
+    fh = fieldfile.open("rb")
+    if byte_range is None:
+        if not is_asgi(request):
+            # WSGI: the server's file_wrapper (sendfile) sends it
+            return FileResponse(
+                fh, as_attachment=as_attachment, filename=name, content_type=content_type, headers=headers
+            )
+        byte_range = (0, size - 1)
+        response_status = 200
+    else:
+        response_status = 206
+
+    start, end = byte_range
+    length = end - start + 1
+    # under ASGI FileResponse would be read whole into memory before sending
+    response = StreamingHttpResponse(
+        streaming_body(request, iter_range(fh, start, length)),
+        status=response_status, content_type=content_type, headers=headers,
+    )
+    response["Content-Length"] = str(length)
+    if response_status == 206:
+        response["Content-Range"] = f"bytes {start}-{end}/{size}"
+    return response
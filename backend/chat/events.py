@@ -0,0 +1,92 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.db import transaction
+
+from .notify import notify_message
+
+
+def conversation_group(conversation_id):
+    return f"conversation_{conversation_id}"
+
+
+def user_group(user_id):
+    return f"user_{user_id}"
+
+
+def _group_send(group, event):
+    layer = get_channel_layer()
+    if layer is None:
+        return
+    async_to_sync(layer.group_send)(group, event)
+
+
+def publish_message(conversation_id, data):
+    """
+    پیام سریالایز‌شده (خروجی MessageSerializer) را برای اعضای آنلاین گفتگو می‌فرستد.
+    ارسال بعد از commit انجام می‌شود تا کلاینت پیامی را که rollback شده نبیند.
+    درخواست‌های long-poll منتظر همین گفتگو هم بیدار می‌شوند.
+    """
+    def send():
+        notify_message(conversation_id, data["id"])
+        _group_send(
+            conversation_group(conversation_id),
+            {"type": "chat.message", "message": data},
+        )
+
+    transaction.on_commit(send)
+
+
+def publish_conversation(member_ids, data):
+    """گفتگوی جدید را به اعضا اطلاع می‌دهد تا سوکت‌های باز به گروه آن بپیوندند."""
+    def send():
+        for user_id in member_ids:
+            _group_send(
+                user_group(user_id),
+                {"type": "chat.conversation", "conversation": data},
+            )
+
+    transaction.on_commit(send)
+
+
+def publish_removed(user_ids, conversation_ids):
+    """
+    کاربرانی که از گفتگو بیرون رفته‌اند (یا گفتگو حذف شده) تا سوکت‌های بازشان
+    از گروه آن جدا شوند و دیگر پیام و تایپ آن را نگیرند.
+    """
+    user_ids, conversation_ids = list(user_ids), list(conversation_ids)
+
+    def send():
+        for user_id in user_ids:
+            for conversation_id in conversation_ids:
+                _group_send(user_group(user_id), {"type": "chat.removed", "conversation": conversation_id})
+
+    if user_ids and conversation_ids:
+        transaction.on_commit(send)
+
+
+def typing_event(conversation_id, user_id, typing):
+    return {
+        "type": "chat.typing",
+        "conversation": conversation_id,
+        "user": user_id,
+        "typing": typing,
+        "expires_in": settings.CHAT_TYPING_TTL,
+    }
+
+
+def presence_event(user_id, online):
+    return {"type": "chat.presence", "user": user_id, "online": online}
+
+
+def publish_typing(conversation_id, user_id, typing):
+    """وضعیت تایپ مستقیم به سوکت‌های اعضا؛ بدون دیتابیس و بدون انتظار commit"""
+    _group_send(conversation_group(conversation_id), typing_event(conversation_id, user_id, typing))
+
+
+def publish_presence(user_id, online, contact_ids):
+    """آنلاین/آفلاین شدن کاربر به مخاطبانش (فقط در لحظه‌ی تغییر، نه هر heartbeat)"""
+    event = presence_event(user_id, online)
+    for contact_id in contact_ids:
+        if contact_id != user_id:
+            _group_send(user_group(contact_id), event)
@@ -0,0 +1,120 @@
+import csv
+import io
+import zlib
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+from .models import Message, MessageAttachment
+
+# Rows are read in keyset batches (id > last ORDER BY id LIMIT n) and written
+# out as they come, so memory stays flat however long the history is.
+EXPORT_BATCH_SIZE = 2000
+# Output is handed to the response / file in blocks of roughly this size
+EXPORT_FLUSH_SIZE = 64 * 1024
+
+EXPORT_FORMATS = {
+    "ndjson": ("application/x-ndjson", "ndjson"),
+    "csv": ("text/csv", "csv"),
+}
+
+CSV_COLUMNS = [
+    "id", "conversation_id", "created_at", "sender_id", "sender_username", "text",
+    "attachments", "attachment_names",
+]
+
+
+def export_rows(conversation_id, batch_size=EXPORT_BATCH_SIZE):
+    """
+    Yield one dict per message of ``conversation_id`` (oldest first) with
+    sender and attachment metadata. Two queries per batch.
+    """
+    last_id = 0
+    while True:
+        batch = list(
+            Message.objects.filter(conversation_id=conversation_id, id__gt=last_id)
+            .order_by("id")
+            .values_list("id", "created_at", "sender_id", "sender__username", "text")[:batch_size]
+        )
+        if not batch:
+            return
+
+        attachments = {}
+        for row in (
+            MessageAttachment.objects.filter(message_id__in=[m[0] for m in batch])
+            .order_by("id")
+            # file is the content-addressed blob path; name is what the sender called it
+            .values("id", "message_id", "name", "file", "content_type", "size", "uploaded_at")
+        ):
+            attachments.setdefault(row.pop("message_id"), []).append(row)
+
+        for message_id, created_at, sender_id, username, text in batch:
+            yield {
+                "id": message_id,
+                "conversation_id": conversation_id,
+                "created_at": created_at,
+                "sender_id": sender_id,
+                "sender_username": username,
+                "text": text,
+                "attachments": attachments.get(message_id, []),
+            }
+
+        if len(batch) < batch_size:
+            return
+        last_id = batch[-1][0]
+
+
+def ndjson_chunks(rows):
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    for row in rows:
+        yield encoder.encode(row) + "\n"
+
+
+def csv_chunks(rows):
+    encoder = DjangoJSONEncoder(ensure_ascii=False, separators=(",", ":"))
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(CSV_COLUMNS)
+    for row in rows:
+        writer.writerow([
+            row["id"],
+            row["conversation_id"],
+            row["created_at"].isoformat(),
+            row["sender_id"],
+            row["sender_username"],
+            row["text"],
+            encoder.encode(row["attachments"]) if row["attachments"] else "",
+            "\n".join(a["name"] for a in row["attachments"]),
+        ])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+def buffered(chunks, size=EXPORT_FLUSH_SIZE):
+    """Join small text chunks into ~``size`` byte blocks of UTF-8."""
+    pending, pending_size = [], 0
+    for chunk in chunks:
+        data = chunk.encode("utf-8")
+        pending.append(data)
+        pending_size += len(data)
+        if pending_size >= size:
+            yield b"".join(pending)
+            pending, pending_size = [], 0
+    if pending:
+        yield b"".join(pending)
+
+
+def gzipped(blocks):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 → gzip container
+    for block in blocks:
+        data = compressor.compress(block)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export_stream(conversation_id, fmt="ndjson", compress=False, batch_size=EXPORT_BATCH_SIZE):
+    """Byte blocks of the whole conversation in ``fmt`` (``ndjson`` / ``csv``)."""
+    chunks = ndjson_chunks if fmt == "ndjson" else csv_chunks
+    blocks = buffered(chunks(export_rows(conversation_id, batch_size)))
+    return gzipped(blocks) if compress else blocks
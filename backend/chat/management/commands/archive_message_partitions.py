@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from chat import partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Archive cold chat_message partitions on PostgreSQL: move them to the archive "
+        "tablespace, rewrite them in conversation order and freeze them. They stay attached, "
+        "so message history reads are unchanged."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--older-than-days", type=int, default=settings.CHAT_MESSAGE_ARCHIVE_AFTER_DAYS)
+        parser.add_argument("--tablespace", default=settings.CHAT_MESSAGE_ARCHIVE_TABLESPACE)
+        parser.add_argument("--limit", type=int, default=0, help="Archive at most this many partitions.")
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        if not partitions.supported(connection):
+            self.stderr.write(f"chat_message is not partitioned on {connection.vendor}; nothing to do.")
+            return
+
+        before = timezone.now() - timedelta(days=options["older_than_days"])
+        cold = partitions.cold_partitions(connection, before)
+        if options["limit"]:
+            cold = cold[:options["limit"]]
+        if not cold:
+            self.stdout.write("no cold partitions")
+        for partition in cold:
+            if options["dry_run"]:
+                self.stdout.write(f"would archive {partition.name}")
+                continue
+            partitions.archive_partition(connection, partition, options["tablespace"])
+            self.stdout.write(f"archived {partition.name}")
@@ -0,0 +1,219 @@
+import json
+import platform
+import random
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from chat.bench import compare, summarize
+from chat.management.commands.seed_chat import SEED_PASSWORD
+from chat.models import Conversation, Message, ReadCursor
+
+User = get_user_model()
+
+SCENARIOS = [
+    "register",
+    "login",
+    "conversation_list",
+    "conversation_create",
+    "inbox",
+    "message_list",
+    "message_list_compact",
+    "message_send",
+]
+
+
+class Command(BaseCommand):
+    help = (
+        "In-process benchmark of the main API endpoints against the configured database "
+        "(seed it first with seed_chat). Reports latency percentiles, throughput and queries "
+        "per request as JSON, and can compare against a previous run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=100)
+        parser.add_argument("--warmup", type=int, default=10)
+        parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+        parser.add_argument("--prefix", default="seed", help="Username prefix used by seed_chat.")
+        parser.add_argument("--label", default="")
+        parser.add_argument("--output", help="Write the JSON results to this file.")
+        parser.add_argument("--compare", help="Baseline JSON from an earlier run.")
+        parser.add_argument(
+            "--threshold", type=float, default=0.2,
+            help="Allowed p95 growth against the baseline (0.2 = 20%%).",
+        )
+        parser.add_argument("--fail-on-regression", action="store_true")
+        parser.add_argument("--keep", action="store_true", help="Keep users/conversations/messages it creates.")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.run_id = uuid.uuid4().hex[:8]
+        self.created = {"users": [], "conversations": [], "messages": []}
+        self.prepare(options["prefix"])
+
+        hosts = [h for h in settings.ALLOWED_HOSTS if h and h != "*" and not h.startswith(".")]
+        self.client = Client(HTTP_HOST=hosts[0] if hosts else "localhost")
+
+        results = {}
+        # measures the endpoints, not the rate limits a run of this length would hit
+        unlimited = override_settings(THROTTLE_RATES={}, CONCURRENCY_LIMITS={})
+        unlimited.enable()
+        try:
+            for name in options["scenarios"]:
+                request = getattr(self, f"scenario_{name}")
+                for i in range(options["warmup"]):
+                    self.remember(request, self.call(request, f"w{i}"))
+                results[name] = self.measure(request, options["iterations"])
+                self.stderr.write(f"{name}: p50 {results[name]['p50_ms']}ms p95 {results[name]['p95_ms']}ms")
+        finally:
+            unlimited.disable()
+            if not options["keep"]:
+                self.cleanup()
+
+        report = {
+            "label": options["label"],
+            "created_at": timezone.now().isoformat(),
+            "database": connection.vendor,
+            "python": platform.python_version(),
+            "iterations": options["iterations"],
+            "scenarios": results,
+        }
+
+        if options["compare"]:
+            with open(options["compare"]) as fh:
+                baseline = json.load(fh)
+            report["regressions"] = compare(results, baseline.get("scenarios", {}), options["threshold"])
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as fh:
+                fh.write(output)
+        self.stdout.write(output)
+
+        if options["fail_on_regression"] and report.get("regressions"):
+            raise CommandError("Regressions: " + "; ".join(report["regressions"]))
+
+    # ---- setup ----
+
+    def prepare(self, prefix):
+        users = list(User.objects.filter(username__startswith=f"{prefix}_").order_by("id")[:50])
+        if len(users) < 3:
+            raise CommandError(f"Need seeded users named {prefix}_*; run seed_chat first.")
+        self.users = users
+
+        # the busiest seeded conversation: the hot path for history reads and sends
+        busiest = (
+            Message.objects.filter(sender__username__startswith=f"{prefix}_")
+            .values("conversation_id")
+            .annotate(n=Count("id"))
+            .order_by("-n")
+            .first()
+        )
+        if busiest is None:
+            raise CommandError("Seeded users have no messages; run seed_chat with --messages.")
+        self.conversation = Conversation.objects.get(pk=busiest["conversation_id"])
+        self.actor = self.conversation.members.order_by("id").first()
+        self.token = Token.objects.get_or_create(user=self.actor)[0].key
+
+    def cleanup(self):
+        Message.objects.filter(id__in=self.created["messages"]).delete()
+        # the deleted sends were the hot conversation's newest messages
+        last = self.conversation.messages.order_by("-id").first()
+        Conversation.objects.filter(pk=self.conversation.pk).update(
+            last_message=last, last_activity_at=last.created_at
+        )
+        ReadCursor.objects.filter(conversation=self.conversation).update(last_activity_at=last.created_at)
+        Conversation.objects.filter(id__in=self.created["conversations"]).delete()
+        User.objects.filter(id__in=self.created["users"]).delete()
+
+    # ---- measuring ----
+
+    def call(self, request, i):
+        method, path, data, auth = request(i)
+        headers = {"HTTP_AUTHORIZATION": f"Token {self.token}"} if auth else {}
+        if method == "get":
+            resp = self.client.get(path, data or {}, **headers)
+        else:
+            resp = self.client.post(path, data, content_type="application/json", **headers)
+        return resp
+
+    def measure(self, request, iterations):
+        latencies, queries, errors = [], [], 0
+        started = time.perf_counter()
+        for i in range(iterations):
+            with CaptureQueriesContext(connection) as ctx:
+                t0 = time.perf_counter()
+                resp = self.call(request, i)
+                latencies.append((time.perf_counter() - t0) * 1000)
+            queries.append(len(ctx.captured_queries))
+            if resp.status_code >= 400:
+                errors += 1
+            self.remember(request, resp)
+        wall = time.perf_counter() - started
+        summary = summarize(latencies, wall, errors)
+        summary["queries_mean"] = round(sum(queries) / len(queries), 2) if queries else None
+        summary["queries_max"] = max(queries) if queries else None
+        return summary
+
+    def remember(self, request, resp):
+        if resp.status_code >= 300:
+            return
+        name = request.__name__
+        data = getattr(resp, "data", None) or {}
+        if name == "scenario_register":
+            self.created["users"] += list(
+                User.objects.filter(username=data.get("username")).values_list("id", flat=True)
+            )
+        elif name == "scenario_conversation_create" and "id" in data:
+            self.created["conversations"].append(data["id"])
+        elif name == "scenario_message_send" and "id" in data:
+            self.created["messages"].append(data["id"])
+
+    # ---- scenarios: (method, path, data, authenticated) ----
+
+    def scenario_register(self, i):
+        username = f"bench_{self.run_id}_{i}"
+        password = "Bench-pass-9081"
+        return "post", "/api/chat/register/", {
+            "username": username, "email": f"{username}@example.com",
+            "password": password, "password2": password,
+        }, False
+
+    def scenario_login(self, i):
+        user = self.rng.choice(self.users)
+        return "post", "/api/chat/login/", {"username": user.username, "password": SEED_PASSWORD}, False
+
+    def scenario_conversation_list(self, i):
+        return "get", "/api/chat/conversations/", None, True
+
+    def scenario_conversation_create(self, i):
+        members = [u.pk for u in self.rng.sample(self.users, 3) if u.pk != self.actor.pk]
+        return "post", "/api/chat/conversations/", {
+            "is_group": True, "name": f"bench {self.run_id} {i}", "members": members,
+        }, True
+
+    def scenario_inbox(self, i):
+        return "get", "/api/chat/inbox/", None, True
+
+    def scenario_message_list(self, i):
+        return "get", f"/api/chat/messages/{self.conversation.pk}/", {"limit": 50}, True
+
+    def scenario_message_list_compact(self, i):
+        return "get", f"/api/chat/messages/{self.conversation.pk}/", {
+            "limit": 50, "compact": 1, "format": "msgpack",
+        }, True
+
+    def scenario_message_send(self, i):
+        return "post", "/api/chat/messages/send/", {
+            "conversation_id": self.conversation.pk, "text": f"benchmark {self.run_id} {i}",
+        }, True
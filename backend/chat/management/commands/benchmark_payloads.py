@@ -0,0 +1,94 @@
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.test import RequestFactory
+from rest_framework.renderers import JSONRenderer
+
+from chat.bench import measure_payload
+from chat.compact import users_table
+from chat.models import Message
+from chat.pagination import InboxCursorPagination
+from chat.serializers import InboxConversationSerializer, MessageSerializer
+from chat.views import InboxView, conversation_messages
+from core.renderers import MessagePackRenderer, ORJSONRenderer
+
+# name -> (compact, renderer); the first one is DRF's own output, the baseline
+VARIANTS = {
+    "drf_json": (False, JSONRenderer()),
+    "orjson": (False, ORJSONRenderer()),
+    "compact_orjson": (True, ORJSONRenderer()),
+    "compact_msgpack": (True, MessagePackRenderer()),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare response size and serialization/encoding time of the message list and "
+        "inbox pages across renderers and the compact representation (seed with seed_chat first)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=50)
+        parser.add_argument("--limit", type=int, default=50, help="Items per page.")
+        parser.add_argument("--prefix", default="seed", help="Username prefix used by seed_chat.")
+        parser.add_argument("--output", help="Write the JSON results to this file.")
+
+    def handle(self, *args, **options):
+        busiest = (
+            Message.objects.filter(sender__username__startswith=f"{options['prefix']}_")
+            .values("conversation_id")
+            .annotate(n=Count("id"))
+            .order_by("-n")
+            .first()
+        )
+        if busiest is None:
+            raise CommandError("No seeded messages; run seed_chat with --messages first.")
+        limit = options["limit"]
+        messages = list(conversation_messages(busiest["conversation_id"]).order_by("-id")[:limit])
+
+        hosts = [h for h in settings.ALLOWED_HOSTS if h and h != "*" and not h.startswith(".")]
+        request = RequestFactory().get("/", HTTP_HOST=hosts[0] if hosts else "localhost")
+        request.user = messages[0].sender
+        inbox_view = InboxView()
+        inbox_view.request = request
+        inbox = list(inbox_view.get_queryset().order_by(*InboxCursorPagination.ordering)[:limit])
+
+        datasets = {"message_list": (MessageSerializer, messages), "inbox": (InboxConversationSerializer, inbox)}
+        report = {}
+        for dataset, (serializer_class, rows) in datasets.items():
+            results = {}
+            for name, (compact, renderer) in VARIANTS.items():
+                results[name] = measure_payload(
+                    self.serializer(serializer_class, rows, request, compact),
+                    renderer.render,
+                    options["iterations"],
+                )
+            baseline = results["drf_json"]
+            for result in results.values():
+                result["bytes_ratio"] = round(result["bytes"] / baseline["bytes"], 3)
+                if baseline["total_ms"]:
+                    result["time_ratio"] = round(result["total_ms"] / baseline["total_ms"], 3)
+            report[dataset] = {"items": len(rows), "variants": results}
+            best = min(results, key=lambda name: results[name]["bytes"])
+            self.stderr.write(f"{dataset}: smallest {best} at {results[best]['bytes_ratio']:.0%} of drf_json")
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as fh:
+                fh.write(output)
+        self.stdout.write(output)
+
+    @staticmethod
+    def serializer(serializer_class, rows, request, compact):
+        def serialize():
+            context = {"request": request}
+            if compact:
+                context["users"] = {}
+            data = {"results": serializer_class(rows, many=True, context=context).data}
+            if compact:
+                data["users"] = users_table(context["users"])
+            return data
+
+        return serialize
@@ -0,0 +1,75 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import IntegrityError, transaction
+from django.db.models import ProtectedError
+from django.utils import timezone
+
+from chat.blobs import orphaned_blobs, recount_refs, stray_files
+
+
+class Command(BaseCommand):
+    help = (
+        "Garbage-collect attachment blobs: delete blobs no attachment or pending upload "
+        "refers to (unused for at least the grace period) together with their files."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--grace-seconds", type=int, default=settings.BLOB_GC_GRACE_SECONDS)
+        parser.add_argument("--recount", action="store_true", help="Recompute ref counts first.")
+        parser.add_argument(
+            "--scan-storage", action="store_true",
+            help="Also delete files under blobs/ that have no Blob row.",
+        )
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(seconds=options["grace_seconds"])
+        dry_run = options["dry_run"]
+
+        if options["recount"] and not dry_run:
+            self.stdout.write(f"recounted {recount_refs()} blobs")
+
+        deleted = freed = 0
+        last_id = 0
+        while True:
+            batch = list(
+                orphaned_blobs(before).filter(pk__gt=last_id).order_by("pk")[:options["batch_size"]]
+            )
+            if not batch:
+                break
+            last_id = batch[-1].pk
+            for blob in batch:
+                if dry_run:
+                    self.stdout.write(f"would delete {blob.file.name} ({blob.size} bytes)")
+                elif not self.delete_blob(blob, before):
+                    continue
+                deleted += 1
+                freed += blob.size
+
+        strays = 0
+        if options["scan_storage"]:
+            for path in stray_files(before, options["batch_size"]):
+                if dry_run:
+                    self.stdout.write(f"would delete stray {path}")
+                else:
+                    default_storage.delete(path)
+                strays += 1
+
+        verb = "would delete" if dry_run else "deleted"
+        self.stdout.write(f"{verb} {deleted} blobs ({freed} bytes), {strays} stray files")
+
+    def delete_blob(self, blob, before):
+        # دوباره زیر قفل: شاید در این فاصله با hash ارسال شده باشد
+        try:
+            with transaction.atomic():
+                if not orphaned_blobs(before).select_for_update().filter(pk=blob.pk).exists():
+                    return False
+                blob.delete()
+        except (IntegrityError, ProtectedError):
+            return False
+        default_storage.delete(blob.file.name)
+        return True
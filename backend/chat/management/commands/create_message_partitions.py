@@ -0,0 +1,41 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from chat import partitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Create the upcoming id-range partitions of chat_message on PostgreSQL "
+        "(run it periodically: the maintenance service in docker-compose does, hourly). "
+        "--convert partitions an existing plain table."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--ahead", type=int, default=settings.CHAT_MESSAGE_PARTITIONS_AHEAD)
+        parser.add_argument("--size", type=int, default=settings.CHAT_MESSAGE_PARTITION_SIZE)
+        parser.add_argument(
+            "--convert", action="store_true",
+            help="Turn a plain chat_message table into a partitioned one first.",
+        )
+
+    def handle(self, *args, **options):
+        if not partitions.supported(connection):
+            self.stderr.write(f"chat_message is not partitioned on {connection.vendor}; nothing to do.")
+            return
+
+        with transaction.atomic():
+            if not partitions.is_partitioned(connection):
+                if not options["convert"]:
+                    raise CommandError("chat_message is not partitioned; rerun with --convert.")
+                partitions.convert(connection, options["size"])
+                self.stdout.write("converted chat_message to a partitioned table")
+            created = partitions.ensure_partitions(connection, options["ahead"], options["size"])
+
+        for name in created:
+            self.stdout.write(f"created {name}")
+        last_id = partitions.last_message_id(connection)
+        for p in partitions.list_partitions(connection):
+            state = "archived" if p.archived else ("current" if (p.start or 0) <= last_id < p.end else "")
+            self.stdout.write(f"{p.name}: ids {p.start if p.start is not None else 'min'}..{p.end} {state}".rstrip())
@@ -0,0 +1,60 @@
+import hashlib
+
+from django.core.files.storage import default_storage
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from chat.blobs import add_refs, store_blob
+from chat.models import MessageAttachment, Upload
+from chat.uploads import CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = (
+        "Move attachments stored before content addressing into blobs: identical files end "
+        "up stored once and the old per-upload copies are deleted."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=200)
+
+    def handle(self, *args, **options):
+        legacy = MessageAttachment.objects.filter(blob__isnull=True).exclude(file="")
+        moved = missing = freed = 0
+        last_id = 0
+        while True:
+            batch = list(legacy.filter(pk__gt=last_id).order_by("pk")[:options["batch_size"]])
+            if not batch:
+                break
+            last_id = batch[-1].pk
+            for attachment in batch:
+                old = attachment.file.name
+                if not default_storage.exists(old):
+                    missing += 1
+                    continue
+                blob = self.store(attachment)
+                with transaction.atomic():
+                    updated = MessageAttachment.objects.filter(pk=attachment.pk, blob__isnull=True).update(
+                        blob=blob, file=blob.file.name, name=attachment.name or old.rsplit("/", 1)[-1]
+                    )
+                    add_refs([blob.pk] * updated)
+                moved += updated
+                # نسخه‌ی قدیمی فقط وقتی کسی دیگر به همان مسیر اشاره نکند
+                if (
+                    old != blob.file.name
+                    and not MessageAttachment.objects.filter(file=old).exists()
+                    and not Upload.objects.filter(file=old).exists()
+                ):
+                    freed += attachment.file.size
+                    default_storage.delete(old)
+            self.stdout.write(f"attachments moved {moved}")
+
+        self.stdout.write(f"moved {moved} attachments, freed {freed} bytes, {missing} files missing")
+
+    def store(self, attachment):
+        digest = hashlib.sha256()
+        with attachment.file.open("rb") as fh:
+            for chunk in fh.chunks(CHUNK_SIZE):
+                digest.update(chunk)
+        with attachment.file.open("rb") as fh:
+            return store_blob(fh, digest.hexdigest(), attachment.file.size, attachment.content_type)
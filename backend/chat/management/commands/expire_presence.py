@@ -0,0 +1,45 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chat.events import publish_presence
+from chat.membership import get_contact_ids
+from chat.presence import sweep
+
+
+class Command(BaseCommand):
+    help = (
+        "Announce offline to the contacts of users whose last connection stopped "
+        "heart-beating without a disconnect (HTTP heartbeat clients, dropped sockets). "
+        "Runs until stopped; several can run side by side. Needs the redis presence "
+        "store unless run in the serving process."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument(
+            "--interval", type=float, default=5.0,
+            help="Seconds between sweeps.",
+        )
+        parser.add_argument("--once", action="store_true", help="Sweep once and exit.")
+
+    def handle(self, *args, **options):
+        total = 0
+        try:
+            while True:
+                close_old_connections()
+                offline = sweep(options["batch_size"])
+                for user_id in offline:
+                    publish_presence(user_id, False, get_contact_ids(user_id))
+                total += len(offline)
+                if len(offline) == options["batch_size"]:
+                    continue
+                if options["once"]:
+                    break
+                time.sleep(options["interval"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            close_old_connections()
+        self.stdout.write(f"announced {total} users offline")
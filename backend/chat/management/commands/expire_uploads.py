@@ -0,0 +1,110 @@
+import uuid
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from chat.models import Upload
+from chat.uploads import UploadBusy, locked_partial, partial_path
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete chunked uploads left pending with no chunk received for the expiry period, "
+        "with their partial files; completed uploads never attached to a message within it "
+        "(so collect_blobs can drop their blobs); and partial files no pending upload owns."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--expire-seconds", type=int, default=settings.CHUNKED_UPLOAD_EXPIRE_SECONDS)
+        parser.add_argument("--batch-size", type=int, default=500)
+        parser.add_argument("--dry-run", action="store_true")
+
+    def handle(self, *args, **options):
+        before = timezone.now() - timedelta(seconds=options["expire_seconds"])
+        dry_run = options["dry_run"]
+
+        expired = 0
+        last_id = None
+        while True:
+            stale = Upload.objects.filter(status=Upload.PENDING, updated_at__lt=before).order_by("pk")
+            if last_id is not None:
+                stale = stale.filter(pk__gt=last_id)
+            batch = list(stale[:options["batch_size"]])
+            if not batch:
+                break
+            last_id = batch[-1].pk
+            for upload in batch:
+                if dry_run:
+                    self.stdout.write(f"would expire upload {upload.pk} ({upload.offset}/{upload.size} bytes)")
+                elif not self.expire(upload, before):
+                    continue
+                expired += 1
+
+        # completed but never sent: nothing on disk of their own, but they keep their blob alive
+        last_id = None
+        while True:
+            unused = Upload.objects.filter(status=Upload.COMPLETE, updated_at__lt=before).order_by("pk")
+            if last_id is not None:
+                unused = unused.filter(pk__gt=last_id)
+            batch = list(unused.values_list("pk", flat=True)[:options["batch_size"]])
+            if not batch:
+                break
+            last_id = batch[-1]
+            if dry_run:
+                for pk in batch:
+                    self.stdout.write(f"would expire unattached upload {pk}")
+                expired += len(batch)
+            else:
+                # شرط دوباره: اگر همین حالا به پیامی وصل شده باشد، ATTACHED است و حذف نمی‌شود
+                deleted, _ = Upload.objects.filter(
+                    pk__in=batch, status=Upload.COMPLETE, updated_at__lt=before
+                ).delete()
+                expired += deleted
+
+        strays = 0
+        directory = Path(settings.CHUNKED_UPLOAD_DIR)
+        if directory.is_dir():
+            cutoff = before.timestamp()
+            candidates = {
+                path.stem: path for path in directory.glob("*.part") if path.stat().st_mtime < cutoff
+            }
+            pending = {
+                str(pk) for pk in Upload.objects.filter(
+                    pk__in=[stem for stem in candidates if is_uuid(stem)], status=Upload.PENDING
+                ).values_list("pk", flat=True)
+            }
+            for stem, path in candidates.items():
+                if stem in pending:
+                    continue
+                if dry_run:
+                    self.stdout.write(f"would delete stray {path}")
+                else:
+                    path.unlink(missing_ok=True)
+                strays += 1
+
+        verb = "would delete" if dry_run else "deleted"
+        self.stdout.write(f"{verb} {expired} expired uploads, {strays} stray partial files")
+
+    def expire(self, upload, before):
+        # زیر قفل فایل: اگر همین حالا تکه‌ای در راه است، دست نمی‌خورد
+        try:
+            with locked_partial(upload):
+                deleted, _ = Upload.objects.filter(
+                    pk=upload.pk, status=Upload.PENDING, updated_at__lt=before
+                ).delete()
+                if deleted:
+                    partial_path(upload).unlink(missing_ok=True)
+        except UploadBusy:
+            return False
+        return bool(deleted)
+
+
+def is_uuid(value):
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        return False
+    return True
@@ -0,0 +1,42 @@
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.export import EXPORT_BATCH_SIZE, EXPORT_FORMATS, export_stream
+from chat.models import Conversation
+
+
+class Command(BaseCommand):
+    help = "Export a conversation's full history (NDJSON or CSV, optionally gzipped) with flat memory use."
+
+    def add_arguments(self, parser):
+        parser.add_argument("conversation_id", type=int)
+        parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson")
+        parser.add_argument("--gzip", action="store_true", help="Compress the output with gzip.")
+        parser.add_argument("--output", "-o", help="File to write; stdout when omitted.")
+        parser.add_argument("--batch-size", type=int, default=EXPORT_BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        conversation_id = options["conversation_id"]
+        if not Conversation.objects.filter(pk=conversation_id).exists():
+            raise CommandError(f"Conversation {conversation_id} does not exist.")
+
+        blocks = export_stream(
+            conversation_id,
+            options["format"],
+            compress=options["gzip"],
+            batch_size=options["batch_size"],
+        )
+        out = open(options["output"], "wb") if options["output"] else sys.stdout.buffer
+        written = 0
+        try:
+            for block in blocks:
+                out.write(block)
+                written += len(block)
+        finally:
+            if options["output"]:
+                out.close()
+            else:
+                out.flush()
+        if options["output"]:
+            self.stderr.write(f"wrote {written} bytes to {options['output']}")
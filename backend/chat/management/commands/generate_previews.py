@@ -0,0 +1,44 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat.models import MessageAttachment
+from chat.previews import run_previews
+
+
+class Command(BaseCommand):
+    help = "Generate thumbnails, placeholders and dimensions for image attachments (backfill)."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--all", action="store_true",
+            help="Regenerate every attachment, not only pending/failed ones.",
+        )
+        parser.add_argument("--batch-size", type=int, default=100)
+        parser.add_argument("--workers", type=int, default=settings.ATTACHMENT_PREVIEW_WORKERS)
+
+    def handle(self, *args, **options):
+        qs = MessageAttachment.objects.order_by("id")
+        if not options["all"]:
+            qs = qs.filter(
+                preview_status__in=[MessageAttachment.PREVIEW_PENDING, MessageAttachment.PREVIEW_FAILED]
+            )
+        ids = list(qs.values_list("id", flat=True))
+        size = options["batch_size"]
+        batches = [ids[i:i + size] for i in range(0, len(ids), size)]
+
+        if options["workers"] > 1:
+            pool = ThreadPoolExecutor(max_workers=options["workers"])
+            results = pool.map(run_previews, batches)
+        else:
+            pool = None
+            results = map(run_previews, batches)
+        try:
+            for done, _ in enumerate(results, start=1):
+                self.stdout.write(f"batch {done}/{len(batches)}")
+        finally:
+            if pool is not None:
+                pool.shutdown()
+
+        self.stdout.write(self.style.SUCCESS(f"Processed {len(ids)} attachment(s)."))
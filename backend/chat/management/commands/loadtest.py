@@ -0,0 +1,106 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from rest_framework.authtoken.models import Token
+
+from chat.bench import summarize
+from chat.models import Conversation
+
+User = get_user_model()
+
+
+class Command(BaseCommand):
+    help = (
+        "HTTP load test against a running server (e.g. runserver vs. python -m core.serve). "
+        "Mixes message list and message send requests and prints latency percentiles as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8000", help="Server base URL.")
+        parser.add_argument("--concurrency", type=int, default=32)
+        parser.add_argument("--duration", type=float, default=20.0, help="Seconds to run.")
+        parser.add_argument(
+            "--send-ratio", type=float, default=0.2,
+            help="Fraction of requests that send a message (the rest list messages).",
+        )
+        parser.add_argument("--token", help="Existing API token; a fixture user is created if omitted.")
+        parser.add_argument("--conversation", type=int, help="Conversation id to use with --token.")
+        parser.add_argument("--label", default="", help="Free-form label stored with the results.")
+        parser.add_argument("--output", help="Write the JSON results to this file.")
+
+    def handle(self, *args, **options):
+        token, conversation_id = options["token"], options["conversation"]
+        if not token:
+            token, conversation_id = self.make_fixture()
+
+        base = options["url"].rstrip("/")
+        headers = {"Authorization": f"Token {token}", "Content-Type": "application/json"}
+        list_url = f"{base}/api/chat/messages/{conversation_id}/?limit=50"
+        send_url = f"{base}/api/chat/messages/send/"
+        send_every = round(1 / options["send_ratio"]) if options["send_ratio"] > 0 else 0
+
+        samples = {"list": [], "send": []}
+        errors = {"list": 0, "send": 0}
+        lock = threading.Lock()
+        deadline = time.monotonic() + options["duration"]
+
+        def worker(worker_id):
+            n = 0
+            while time.monotonic() < deadline:
+                n += 1
+                kind = "send" if send_every and (n + worker_id) % send_every == 0 else "list"
+                if kind == "send":
+                    body = json.dumps({"conversation_id": conversation_id, "text": f"load {worker_id}/{n}"})
+                    req = urllib.request.Request(send_url, data=body.encode(), headers=headers, method="POST")
+                else:
+                    req = urllib.request.Request(list_url, headers=headers)
+                started = time.perf_counter()
+                try:
+                    with urllib.request.urlopen(req, timeout=30) as resp:
+                        resp.read()
+                    ok = True
+                except (urllib.error.URLError, OSError):
+                    ok = False
+                elapsed = (time.perf_counter() - started) * 1000
+                with lock:
+                    if ok:
+                        samples[kind].append(elapsed)
+                    else:
+                        errors[kind] += 1
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=options["concurrency"]) as pool:
+            list(pool.map(worker, range(options["concurrency"])))
+        wall = time.monotonic() - started
+
+        results = {
+            "label": options["label"],
+            "url": base,
+            "concurrency": options["concurrency"],
+            "duration_s": round(wall, 2),
+            "endpoints": {},
+        }
+        for kind, values in samples.items():
+            results["endpoints"][kind] = summarize(values, wall, errors[kind])
+
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as fh:
+                fh.write(output)
+        self.stdout.write(output)
+
+    def make_fixture(self):
+        user, _ = User.objects.get_or_create(username="loadtest")
+        peer, _ = User.objects.get_or_create(username="loadtest-peer")
+        conv = Conversation.objects.filter(name="loadtest", is_group=True, members=user).first()
+        if conv is None:
+            conv = Conversation.objects.create(name="loadtest", is_group=True)
+            conv.members.set([user, peer])
+        token, _ = Token.objects.get_or_create(user=user)
+        return token.key, conv.id
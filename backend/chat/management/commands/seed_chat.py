@@ -0,0 +1,190 @@
+import hashlib
+import random
+from itertools import accumulate
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Max, OuterRef, Subquery
+from django.utils import timezone
+
+from chat.blobs import add_refs, store_blob
+from chat.models import Conversation, Message, MessageAttachment, ReadCursor
+
+User = get_user_model()
+Membership = Conversation.members.through
+
+SEED_PASSWORD = "seed-pass-123"
+WORDS = (
+    "salam hello meeting report deploy fix review lunch today tomorrow please thanks "
+    "ok done build release server client bug ticket design call later sure"
+).split()
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed realistic chat data for benchmarks: users, DMs, groups, messages spread over "
+        "conversations with a Zipf-like skew, and a share of attachments. Runs offline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--dms", type=int, default=400)
+        parser.add_argument("--groups", type=int, default=40)
+        parser.add_argument("--group-size", type=int, nargs=2, default=[3, 30], metavar=("MIN", "MAX"))
+        parser.add_argument("--messages", type=int, default=20000)
+        parser.add_argument(
+            "--skew", type=float, default=1.1,
+            help="Zipf exponent for messages per conversation (0 = uniform).",
+        )
+        parser.add_argument("--attachment-ratio", type=float, default=0.02)
+        parser.add_argument("--prefix", default="seed", help="Username prefix of the generated users.")
+        parser.add_argument("--flush", action="store_true", help="Delete users with this prefix first.")
+        parser.add_argument("--seed", type=int, default=42, help="Random seed, for repeatable datasets.")
+        parser.add_argument("--batch-size", type=int, default=5000)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options["seed"])
+        prefix = options["prefix"]
+        batch = options["batch_size"]
+
+        if options["flush"]:
+            self.flush(prefix)
+        if User.objects.filter(username__startswith=f"{prefix}_").exists():
+            raise CommandError(f"Users named {prefix}_* already exist; use --flush or another --prefix.")
+        if options["users"] < 2:
+            raise CommandError("--users must be at least 2.")
+
+        with transaction.atomic():
+            users = self.create_users(prefix, options["users"], batch)
+            conversations = self.create_conversations(rng, users, options, batch)
+            self.create_messages(rng, conversations, options, batch)
+
+        self.stdout.write(
+            f"seeded {len(users)} users ({prefix}_0..{prefix}_{len(users) - 1}, password {SEED_PASSWORD!r}), "
+            f"{len(conversations)} conversations, {options['messages']} messages"
+        )
+
+    def flush(self, prefix):
+        users = User.objects.filter(username__startswith=f"{prefix}_")
+        Conversation.objects.filter(members__in=users).distinct().delete()
+        users.delete()
+
+    def create_users(self, prefix, count, batch):
+        # one hash for everyone: hashing per user would dominate the run
+        password = make_password(SEED_PASSWORD)
+        User.objects.bulk_create(
+            [
+                User(username=f"{prefix}_{i}", email=f"{prefix}_{i}@example.com", password=password)
+                for i in range(count)
+            ],
+            batch_size=batch,
+        )
+        return list(User.objects.filter(username__startswith=f"{prefix}_").values_list("id", flat=True))
+
+    def create_conversations(self, rng, users, options, batch):
+        """Returns ``[(conversation_id, member_ids), ...]``."""
+        now = timezone.now()
+        pairs = set()
+        max_pairs = len(users) * (len(users) - 1) // 2
+        while len(pairs) < min(options["dms"], max_pairs):
+            pairs.add(tuple(sorted(rng.sample(users, 2))))
+
+        low, high = options["group_size"]
+        groups = [rng.sample(users, rng.randint(min(low, len(users)), min(high, len(users))))
+                  for _ in range(options["groups"])]
+
+        convs = [Conversation(dm_key=Conversation.make_dm_key(a, b), last_activity_at=now) for a, b in pairs]
+        convs += [
+            Conversation(is_group=True, name=f"{options['prefix']} group {i}", last_activity_at=now)
+            for i in range(len(groups))
+        ]
+        Conversation.objects.bulk_create(convs, batch_size=batch)
+
+        members = [list(pair) for pair in pairs] + groups
+        result = [(conv.pk, member_ids) for conv, member_ids in zip(convs, members)]
+        Membership.objects.bulk_create(
+            [Membership(conversation_id=c, user_id=u) for c, ids in result for u in ids], batch_size=batch
+        )
+        ReadCursor.objects.bulk_create(
+            [ReadCursor(conversation_id=c, user_id=u) for c, ids in result for u in ids], batch_size=batch
+        )
+        return result
+
+    def create_messages(self, rng, conversations, options, batch):
+        total = options["messages"]
+        if not conversations or not total:
+            return
+
+        # rank r gets weight 1 / r^skew: a few very busy conversations, a long quiet tail
+        order = list(conversations)
+        rng.shuffle(order)
+        weights = list(accumulate(1 / (rank ** options["skew"]) for rank in range(1, len(order) + 1)))
+
+        # a handful of real blobs shared by all seeded attachments
+        blobs = []
+        if options["attachment_ratio"] > 0:
+            for i in range(8):
+                data = rng.randbytes(2048)
+                blobs.append(store_blob(ContentFile(data), hashlib.sha256(data).hexdigest(), len(data)))
+
+        created = 0
+        while created < total:
+            size = min(batch, total - created)
+            picks = rng.choices(order, cum_weights=weights, k=size)
+            messages = Message.objects.bulk_create(
+                [
+                    Message(
+                        conversation_id=conv_id,
+                        sender_id=rng.choice(member_ids),
+                        text=" ".join(rng.choices(WORDS, k=rng.randint(1, 20))),
+                    )
+                    for conv_id, member_ids in picks
+                ],
+                batch_size=batch,
+            )
+            if blobs:
+                attachments = MessageAttachment.objects.bulk_create(
+                    [
+                        MessageAttachment(
+                            message_id=msg.pk,
+                            blob=blob,
+                            file=blob.file.name,
+                            name=f"{options['prefix']}_{blob.pk}.bin",
+                            content_type="application/octet-stream",
+                            size=blob.size,
+                            preview_status=MessageAttachment.PREVIEW_NONE,
+                        )
+                        for msg in messages
+                        if rng.random() < options["attachment_ratio"]
+                        for blob in [rng.choice(blobs)]
+                    ],
+                    batch_size=batch,
+                )
+                add_refs(a.blob_id for a in attachments)
+            created += size
+            self.stdout.write(f"messages {created}/{total}")
+
+        # inbox denormalization that register_message would have kept up to date
+        last_ids = dict(
+            Message.objects.filter(conversation_id__in=[c for c, _ in conversations])
+            .values("conversation_id")
+            .annotate(last=Max("id"))
+            .values_list("conversation_id", "last")
+        )
+        last_messages = Message.objects.in_bulk(list(last_ids.values()))
+        updates = []
+        for conv_id, last_id in last_ids.items():
+            message = last_messages[last_id]
+            updates.append(
+                Conversation(pk=conv_id, last_message_id=last_id, last_activity_at=message.created_at)
+            )
+        Conversation.objects.bulk_update(updates, ["last_message", "last_activity_at"], batch_size=batch)
+        # seeded history counts as read; members see the conversations in activity order
+        conversation = Conversation.objects.filter(pk=OuterRef("conversation_id"))
+        ReadCursor.objects.filter(conversation_id__in=list(last_ids)).update(
+            last_read_message_id=Subquery(conversation.values("last_message_id")[:1]),
+            last_activity_at=Subquery(conversation.values("last_activity_at")[:1]),
+        )
@@ -0,0 +1,52 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+
+from chat.push import drain, prune_dead
+
+
+class Command(BaseCommand):
+    help = (
+        "Drain the push outbox: fan new messages out to every recipient through "
+        "CHAT_PUSH_NOTIFIER, retrying failures with backoff up to CHAT_PUSH_MAX_ATTEMPTS. "
+        "Runs until stopped; "
+        "several workers can run side by side."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=settings.CHAT_PUSH_BATCH_SIZE)
+        parser.add_argument("--workers", type=int, default=settings.CHAT_PUSH_WORKERS)
+        parser.add_argument(
+            "--poll-interval", type=float, default=1.0,
+            help="Seconds to sleep when nothing is due.",
+        )
+        parser.add_argument("--once", action="store_true", help="Exit once nothing is due.")
+
+    def handle(self, *args, **options):
+        dead = prune_dead()
+        if dead:
+            self.stderr.write(f"dropped {dead} messages past CHAT_PUSH_MAX_ATTEMPTS")
+        pool = ThreadPoolExecutor(max_workers=options["workers"], thread_name_prefix="push")
+        total_rows = total_sent = 0
+        try:
+            while True:
+                close_old_connections()
+                rows, sent, retried = drain(pool, options["batch_size"])
+                total_rows += rows
+                total_sent += sent
+                if retried:
+                    self.stderr.write(f"{retried} of {rows} messages rescheduled")
+                if rows:
+                    continue
+                if options["once"]:
+                    break
+                time.sleep(options["poll_interval"])
+        except KeyboardInterrupt:
+            pass
+        finally:
+            pool.shutdown()
+            close_old_connections()
+        self.stdout.write(f"delivered {total_sent} notifications for {total_rows} messages")
@@ -0,0 +1,71 @@
+from django.conf import settings
+from django.core.cache import cache
+
+from core.db_router import use_primary
+from core.versions import bump_versions
+
+from .models import Conversation
+
+
+def membership_cache_key(user_id):
+    return f"chat:conversations:{user_id}"
+
+
+def get_conversation_ids(user_id):
+    """
+    Set of conversation ids ``user_id`` belongs to, cached for
+    ``MEMBERSHIP_CACHE_TTL`` seconds and dropped on every member change
+    (see chat.signals). Filled from the primary: a lagging replica read
+    right after the invalidation would stick until the TTL.
+    """
+    key = membership_cache_key(user_id)
+    ids = cache.get(key)
+    if ids is None:
+        with use_primary():
+            ids = frozenset(
+                Conversation.members.through.objects.filter(user_id=user_id)
+                .values_list("conversation_id", flat=True)
+            )
+        cache.set(key, ids, settings.MEMBERSHIP_CACHE_TTL)
+    return ids
+
+
+def contacts_cache_key(user_id):
+    return f"chat:contacts:{user_id}"
+
+
+def get_contact_ids(user_id):
+    """
+    Ids of everyone sharing a conversation with ``user_id`` (themselves
+    included), cached like the membership set and dropped for all members
+    of a conversation whose members change.
+    """
+    key = contacts_cache_key(user_id)
+    ids = cache.get(key)
+    if ids is None:
+        with use_primary():
+            ids = frozenset(
+                Conversation.members.through.objects.filter(conversation_id__in=get_conversation_ids(user_id))
+                .values_list("user_id", flat=True)
+                .distinct()
+            ) | {user_id}
+        cache.set(key, ids, settings.MEMBERSHIP_CACHE_TTL)
+    return ids
+
+
+def invalidate_contacts(user_ids):
+    cache.delete_many([contacts_cache_key(user_id) for user_id in user_ids])
+
+
+def conversations_scope(user_id):
+    """Version scope of ``user_id``'s conversation list (see core.versions)."""
+    return f"conversations:{user_id}"
+
+
+def is_member(user_id, conversation_id):
+    return conversation_id in get_conversation_ids(user_id)
+
+
+def invalidate_memberships(user_ids):
+    cache.delete_many([membership_cache_key(user_id) for user_id in user_ids])
+    bump_versions([conversations_scope(user_id) for user_id in user_ids])
@@ -0,0 +1,39 @@
+from urllib.parse import parse_qs
+
+from channels.db import database_sync_to_async
+from channels.middleware import BaseMiddleware
+from django.contrib.auth.models import AnonymousUser
+
+from users.authentication import get_token
+
+
+@database_sync_to_async
+def get_user_for_token(key):
+    # همان lookup کش‌شده‌ی REST؛ logout و غیرفعال شدن هر دو مسیر را با هم باطل می‌کند
+    token = get_token(key)
+    return token.user if token is not None and token.user.is_active else AnonymousUser()
+
+
+class TokenAuthMiddleware(BaseMiddleware):
+    """
+    احراز هویت WebSocket با همان توکن DRF.
+    توکن از هدر ``Authorization: Token <key>`` یا ``?token=<key>`` خوانده می‌شود
+    (کلاینت‌های موبایل همیشه نمی‌توانند هدر بفرستند).
+    """
+
+    async def __call__(self, scope, receive, send):
+        scope = dict(scope)
+        key = self.get_token_key(scope)
+        scope["user"] = await get_user_for_token(key) if key else AnonymousUser()
+        return await super().__call__(scope, receive, send)
+
+    @staticmethod
+    def get_token_key(scope):
+        for name, value in scope.get("headers", []):
+            if name == b"authorization":
+                parts = value.decode("latin1").split()
+                if len(parts) == 2 and parts[0].lower() == "token":
+                    return parts[1]
+        query = parse_qs(scope.get("query_string", b"").decode("latin1"))
+        tokens = query.get("token")
+        return tokens[0] if tokens else None
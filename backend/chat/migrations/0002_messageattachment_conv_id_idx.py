@@ -0,0 +1,47 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:06
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageAttachment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file', models.FileField(upload_to='attachments/%Y/%m/%d')),
+                ('content_type', models.CharField(blank=True, default='', max_length=100)),
+                ('size', models.IntegerField(default=0)),
+                ('uploaded_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+            },
+        ),
+        migrations.AlterModelOptions(
+            name='message',
+            options={'ordering': ['id']},
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='text',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'id'], name='chat_msg_conv_id_idx'),
+        ),
+        migrations.AddField(
+            model_name='messageattachment',
+            name='message',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='attachments', to='chat.message'),
+        ),
+    ]
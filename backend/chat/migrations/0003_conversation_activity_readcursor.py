@@ -0,0 +1,70 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:09
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+
+
+def backfill(apps, schema_editor):
+    Conversation = apps.get_model("chat", "Conversation")
+    Message = apps.get_model("chat", "Message")
+    ReadCursor = apps.get_model("chat", "ReadCursor")
+    Membership = Conversation.members.through
+    db = schema_editor.connection.alias
+
+    for conv in Conversation.objects.using(db).iterator():
+        last = Message.objects.using(db).filter(conversation_id=conv.pk).order_by("-id").first()
+        conv.last_message = last
+        conv.last_activity_at = last.created_at if last else conv.created_at
+        conv.save(using=db, update_fields=["last_message", "last_activity_at"])
+
+        # پیام‌های قبل از مهاجرت خوانده‌شده فرض می‌شوند
+        ReadCursor.objects.using(db).bulk_create(
+            [
+                ReadCursor(
+                    conversation_id=conv.pk,
+                    user_id=user_id,
+                    last_read_message_id=last.pk if last else 0,
+                )
+                for user_id in Membership.objects.using(db).filter(conversation_id=conv.pk)
+                .values_list("user_id", flat=True)
+            ],
+            ignore_conflicts=True,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0002_messageattachment_conv_id_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_activity_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.CreateModel(
+            name='ReadCursor',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('last_read_message_id', models.BigIntegerField(default=0)),
+                ('unread_count', models.PositiveIntegerField(default=0)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('conversation', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to='chat.conversation')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='read_cursors', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('conversation', 'user'), name='chat_readcursor_conv_user_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+    ]
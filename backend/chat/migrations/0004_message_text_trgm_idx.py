@@ -0,0 +1,34 @@
+from django.db import migrations
+
+# Django's icontains compiles to ``UPPER("text"::text) LIKE UPPER(%s)`` on
+# PostgreSQL, so the trigram index is built on the same expression.
+CREATE_SQL = (
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS chat_msg_text_trgm_idx "
+    "ON chat_message USING gin (UPPER(text) gin_trgm_ops)"
+)
+DROP_SQL = "DROP INDEX CONCURRENTLY IF EXISTS chat_msg_text_trgm_idx"
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    schema_editor.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+    schema_editor.execute(CREATE_SQL)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "postgresql":
+        schema_editor.execute(DROP_SQL)
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY cannot run inside a transaction.
+    atomic = False
+
+    dependencies = [
+        ('chat', '0003_conversation_activity_readcursor'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:11
+
+import django.db.models.deletion
+import uuid
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_message_text_trgm_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='messageattachment',
+            name='size',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='Upload',
+            fields=[
+                ('id', models.UUIDField(default=uuid.uuid4, editable=False, primary_key=True, serialize=False)),
+                ('filename', models.CharField(max_length=255)),
+                ('content_type', models.CharField(blank=True, default='', max_length=100)),
+                ('size', models.BigIntegerField()),
+                ('offset', models.BigIntegerField(default=0)),
+                ('sha256', models.CharField(blank=True, default='', max_length=64)),
+                ('status', models.CharField(choices=[('pending', 'pending'), ('complete', 'complete'), ('attached', 'attached')], default='pending', max_length=10)),
+                ('file', models.FileField(blank=True, upload_to='attachments/%Y/%m/%d')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='uploads', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'ordering': ['created_at'],
+            },
+        ),
+    ]
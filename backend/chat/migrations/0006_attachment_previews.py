@@ -0,0 +1,52 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0005_chunked_upload'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageattachment',
+            name='height',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='messageattachment',
+            name='placeholder',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='messageattachment',
+            name='preview_status',
+            field=models.CharField(choices=[('pending', 'pending'), ('ready', 'ready'), ('failed', 'failed'), ('none', 'none')], db_index=True, default='pending', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='messageattachment',
+            name='width',
+            field=models.PositiveIntegerField(blank=True, null=True),
+        ),
+        migrations.CreateModel(
+            name='AttachmentVariant',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=20)),
+                ('file', models.FileField(upload_to='attachments/variants/%Y/%m/%d')),
+                ('content_type', models.CharField(default='image/jpeg', max_length=100)),
+                ('width', models.PositiveIntegerField()),
+                ('height', models.PositiveIntegerField()),
+                ('size', models.BigIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('attachment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='variants', to='chat.messageattachment')),
+            ],
+            options={
+                'ordering': ['width'],
+                'constraints': [models.UniqueConstraint(fields=('attachment', 'name'), name='chat_variant_attachment_name_uniq')],
+            },
+        ),
+    ]
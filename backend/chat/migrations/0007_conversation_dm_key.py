@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:19
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+
+def backfill_dm_keys(apps, schema_editor):
+    """
+    Give every two-member DM its key. Duplicate DMs between the same pair
+    are merged into the oldest one: messages move over, the rest are deleted.
+    """
+    Conversation = apps.get_model("chat", "Conversation")
+    Message = apps.get_model("chat", "Message")
+    Membership = Conversation.members.through
+    db = schema_editor.connection.alias
+
+    members = defaultdict(list)
+    for conv_id, user_id in (
+        Membership.objects.using(db).filter(conversation__is_group=False)
+        .values_list("conversation_id", "user_id")
+    ):
+        members[conv_id].append(user_id)
+
+    by_key = defaultdict(list)
+    for conv_id, user_ids in members.items():
+        if len(user_ids) == 2:
+            low, high = sorted(user_ids)
+            by_key[f"{low}:{high}"].append(conv_id)
+
+    for key, conv_ids in by_key.items():
+        keep, *duplicates = sorted(conv_ids)
+        if duplicates:
+            Message.objects.using(db).filter(conversation_id__in=duplicates).update(conversation_id=keep)
+            Conversation.objects.using(db).filter(id__in=duplicates).delete()
+            last = Message.objects.using(db).filter(conversation_id=keep).order_by("-id").first()
+            if last is not None:
+                Conversation.objects.using(db).filter(id=keep).update(
+                    last_message=last, last_activity_at=last.created_at
+                )
+        Conversation.objects.using(db).filter(id=keep).update(dm_key=key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_attachment_previews'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='dm_key',
+            field=models.CharField(blank=True, editable=False, max_length=41, null=True, unique=True),
+        ),
+        migrations.RunPython(backfill_dm_keys, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:32
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_conversation_dm_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='members_changed_at',
+            field=models.DateTimeField(db_index=True, default=django.utils.timezone.now),
+        ),
+    ]
@@ -0,0 +1,27 @@
+from django.conf import settings
+from django.db import migrations
+
+from chat import partitions
+
+
+def partition_messages(apps, schema_editor):
+    connection = schema_editor.connection
+    if not settings.CHAT_MESSAGE_PARTITIONING or not partitions.supported(connection):
+        return
+    if not partitions.is_partitioned(connection):
+        partitions.convert(connection)
+    partitions.ensure_partitions(connection)
+
+
+class Migration(migrations.Migration):
+    # Only PostgreSQL is touched; the existing table becomes the first
+    # partition in place, so no rows are copied. Going back leaves the table
+    # partitioned, which the ORM does not notice.
+
+    dependencies = [
+        ('chat', '0008_conversation_members_changed_at'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition_messages, migrations.RunPython.noop),
+    ]
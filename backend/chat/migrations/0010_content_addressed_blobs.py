@@ -0,0 +1,54 @@
+# Generated by Django 5.2.18 on 2026-10-18 10:54
+
+import chat.models
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0009_message_partitioning'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Blob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('file', models.FileField(max_length=200, upload_to=chat.models.blob_path)),
+                ('size', models.BigIntegerField()),
+                ('content_type', models.CharField(blank=True, default='', max_length=100)),
+                ('ref_count', models.PositiveIntegerField(default=0)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('updated_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='messageattachment',
+            name='name',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AlterField(
+            model_name='messageattachment',
+            name='file',
+            field=models.FileField(max_length=200, upload_to='attachments/%Y/%m/%d'),
+        ),
+        migrations.AlterField(
+            model_name='upload',
+            name='file',
+            field=models.FileField(blank=True, max_length=200, upload_to='attachments/%Y/%m/%d'),
+        ),
+        migrations.AddField(
+            model_name='messageattachment',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='attachments', to='chat.blob'),
+        ),
+        migrations.AddField(
+            model_name='upload',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='uploads', to='chat.blob'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:03
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_content_addressed_blobs'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PushOutbox',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipients', models.JSONField(blank=True, null=True)),
+                ('attempts', models.PositiveSmallIntegerField(default=0)),
+                ('available_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True, default='')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='chat.message')),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['available_at'], name='chat_pushoutbox_avail_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2.18 on 2026-10-18 11:34
+
+import django.utils.timezone
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+
+
+def backfill(apps, schema_editor):
+    Conversation = apps.get_model("chat", "Conversation")
+    ReadCursor = apps.get_model("chat", "ReadCursor")
+    db = schema_editor.connection.alias
+    ReadCursor.objects.using(db).update(
+        last_activity_at=Subquery(
+            Conversation.objects.using(db).filter(pk=OuterRef("conversation_id")).values("last_activity_at")[:1]
+        )
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0011_push_outbox'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='readcursor',
+            name='unread_count',
+        ),
+        migrations.AddField(
+            model_name='readcursor',
+            name='last_activity_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(backfill, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='readcursor',
+            index=models.Index(fields=['user', '-last_activity_at', '-conversation'], name='chat_readcursor_inbox_idx'),
+        ),
+    ]
@@ -1,5 +1,9 @@
+import uuid
+
 from django.conf import settings
 from django.db import models
+from django.db.models import Q
+from django.utils import timezone
 
 User = settings.AUTH_USER_MODEL
 
@@ -9,6 +13,15 @@ class Conversation(models.Model):
     is_group = models.BooleanField(default=False)
     members = models.ManyToManyField(User, related_name="conversations", blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
+    # دی‌نرمال برای اینباکس: آخرین پیام و زمان آخرین فعالیت
+    last_message = models.ForeignKey(
+        "Message", null=True, blank=True, on_delete=models.SET_NULL, related_name="+"
+    )
+    last_activity_at = models.DateTimeField(default=timezone.now, db_index=True)
+    # کلید یکتای DM: "<min_user_id>:<max_user_id>"؛ برای گروه‌ها null
+    dm_key = models.CharField(max_length=41, unique=True, null=True, blank=True, editable=False)
+    # زمان آخرین تغییر اعضا؛ sync فقط گفتگوهای تغییرکرده را دوباره می‌فرستد
+    members_changed_at = models.DateTimeField(default=timezone.now, db_index=True)
 
     class Meta:
         ordering = ["-created_at"]
@@ -17,6 +30,29 @@ class Conversation(models.Model):
         base = self.name or f"Conversation {self.pk}"
         return f"{base} ({'group' if self.is_group else 'dm'})"
 
+    @staticmethod
+    def make_dm_key(user_a, user_b):
+        low, high = sorted((int(user_a), int(user_b)))
+        return f"{low}:{high}"
+
+    def register_message(self, message):
+        """
+        Update the denormalized inbox state for a newly created message
+        (or the last of several from the same sender).
+        Must run in the same transaction as the INSERT. Costs the same for
+        any group size: unread counts are derived from the read cursors when
+        the inbox is listed, and only CHAT_INBOX_INLINE_BUMP members' cursors
+        move up here; the push worker bumps the rest.
+        """
+        # شرط id مانع می‌شود ارسال همزمان، last_message را به عقب برگرداند
+        Conversation.objects.filter(pk=self.pk).filter(
+            Q(last_message__isnull=True) | Q(last_message_id__lt=message.id)
+        ).update(last_message=message, last_activity_at=message.created_at)
+        ReadCursor.objects.filter(conversation=self, user_id=message.sender_id).update(
+            last_read_message_id=message.id, last_activity_at=message.created_at
+        )
+        ReadCursor.bump_activity(self.pk, message.created_at, limit=settings.CHAT_INBOX_INLINE_BUMP)
+
 
 class Message(models.Model):
     conversation = models.ForeignKey(
@@ -39,17 +75,189 @@ class Message(models.Model):
         return f"Msg#{self.pk} by {self.sender_id} in Conv#{self.conversation_id}"
 
 
+def blob_path(instance, filename):
+    return f"blobs/{instance.sha256[:2]}/{instance.sha256[2:4]}/{instance.sha256}"
+
+
+class Blob(models.Model):
+    """
+    A stored file addressed by the SHA-256 of its content. Attachments and
+    completed uploads point at a blob instead of owning a copy, so content
+    that is forwarded or shared again is stored once. ``ref_count`` is the
+    number of attachments using it; ``collect_blobs`` deletes unused blobs.
+    """
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    file = models.FileField(upload_to=blob_path, max_length=200)
+    size = models.BigIntegerField()
+    content_type = models.CharField(max_length=100, blank=True, default="")
+    ref_count = models.PositiveIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # آخرین تغییر ref_count؛ GC فقط blobهایی را که مدتی بی‌استفاده مانده‌اند پاک می‌کند
+    updated_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"Blob {self.sha256[:12]} x{self.ref_count}"
+
+
 class MessageAttachment(models.Model):
+    PREVIEW_PENDING = "pending"
+    PREVIEW_READY = "ready"
+    PREVIEW_FAILED = "failed"
+    PREVIEW_NONE = "none"  # not an image
+    PREVIEW_CHOICES = [
+        (PREVIEW_PENDING, "pending"),
+        (PREVIEW_READY, "ready"),
+        (PREVIEW_FAILED, "failed"),
+        (PREVIEW_NONE, "none"),
+    ]
+
     message = models.ForeignKey(
         Message, related_name="attachments", on_delete=models.CASCADE
     )
-    file = models.FileField(upload_to="attachments/%Y/%m/%d")
+    file = models.FileField(upload_to="attachments/%Y/%m/%d", max_length=200)
+    # محتوای فایل (file همان مسیر blob است)؛ پیوست‌های قدیمی تا dedupe_attachments خالی‌اند
+    blob = models.ForeignKey(
+        Blob, null=True, blank=True, on_delete=models.PROTECT, related_name="attachments"
+    )
+    name = models.CharField(max_length=255, blank=True, default="")  # نام اصلی فایل
     content_type = models.CharField(max_length=100, blank=True, default="")  # ← 100
-    size = models.IntegerField(default=0)                                    # ← integer
+    size = models.BigIntegerField(default=0)                                 # ← bigint (>2GB)
     uploaded_at = models.DateTimeField(auto_now_add=True)                    # ← نام درست
+    # پیش‌نمایش تصویر (در پس‌زمینه پر می‌شود)
+    width = models.PositiveIntegerField(null=True, blank=True)
+    height = models.PositiveIntegerField(null=True, blank=True)
+    placeholder = models.TextField(blank=True, default="")  # data URI خیلی کوچک برای blur
+    preview_status = models.CharField(
+        max_length=10, choices=PREVIEW_CHOICES, default=PREVIEW_PENDING, db_index=True
+    )
 
     class Meta:
         ordering = ["id"]
 
     def __str__(self):
         return f"Attachment#{self.pk} of Msg#{self.message_id}"
+
+
+class AttachmentVariant(models.Model):
+    """A resized rendition of an image attachment (e.g. ``thumb``, ``medium``)."""
+
+    attachment = models.ForeignKey(
+        MessageAttachment, related_name="variants", on_delete=models.CASCADE
+    )
+    name = models.CharField(max_length=20)
+    file = models.FileField(upload_to="attachments/variants/%Y/%m/%d")
+    content_type = models.CharField(max_length=100, default="image/jpeg")
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+    size = models.BigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["width"]
+        constraints = [
+            models.UniqueConstraint(
+                fields=["attachment", "name"], name="chat_variant_attachment_name_uniq"
+            ),
+        ]
+
+    def __str__(self):
+        return f"Variant {self.name} of Attachment#{self.attachment_id}"
+
+
+class ReadCursor(models.Model):
+    """
+    Per-member read position, and the conversation's place in that member's
+    inbox (``last_activity_at``, copied from the conversation so the inbox
+    is one index range scan per user).
+    """
+
+    conversation = models.ForeignKey(
+        Conversation, on_delete=models.CASCADE, related_name="read_cursors"
+    )
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="read_cursors")
+    last_read_message_id = models.BigIntegerField(default=0)
+    last_activity_at = models.DateTimeField(default=timezone.now)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["conversation", "user"], name="chat_readcursor_conv_user_uniq"
+            ),
+        ]
+        indexes = [
+            models.Index(
+                fields=["user", "-last_activity_at", "-conversation"], name="chat_readcursor_inbox_idx"
+            ),
+        ]
+
+    def __str__(self):
+        return f"ReadCursor user#{self.user_id} conv#{self.conversation_id} @{self.last_read_message_id}"
+
+    @staticmethod
+    def bump_activity(conversation_id, at, limit=None):
+        """Move the conversation up to ``at`` in its members' inboxes, for at most ``limit`` of them."""
+        stale = ReadCursor.objects.filter(conversation_id=conversation_id, last_activity_at__lt=at)
+        if limit is not None:
+            stale = ReadCursor.objects.filter(pk__in=stale.order_by().values("pk")[:limit])
+        return stale.update(last_activity_at=at)
+
+
+class Upload(models.Model):
+    """
+    A chunked, resumable upload. Chunks are appended to a partial file on
+    local disk; ``complete`` verifies the hash and moves it into storage,
+    after which it can be attached to a message once.
+    """
+
+    PENDING = "pending"
+    COMPLETE = "complete"
+    ATTACHED = "attached"
+    STATUS_CHOICES = [(PENDING, "pending"), (COMPLETE, "complete"), (ATTACHED, "attached")]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name="uploads")
+    filename = models.CharField(max_length=255)
+    content_type = models.CharField(max_length=100, blank=True, default="")
+    size = models.BigIntegerField()
+    offset = models.BigIntegerField(default=0)
+    sha256 = models.CharField(max_length=64, blank=True, default="")
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=PENDING)
+    file = models.FileField(upload_to="attachments/%Y/%m/%d", blank=True, max_length=200)
+    blob = models.ForeignKey(
+        Blob, null=True, blank=True, on_delete=models.SET_NULL, related_name="uploads"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ["created_at"]
+
+    def __str__(self):
+        return f"Upload {self.pk} ({self.offset}/{self.size}, {self.status})"
+
+
+class PushOutbox(models.Model):
+    """
+    A message whose push notifications are still owed. Written in the send
+    transaction (one row, whatever the group size) and drained by the
+    ``send_push_notifications`` worker, which deletes the row once every
+    recipient has been handed to the notifier. ``recipients`` is null until
+    a delivery partly fails; then it holds the ids still to retry.
+    ``available_at`` is both the retry time and the claim lease.
+    """
+
+    message = models.ForeignKey(Message, on_delete=models.CASCADE, related_name="+")
+    recipients = models.JSONField(null=True, blank=True)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        ordering = ["id"]
+        indexes = [models.Index(fields=["available_at"], name="chat_pushoutbox_avail_idx")]
+
+    def __str__(self):
+        return f"PushOutbox Msg#{self.message_id} (attempt {self.attempts})"
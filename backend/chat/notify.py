@@ -0,0 +1,243 @@
+import asyncio
+import logging
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+# Wakes long-poll requests when a conversation gets a new message, so a
+# waiting client costs no queries until there is something to fetch. A
+# waiting request registers a Waiter; sync requests block on a
+# threading.Event, async ones await an asyncio.Event on their own loop, so
+# an idle async long-poll holds no thread at all.
+
+
+class Waiter:
+    """One waiting request: ``after`` is {conversation id: last seen id}."""
+
+    def __init__(self, after, loop=None):
+        self.after = after
+        self.news = set()
+        self.loop = loop
+        self.event = asyncio.Event() if loop else threading.Event()
+
+    def offer(self, conversation_id, message_id):
+        """Called from any thread when ``conversation_id`` got ``message_id``."""
+        if message_id <= self.after.get(conversation_id, message_id):
+            return
+        self.news.add(conversation_id)
+        if self.loop is None:
+            self.event.set()
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.event.set)
+        except RuntimeError:  # the loop is gone; so is the request
+            pass
+
+
+class BaseNotifier:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waiters = {}  # conversation id -> set of Waiters
+
+    def add_waiter(self, waiter):
+        """Register ``waiter``; returns the conversations nobody was waiting on yet."""
+        new = []
+        for conversation_id in waiter.after:
+            if conversation_id not in self.waiters:
+                new.append(conversation_id)
+            self.waiters.setdefault(conversation_id, set()).add(waiter)
+        return new
+
+    def remove_waiter(self, waiter):
+        with self.lock:
+            for conversation_id in waiter.after:
+                waiting = self.waiters.get(conversation_id)
+                if waiting is not None:
+                    waiting.discard(waiter)
+                    if not waiting:
+                        del self.waiters[conversation_id]
+                        self.forget(conversation_id)
+
+    def forget(self, conversation_id):
+        """Nobody in this process waits on ``conversation_id`` anymore."""
+
+    def dispatch(self, conversation_id, message_id):
+        with self.lock:
+            waiting = list(self.waiters.get(conversation_id, ()))
+        for waiter in waiting:
+            waiter.offer(conversation_id, message_id)
+
+    def prepare(self, waiter):
+        """Register ``waiter``, then mark what is already newer than it has seen."""
+        raise NotImplementedError
+
+    def wait(self, after, timeout):
+        waiter = Waiter(after)
+        self.prepare(waiter)
+        try:
+            if not waiter.news:
+                waiter.event.wait(timeout)
+            return sorted(waiter.news)
+        finally:
+            self.remove_waiter(waiter)
+
+    async def aprepare(self, waiter):
+        self.prepare(waiter)
+
+    async def await_news(self, after, timeout):
+        waiter = Waiter(after, asyncio.get_running_loop())
+        await self.aprepare(waiter)
+        try:
+            if not waiter.news:
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return sorted(waiter.news)
+        finally:
+            self.remove_waiter(waiter)
+
+
+class LocalNotifier(BaseNotifier):
+    """In-process: only requests served by the same worker are woken."""
+
+    def __init__(self):
+        super().__init__()
+        self.latest = {}
+
+    def notify(self, conversation_id, message_id):
+        with self.lock:
+            if message_id > self.latest.get(conversation_id, 0):
+                self.latest[conversation_id] = message_id
+        self.dispatch(conversation_id, message_id)
+
+    def prepare(self, waiter):
+        with self.lock:
+            self.add_waiter(waiter)
+            latest = {c: self.latest.get(c, 0) for c in waiter.after}
+        for conversation_id, message_id in latest.items():
+            waiter.offer(conversation_id, message_id)
+
+
+class RedisNotifier(BaseNotifier):
+    """
+    Shared across workers: the newest id per conversation is kept in a key
+    (so a notify that lands between the client's query and its subscribe is
+    not lost) and announced on a pub/sub channel. Each process has one
+    pub/sub connection, read by a listener thread that wakes the local
+    waiters; a conversation is subscribed while anyone here waits on it.
+    """
+
+    def __init__(self, url):
+        import redis
+
+        super().__init__()
+        self.redis = redis.Redis.from_url(url)
+        self.pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        # the connection is not thread-safe; the listener releases it between short reads
+        self.pubsub_lock = threading.Lock()
+        self.idle = set()
+        self.listener = None
+
+    @staticmethod
+    def key(conversation_id):
+        return f"chat:latest:{conversation_id}"
+
+    @staticmethod
+    def channel(conversation_id):
+        return f"chat:notify:{conversation_id}"
+
+    def notify(self, conversation_id, message_id):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set(self.key(conversation_id), message_id, ex=settings.CHAT_LONGPOLL_MAX_WAIT * 4)
+        pipe.publish(self.channel(conversation_id), message_id)
+        pipe.execute()
+
+    def prepare(self, waiter):
+        with self.lock:
+            new = self.add_waiter(waiter)
+            self.idle.difference_update(new)
+            if new:
+                # subscribed before the check below, so nothing published after it is missed
+                with self.pubsub_lock:
+                    self.pubsub.subscribe(*[self.channel(c) for c in new])
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, name="chat-notify", daemon=True)
+                self.listener.start()
+        conversation_ids = list(waiter.after)
+        values = self.redis.mget([self.key(c) for c in conversation_ids])
+        for conversation_id, value in zip(conversation_ids, values):
+            if value is not None:
+                waiter.offer(conversation_id, int(value))
+
+    async def aprepare(self, waiter):
+        # a few milliseconds of network I/O; the wait itself holds no thread
+        await sync_to_async(self.prepare, thread_sensitive=False)(waiter)
+
+    def forget(self, conversation_id):
+        # called under self.lock; the listener unsubscribes between reads
+        self.idle.add(conversation_id)
+
+    def listen(self):
+        while True:
+            try:
+                with self.pubsub_lock:
+                    message = self.pubsub.get_message(timeout=0.05)
+                if message is not None and message["type"] == "message":
+                    conversation_id = int(message["channel"].rsplit(b":", 1)[1])
+                    self.dispatch(conversation_id, int(message["data"]))
+                if self.idle:
+                    self.unsubscribe_idle()
+            except Exception:
+                # redis-py reconnects and resubscribes on the next read
+                logger.exception("long-poll listener failed; retrying")
+                time.sleep(1)
+
+    def unsubscribe_idle(self):
+        with self.lock:
+            idle = [c for c in self.idle if c not in self.waiters]
+            self.idle.clear()
+            if idle:
+                with self.pubsub_lock:
+                    self.pubsub.unsubscribe(*[self.channel(c) for c in idle])
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def get_notifier():
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            if settings.CHAT_NOTIFIER == "redis":
+                _notifier = RedisNotifier(settings.REDIS_URL)
+            else:
+                _notifier = LocalNotifier()
+    return _notifier
+
+
+def notify_message(conversation_id, message_id):
+    get_notifier().notify(conversation_id, message_id)
+
+
+def wait_for_messages(after, timeout):
+    """
+    Block until one of the conversations in ``after`` ({conversation_id:
+    last_seen_id}) has a newer message, or ``timeout`` seconds pass.
+    Returns the conversation ids that have news.
+    """
+    if not after or timeout <= 0:
+        return []
+    return get_notifier().wait(after, timeout)
+
+
+async def await_messages(after, timeout):
+    """``wait_for_messages`` for async views: awaits without holding a thread."""
+    if not after or timeout <= 0:
+        return []
+    return await get_notifier().await_news(after, timeout)
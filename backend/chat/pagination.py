@@ -0,0 +1,173 @@
+from base64 import b64decode, b64encode
+from collections import OrderedDict
+
+from django.db.models import Q
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, CursorPagination, _positive_int
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+
+class MessageCursorPagination(BasePagination):
+    """
+    Keyset pagination on ``id`` for a single conversation's messages.
+
+    Filters are always ``conversation_id = X AND id > / < cursor`` so the
+    (conversation, id) index serves both the lookup and the ordering — no
+    ``COUNT(*)`` and no ``OFFSET`` scans however far back the client scrolls.
+
+    Without a cursor the newest page is returned. ``previous`` walks towards
+    older messages, ``next`` towards newer ones. Results are always in
+    ascending id order. Raw ``before_id`` / ``after_id`` are accepted too.
+    """
+
+    default_limit = 50
+    max_limit = 200
+    limit_query_param = "limit"
+    cursor_query_param = "cursor"
+    invalid_cursor_message = "Invalid cursor"
+
+    def paginate_queryset(self, queryset, request, view=None):
+        return self.finish_page(list(self.page_queryset(queryset, request)))
+
+    async def apaginate_queryset(self, queryset, request, view=None):
+        """Same as ``paginate_queryset`` but fetches the page with the async ORM."""
+        return self.finish_page([row async for row in self.page_queryset(queryset, request)])
+
+    def page_queryset(self, queryset, request):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        self.limit = self.get_limit(request)
+        self.direction, self.position = self.decode_cursor(request)
+
+        if self.direction == "after":
+            return queryset.filter(id__gt=self.position).order_by("id")[: self.limit + 1]
+        if self.direction == "before":
+            queryset = queryset.filter(id__lt=self.position)
+        return queryset.order_by("-id")[: self.limit + 1]
+
+    def finish_page(self, rows):
+        has_more = len(rows) > self.limit
+        rows = rows[: self.limit]
+        if self.direction == "after":
+            self.next_position = ("after", rows[-1].id) if has_more else None
+            self.previous_position = ("before", rows[0].id) if rows else None
+        else:
+            rows = rows[::-1]
+            self.previous_position = ("before", rows[0].id) if has_more else None
+            self.next_position = (
+                ("after", rows[-1].id) if rows and self.direction == "before" else None
+            )
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ("next", self.get_next_link()),
+            ("previous", self.get_previous_link()),
+            ("results", data),
+        ]))
+
+    def get_paginated_response_schema(self, schema):
+        return {
+            "type": "object",
+            "required": ["results"],
+            "properties": {
+                "next": {"type": "string", "nullable": True, "format": "uri"},
+                "previous": {"type": "string", "nullable": True, "format": "uri"},
+                "results": schema,
+            },
+        }
+
+    def get_limit(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.limit_query_param],
+                strict=True,
+                cutoff=self.max_limit,
+            )
+        except (KeyError, ValueError):
+            return self.default_limit
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        try:
+            if encoded:
+                direction, _, position = b64decode(encoded.encode("ascii")).decode("ascii").partition(":")
+                if direction not in ("before", "after"):
+                    raise ValueError
+                return direction, int(position)
+            for direction in ("after", "before"):
+                raw = request.query_params.get(f"{direction}_id")
+                if raw not in (None, ""):
+                    return direction, int(raw)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+        return None, None
+
+    def encode_cursor(self, position):
+        direction, pk = position
+        encoded = b64encode(f"{direction}:{pk}".encode("ascii")).decode("ascii")
+        url = self.base_url
+        for param in ("before_id", "after_id"):
+            url = remove_query_param(url, param)
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        return self.encode_cursor(self.next_position) if self.next_position else None
+
+    def get_previous_link(self):
+        return self.encode_cursor(self.previous_position) if self.previous_position else None
+
+
+class InboxCursorPagination(CursorPagination):
+    """
+    Conversations by last activity as seen by the member (their ReadCursor);
+    ``id`` keeps equal timestamps in a stable order.
+    """
+
+    ordering = ("-inbox_activity_at", "-id")
+    page_size = 30
+    page_size_query_param = "limit"
+    max_page_size = 100
+
+
+class MessageSearchPagination(MessageCursorPagination):
+    """
+    Keyset pagination over ``(rank, id)`` for search results, best match first.
+    Only a forward ``next`` link is produced.
+    """
+
+    default_limit = 20
+    max_limit = 100
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.base_url = request.build_absolute_uri()
+        limit = self.get_limit(request)
+        position = self.decode_cursor(request)
+
+        if position is not None:
+            rank, pk = position
+            queryset = queryset.filter(Q(rank__lt=rank) | Q(rank=rank, id__lt=pk))
+        rows = list(queryset.order_by("-rank", "-id")[: limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        self.next_position = (rows[-1].rank, rows[-1].id) if has_more else None
+        self.previous_position = None
+        return rows
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            rank, _, pk = b64decode(encoded.encode("ascii")).decode("ascii").partition(":")
+            return float(rank), int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position):
+        rank, pk = position
+        encoded = b64encode(f"{rank!r}:{pk}".encode("ascii")).decode("ascii")
+        return replace_query_param(self.base_url, self.cursor_query_param, encoded)
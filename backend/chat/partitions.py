@@ -0,0 +1,234 @@
+"""
+Range partitioning of ``chat_message`` by id on PostgreSQL.
+
+Partitions cover fixed id ranges (``CHAT_MESSAGE_PARTITION_SIZE``) rather than
+created_at ranges: ids grow with time anyway, keyset pagination already
+filters on id so history reads prune to the partitions they touch, and the
+primary key stays ``(id)``, which the foreign keys from attachments and
+``Conversation.last_message`` need. Cold partitions are archived in place
+(moved to a tablespace on compressed storage, rewritten in conversation
+order and frozen), so they stay attached and readable through the ORM.
+
+On other backends the table stays a plain table and everything here is a
+no-op.
+"""
+import re
+from collections import namedtuple
+
+from django.conf import settings
+
+TABLE = "chat_message"
+ARCHIVED = "archived"
+
+Partition = namedtuple("Partition", "name start end tablespace archived")
+
+_BOUND = re.compile(r"FROM \((.+?)\) TO \((.+?)\)")
+
+
+def supported(connection):
+    return connection.vendor == "postgresql"
+
+
+def is_partitioned(connection):
+    if not supported(connection):
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass(%s)", [TABLE])
+        return cursor.fetchone() is not None
+
+
+def partition_name(start):
+    return f"{TABLE}_p{start}"
+
+
+def _bound(value):
+    value = value.strip("'")
+    return None if value in ("MINVALUE", "MAXVALUE") else int(value)
+
+
+def list_partitions(connection):
+    """Partitions of ``chat_message`` ordered by id range."""
+    if not is_partitioned(connection):
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname, pg_get_expr(c.relpartbound, c.oid),
+                   COALESCE(t.spcname, ''), COALESCE(obj_description(c.oid, 'pg_class'), '')
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            LEFT JOIN pg_tablespace t ON t.oid = c.reltablespace
+            WHERE i.inhparent = to_regclass(%s)
+            """,
+            [TABLE],
+        )
+        rows = cursor.fetchall()
+    result = []
+    for name, bound, tablespace, comment in rows:
+        match = _BOUND.search(bound)
+        if match is None:  # DEFAULT partition
+            continue
+        result.append(
+            Partition(name, _bound(match.group(1)), _bound(match.group(2)), tablespace,
+                      comment.startswith(ARCHIVED))
+        )
+    result.sort(key=lambda p: -1 if p.start is None else p.start)
+    return result
+
+
+def last_message_id(connection):
+    """Last id handed out by the id sequence (0 on a fresh table)."""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+        sequence = cursor.fetchone()[0]
+        cursor.execute(f"SELECT last_value, is_called FROM {sequence}")
+        value, called = cursor.fetchone()
+    return value if called else value - 1
+
+
+def convert(connection, size=None):
+    """
+    Turn the plain ``chat_message`` table into a partitioned one without
+    copying rows: the existing table becomes the first partition (ids up to
+    the next multiple of ``size``), its indexes are re-created on the parent
+    and matched rather than rebuilt, and foreign keys pointing at it are
+    re-pointed to the parent. Attaching and re-validating the foreign keys
+    scan the tables once. Run inside a transaction.
+    """
+    size = size or settings.CHAT_MESSAGE_PARTITION_SIZE
+    legacy = partition_name(0)
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {TABLE}")
+        max_id = cursor.fetchone()[0]
+        boundary = (max_id // size + 1) * size
+
+        # everything that has to be re-created on the parent, read before the rename
+        cursor.execute(
+            """
+            SELECT i.relname, pg_get_indexdef(i.oid), x.indisprimary
+            FROM pg_index x JOIN pg_class i ON i.oid = x.indexrelid
+            WHERE x.indrelid = to_regclass(%s)
+            """,
+            [TABLE],
+        )
+        indexes = cursor.fetchall()
+        cursor.execute(
+            """
+            SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE contype = 'f' AND conrelid = to_regclass(%s)
+            """,
+            [TABLE],
+        )
+        outgoing = cursor.fetchall()
+        cursor.execute(
+            """
+            SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint
+            WHERE contype = 'f' AND confrelid = to_regclass(%s) AND conrelid <> confrelid
+            """,
+            [TABLE],
+        )
+        incoming = cursor.fetchall()
+
+        cursor.execute(f"ALTER TABLE {TABLE} RENAME TO {legacy}")
+        for name, _, _ in indexes:
+            cursor.execute(f"ALTER INDEX {name} RENAME TO {name[:59]}_p0")
+        cursor.execute(f"ALTER TABLE {legacy} ALTER COLUMN id DROP IDENTITY IF EXISTS")
+        cursor.execute(f"ALTER TABLE {legacy} ALTER COLUMN id DROP DEFAULT")
+        cursor.execute(f"DROP SEQUENCE IF EXISTS {TABLE}_id_seq")
+
+        cursor.execute(
+            f"CREATE TABLE {TABLE} (LIKE {legacy} INCLUDING DEFAULTS INCLUDING CONSTRAINTS "
+            "INCLUDING STORAGE INCLUDING COMPRESSION) PARTITION BY RANGE (id)"
+        )
+        cursor.execute(f"CREATE SEQUENCE {TABLE}_id_seq OWNED BY {TABLE}.id")
+        cursor.execute(f"SELECT setval('{TABLE}_id_seq', %s, false)", [max_id + 1])
+        cursor.execute(f"ALTER TABLE {TABLE} ALTER COLUMN id SET DEFAULT nextval('{TABLE}_id_seq')")
+        for name, definition, primary in indexes:
+            if primary:
+                cursor.execute(f"ALTER TABLE {TABLE} ADD CONSTRAINT {name} PRIMARY KEY (id)")
+            else:
+                cursor.execute(definition)
+        for name, definition in outgoing:
+            cursor.execute(f"ALTER TABLE {TABLE} ADD CONSTRAINT {name} {definition}")
+
+        # matching indexes and foreign keys of the old table are attached, not rebuilt
+        cursor.execute(f"ALTER TABLE {TABLE} ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ({boundary})")
+        for table, name, definition in incoming:
+            cursor.execute(f"ALTER TABLE {table} DROP CONSTRAINT {name}")
+            cursor.execute(f"ALTER TABLE {table} ADD CONSTRAINT {name} {definition}")
+
+
+def ensure_partitions(connection, ahead=None, size=None):
+    """
+    Create the partitions for the next ``ahead`` id ranges past the one
+    currently being written, so inserts never run out of room. Returns the
+    names of the partitions created.
+    """
+    if not is_partitioned(connection):
+        return []
+    ahead = settings.CHAT_MESSAGE_PARTITIONS_AHEAD if ahead is None else ahead
+    size = size or settings.CHAT_MESSAGE_PARTITION_SIZE
+    top = max(p.end for p in list_partitions(connection) if p.end is not None)
+    target = (last_message_id(connection) // size + 1 + ahead) * size
+    created = []
+    with connection.cursor() as cursor:
+        while top < target:
+            name = partition_name(top)
+            cursor.execute(f"CREATE TABLE {name} PARTITION OF {TABLE} FOR VALUES FROM ({top}) TO ({top + size})")
+            created.append(name)
+            top += size
+    return created
+
+
+def cold_partitions(connection, before):
+    """
+    Unarchived partitions that are full (the id sequence is past them) and
+    whose newest message is older than ``before``.
+    """
+    if not is_partitioned(connection):
+        return []
+    last_id = last_message_id(connection)
+    cold = []
+    with connection.cursor() as cursor:
+        for partition in list_partitions(connection):
+            if partition.archived or partition.end is None or partition.end > last_id + 1:
+                continue
+            # newest row through the primary key, not a scan for MAX(created_at)
+            cursor.execute(f"SELECT created_at FROM {partition.name} ORDER BY id DESC LIMIT 1")
+            row = cursor.fetchone()
+            if row is None or row[0] < before:
+                cold.append(partition)
+    return cold
+
+
+def archive_partition(connection, partition, tablespace=""):
+    """
+    Move a cold partition (and its indexes) to ``tablespace`` - typically one
+    on a compressed volume - then rewrite it in (conversation, id) order so a
+    conversation's old history sits on few pages, freeze it so vacuum can skip
+    it from now on, and mark it archived. The partition stays attached: reads
+    go through ``chat_message`` as before. Must run outside a transaction
+    (VACUUM), and takes an exclusive lock on the partition while it runs.
+    """
+    name = partition.name
+    with connection.cursor() as cursor:
+        cursor.execute(
+            """
+            SELECT c.relname, p.relname FROM pg_index x
+            JOIN pg_class c ON c.oid = x.indexrelid
+            LEFT JOIN pg_inherits i ON i.inhrelid = x.indexrelid
+            LEFT JOIN pg_class p ON p.oid = i.inhparent
+            WHERE x.indrelid = to_regclass(%s)
+            """,
+            [name],
+        )
+        indexes = cursor.fetchall()
+        if tablespace:
+            cursor.execute(f"ALTER TABLE {name} SET TABLESPACE {connection.ops.quote_name(tablespace)}")
+            for index, _ in indexes:
+                cursor.execute(f"ALTER INDEX {index} SET TABLESPACE {connection.ops.quote_name(tablespace)}")
+        order = next((index for index, parent in indexes if parent == "chat_msg_conv_id_idx"), None)
+        if order:
+            cursor.execute(f"CLUSTER {name} USING {order}")
+        cursor.execute(f"VACUUM (FREEZE, ANALYZE) {name}")
+        cursor.execute(f"COMMENT ON TABLE {name} IS %s", [f"{ARCHIVED} {tablespace}".strip()])
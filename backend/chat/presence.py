@@ -0,0 +1,254 @@
+import threading
+import time
+
+from django.conf import settings
+
+# Ephemeral online / typing state. Lives only in the presence store (process
+# memory or Redis) with TTLs; nothing here reads or writes the database.
+# A user is online while at least one of their connections (socket or HTTP
+# client) has heart-beaten within CHAT_PRESENCE_TTL seconds. A user whose
+# last connection just stops heart-beating is picked up by ``sweep`` (run
+# by the expire_presence command), so contacts hear "offline" without an
+# explicit disconnect.
+
+LAST_SEEN_TTL = 30 * 24 * 3600
+
+
+class LocalPresenceStore:
+    """In-process: fine for development and single-worker deployments."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = {}  # user_id -> {connection_id: expires_at}
+        self.last_seen = {}  # user_id -> unix time
+        self.online = set()  # users announced online and not yet announced offline
+        self.keys = {}  # key -> [value, expires_at]
+
+    def _alive(self, user_id, now):
+        connections = self.connections.get(user_id)
+        if not connections:
+            return False
+        for connection_id in [c for c, expires in connections.items() if expires <= now]:
+            del connections[connection_id]
+        if not connections:
+            del self.connections[user_id]
+        return bool(connections)
+
+    def touch(self, user_id, connection_id, ttl):
+        now = time.time()
+        with self.lock:
+            was_online = self._alive(user_id, now)
+            self.connections.setdefault(user_id, {})[connection_id] = now + ttl
+            self.last_seen[user_id] = now
+            self.online.add(user_id)
+        return not was_online
+
+    def leave(self, user_id, connection_id):
+        now = time.time()
+        with self.lock:
+            self.connections.get(user_id, {}).pop(connection_id, None)
+            self.last_seen[user_id] = now
+            if self._alive(user_id, now) or user_id not in self.online:
+                return False
+            self.online.discard(user_id)
+            return True
+
+    def sweep(self, limit):
+        now = time.time()
+        with self.lock:
+            gone = [u for u in self.online if not self._alive(u, now)][:limit]
+            self.online.difference_update(gone)
+        return gone
+
+    def lookup(self, user_ids):
+        now = time.time()
+        with self.lock:
+            return {u: (self._alive(u, now), self.last_seen.get(u)) for u in user_ids}
+
+    def _live_key(self, key, now):
+        entry = self.keys.get(key)
+        if entry is not None and entry[1] <= now:
+            del self.keys[key]
+            entry = None
+        return entry
+
+    def claim(self, key, ttl):
+        now = time.time()
+        with self.lock:
+            if len(self.keys) > 10000:
+                for stale in [k for k, (_, expires) in self.keys.items() if expires <= now]:
+                    del self.keys[stale]
+            if self._live_key(key, now) is not None:
+                return False
+            self.keys[key] = [1, now + ttl]
+            return True
+
+    def release(self, key):
+        with self.lock:
+            self.keys.pop(key, None)
+
+    def hit(self, key, window):
+        now = time.time()
+        with self.lock:
+            entry = self._live_key(key, now)
+            if entry is None:
+                entry = self.keys[key] = [0, now + window]
+            entry[0] += 1
+            return entry[0]
+
+
+# KEYS[1] the user's connections, KEYS[2] the online index; ARGV now, user id.
+# Takes the user off the index once no connection is live (1 if this call
+# did, so exactly one caller announces it), else re-scores them by their
+# latest expiry.
+SETTLE_SCRIPT = """
+if redis.call('ZCOUNT', KEYS[1], '(' .. ARGV[1], '+inf') > 0 then
+  local last = redis.call('ZRANGE', KEYS[1], -1, -1, 'WITHSCORES')
+  redis.call('ZADD', KEYS[2], last[2], ARGV[2])
+  return 0
+end
+return redis.call('ZREM', KEYS[2], ARGV[2])
+"""
+
+
+class RedisPresenceStore:
+    """
+    Shared across workers. Each user's live connections are a sorted set
+    scored by expiry, so a connection that stops heart-beating drops out on
+    its own and several devices don't turn each other offline. Online users
+    are also indexed by their latest expiry, which is what ``sweep`` scans.
+    """
+
+    online_key = "presence:online"
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.settle_script = self.redis.register_script(SETTLE_SCRIPT)
+
+    @staticmethod
+    def key(user_id):
+        return f"presence:{user_id}"
+
+    @staticmethod
+    def seen_key(user_id):
+        return f"presence:seen:{user_id}"
+
+    def touch(self, user_id, connection_id, ttl):
+        now = time.time()
+        key = self.key(user_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.zcard(key)
+        pipe.zadd(key, {connection_id: now + ttl})
+        pipe.expire(key, int(ttl) + 1)
+        pipe.set(self.seen_key(user_id), now, ex=LAST_SEEN_TTL)
+        pipe.zadd(self.online_key, {user_id: now + ttl}, gt=True)
+        _, live, *_ = pipe.execute()
+        return live == 0
+
+    def leave(self, user_id, connection_id):
+        now = time.time()
+        key = self.key(user_id)
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.zrem(key, connection_id)
+        pipe.zremrangebyscore(key, "-inf", now)
+        pipe.zcard(key)
+        pipe.set(self.seen_key(user_id), now, ex=LAST_SEEN_TTL)
+        pipe.execute()
+        return self.settle(user_id, now)
+
+    def settle(self, user_id, now):
+        return bool(self.settle_script(keys=[self.key(user_id), self.online_key], args=[now, user_id]))
+
+    def sweep(self, limit):
+        now = time.time()
+        due = self.redis.zrangebyscore(self.online_key, "-inf", now, start=0, num=limit)
+        return [int(u) for u in due if self.settle(int(u), now)]
+
+    def lookup(self, user_ids):
+        user_ids = list(user_ids)
+        if not user_ids:
+            return {}
+        now = time.time()
+        pipe = self.redis.pipeline(transaction=False)
+        for user_id in user_ids:
+            pipe.zcount(self.key(user_id), f"({now}", "+inf")
+        live = pipe.execute()
+        seen = self.redis.mget([self.seen_key(u) for u in user_ids])
+        return {
+            u: (count > 0, float(last) if last is not None else None)
+            for u, count, last in zip(user_ids, live, seen)
+        }
+
+    def claim(self, key, ttl):
+        return bool(self.redis.set(f"presence:{key}", 1, nx=True, px=int(ttl * 1000)))
+
+    def release(self, key):
+        self.redis.delete(f"presence:{key}")
+
+    def hit(self, key, window):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.incr(f"presence:{key}")
+        pipe.expire(f"presence:{key}", int(window), nx=True)
+        return pipe.execute()[0]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_presence_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            if settings.CHAT_PRESENCE_STORE == "redis":
+                _store = RedisPresenceStore(settings.REDIS_URL)
+            else:
+                _store = LocalPresenceStore()
+    return _store
+
+
+def heartbeat(user_id, connection_id):
+    """Mark a connection alive for CHAT_PRESENCE_TTL; True if the user just came online."""
+    return get_presence_store().touch(user_id, connection_id, settings.CHAT_PRESENCE_TTL)
+
+
+def disconnect(user_id, connection_id):
+    """Drop a connection; True if the user has no live connection left."""
+    return get_presence_store().leave(user_id, connection_id)
+
+
+def sweep(limit=1000):
+    """
+    Users whose last connection expired without a disconnect, each returned
+    once (across workers with the redis store) so they can be announced offline.
+    """
+    return get_presence_store().sweep(limit)
+
+
+def presence_of(user_ids):
+    """``{user_id: {"online": bool, "last_seen": unix time or None}}`` in one round trip."""
+    return {
+        user_id: {"online": online, "last_seen": last_seen}
+        for user_id, (online, last_seen) in get_presence_store().lookup(user_ids).items()
+    }
+
+
+def allow_typing(user_id, conversation_id, typing=True):
+    """
+    Whether a typing event should be fanned out. While typing, at most one
+    event per CHAT_TYPING_COALESCE seconds per conversation goes out (the
+    client keeps sending, members keep the indicator up for CHAT_TYPING_TTL);
+    a stop always goes out and re-opens the window. Every user is capped at
+    CHAT_TYPING_RATE events per minute across conversations.
+    """
+    store = get_presence_store()
+    key = f"typing:{conversation_id}:{user_id}"
+    if typing:
+        if not store.claim(key, settings.CHAT_TYPING_COALESCE):
+            return False
+    else:
+        store.release(key)
+    return store.hit(f"typing-rate:{user_id}", 60) <= settings.CHAT_TYPING_RATE
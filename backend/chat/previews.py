@@ -0,0 +1,163 @@
+import base64
+import logging
+import mimetypes
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageFilter, ImageOps, UnidentifiedImageError
+
+from core.db_router import use_primary
+
+from .models import AttachmentVariant, MessageAttachment
+
+logger = logging.getLogger(__name__)
+
+PLACEHOLDER_EDGE = 16
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.ATTACHMENT_PREVIEW_WORKERS,
+                thread_name_prefix="previews",
+            )
+    return _executor
+
+
+def is_image(attachment):
+    content_type = attachment.content_type or mimetypes.guess_type(attachment.file.name)[0] or ""
+    return content_type.startswith("image/")
+
+
+def schedule_previews(attachment_ids):
+    """
+    Queue preview generation for freshly created attachments once the
+    surrounding transaction commits, so the request never waits on Pillow.
+    """
+    attachment_ids = list(attachment_ids)
+    if not attachment_ids:
+        return
+
+    def submit():
+        if settings.ATTACHMENT_PREVIEW_SYNC:
+            run_previews(attachment_ids)
+        else:
+            get_executor().submit(run_previews, attachment_ids)
+
+    transaction.on_commit(submit)
+
+
+def run_previews(attachment_ids):
+    """Worker entry point: owns its DB connection for the thread's lifetime."""
+    close_old_connections()
+    try:
+        # rows were committed a moment ago; a lagging replica may not have them yet
+        with use_primary():
+            for attachment in MessageAttachment.objects.filter(id__in=attachment_ids):
+                generate_previews(attachment)
+    finally:
+        close_old_connections()
+
+
+def encode(image, fmt):
+    buf = BytesIO()
+    if fmt == "JPEG":
+        image.convert("RGB").save(buf, "JPEG", quality=80, optimize=True, progressive=True)
+    else:
+        image.save(buf, fmt, optimize=True)
+    return buf.getvalue()
+
+
+def mark_failed(attachment):
+    MessageAttachment.objects.filter(pk=attachment.pk).update(
+        preview_status=MessageAttachment.PREVIEW_FAILED
+    )
+
+
+def generate_previews(attachment):
+    """
+    Record dimensions, build a blurred placeholder data URI and resized
+    variants (``ATTACHMENT_PREVIEW_SIZES``) for an image attachment. Any
+    failure marks the attachment ``failed`` and leaves no variant files behind.
+    """
+    if not is_image(attachment):
+        MessageAttachment.objects.filter(pk=attachment.pk).update(
+            preview_status=MessageAttachment.PREVIEW_NONE
+        )
+        return
+
+    try:
+        with attachment.file.open("rb") as fh:
+            image = Image.open(fh)
+            image = ImageOps.exif_transpose(image)
+            image.load()
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        logger.warning("Preview generation failed for attachment %s", attachment.pk, exc_info=True)
+        mark_failed(attachment)
+        return
+
+    variants = []
+    try:
+        placeholder = build_variants(attachment, image, variants)
+        stale = list(AttachmentVariant.objects.filter(attachment=attachment))
+        with transaction.atomic():
+            AttachmentVariant.objects.filter(attachment=attachment).delete()
+            AttachmentVariant.objects.bulk_create(variants)
+            MessageAttachment.objects.filter(pk=attachment.pk).update(
+                width=image.width,
+                height=image.height,
+                placeholder=placeholder,
+                preview_status=MessageAttachment.PREVIEW_READY,
+            )
+    except Exception:
+        logger.exception("Preview generation failed for attachment %s", attachment.pk)
+        # فایل‌هایی که تا اینجا نوشته شده‌اند بی‌صاحب می‌مانند
+        for variant in variants:
+            variant.file.delete(save=False)
+        mark_failed(attachment)
+        return
+    for variant in stale:
+        variant.file.delete(save=False)
+
+
+def build_variants(attachment, image, variants):
+    """
+    Encode and store the resized variants, appending each (unsaved) to
+    ``variants`` as soon as its file is written; returns the placeholder.
+    """
+    # تصاویر شفاف PNG می‌مانند، بقیه JPEG
+    has_alpha = image.mode in ("RGBA", "LA") or "transparency" in image.info
+    fmt, ext, content_type = ("PNG", "png", "image/png") if has_alpha else ("JPEG", "jpg", "image/jpeg")
+
+    tiny = image.copy()
+    tiny.thumbnail((PLACEHOLDER_EDGE, PLACEHOLDER_EDGE))
+    tiny = tiny.convert("RGB").filter(ImageFilter.GaussianBlur(1))
+    placeholder = "data:image/jpeg;base64," + base64.b64encode(encode(tiny, "JPEG")).decode("ascii")
+
+    for name, edge in settings.ATTACHMENT_PREVIEW_SIZES.items():
+        if max(image.size) <= edge and variants:
+            # بزرگ‌تر از اصل لازم نیست
+            break
+        resized = image.copy()
+        resized.thumbnail((edge, edge), Image.LANCZOS)
+        data = encode(resized, fmt)
+        variant = AttachmentVariant(
+            attachment=attachment,
+            name=name,
+            content_type=content_type,
+            width=resized.width,
+            height=resized.height,
+            size=len(data),
+        )
+        variant.file.save(f"{attachment.pk}_{name}.{ext}", ContentFile(data), save=False)
+        variants.append(variant)
+    return placeholder
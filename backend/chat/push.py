@@ -0,0 +1,268 @@
+"""
+Push notifications for new messages, fanned out off the request path.
+
+Sending a message only inserts one ``PushOutbox`` row in the send
+transaction, so its cost does not grow with the group. The
+``send_push_notifications`` worker claims rows in batches, expands each into
+its recipients (every member but the sender), hands them to the configured
+notifier in chunks on a thread pool, and deletes the row once all chunks
+were accepted. Recipients that failed are kept on the row and retried with
+exponential backoff, up to CHAT_PUSH_MAX_ATTEMPTS; then the row is dropped
+with an error log. The claim is a lease the worker renews while chunks are
+in flight, and it only deletes or reschedules rows it still holds; a worker
+that dies mid-batch loses only its lease. So delivery is at-least-once: a
+notifier must tolerate the odd duplicate.
+
+The worker also finishes moving the conversation up in the inbox of the
+members ``register_message`` left out (see CHAT_INBOX_INLINE_BUMP).
+"""
+import json
+import logging
+import random
+import threading
+import urllib.request
+from concurrent.futures import wait
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from core.db_router import use_primary
+
+from .models import Conversation, PushOutbox, ReadCursor
+
+logger = logging.getLogger(__name__)
+
+
+class LocalPushNotifier:
+    """Keeps what it was given in memory; for development and tests."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sent = []  # (user_id, payload)
+
+    def send(self, user_ids, payload):
+        with self.lock:
+            self.sent.extend((user_id, payload) for user_id in user_ids)
+        return []
+
+
+class WebhookPushNotifier:
+    """
+    POSTs ``{"recipients": [...], "notification": {...}}`` to
+    ``CHAT_PUSH_WEBHOOK_URL`` (a push gateway). A non-2xx answer fails the
+    whole chunk; a 2xx body may list ``"failed"`` recipient ids to retry.
+    """
+
+    def __init__(self):
+        self.url = settings.CHAT_PUSH_WEBHOOK_URL
+        self.timeout = settings.CHAT_PUSH_TIMEOUT
+
+    def send(self, user_ids, payload):
+        body = json.dumps({"recipients": list(user_ids), "notification": payload}).encode()
+        request = urllib.request.Request(
+            self.url, data=body, method="POST", headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            answer = response.read()
+        try:
+            return json.loads(answer).get("failed") or []
+        except (ValueError, AttributeError):
+            return []
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def get_push_notifier():
+    global _notifier
+    with _notifier_lock:
+        if _notifier is None:
+            _notifier = import_string(settings.CHAT_PUSH_NOTIFIER)()
+    return _notifier
+
+
+def enqueue_push(messages):
+    """Owe push notifications for ``messages``; call inside the send transaction."""
+    PushOutbox.objects.bulk_create([PushOutbox(message=message) for message in messages])
+
+
+def notification_payload(message):
+    return {
+        "type": "message",
+        "conversation": message.conversation_id,
+        "message": message.id,
+        "sender": message.sender_id,
+        "text": message.text[:settings.CHAT_PUSH_PREVIEW_CHARS],
+    }
+
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, capped at CHAT_PUSH_RETRY_MAX seconds."""
+    delay = min(settings.CHAT_PUSH_RETRY_MAX, settings.CHAT_PUSH_RETRY_BASE * 2 ** (attempts - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+def lease_until():
+    return timezone.now() + timedelta(seconds=settings.CHAT_PUSH_LEASE_SECONDS)
+
+
+def claim(batch_size):
+    """
+    Take up to ``batch_size`` due rows and push their ``available_at`` past
+    the lease, so concurrent workers skip them and a crashed worker's rows
+    come back on their own. The rows carry the lease in ``available_at``.
+    """
+    now = timezone.now()
+    lease = lease_until()
+    with transaction.atomic():
+        rows = list(
+            PushOutbox.objects.select_for_update(skip_locked=True, of=("self",))
+            .select_related("message")
+            .filter(available_at__lte=now, attempts__lt=settings.CHAT_PUSH_MAX_ATTEMPTS)
+            .order_by("available_at", "id")[:batch_size]
+        )
+        if rows:
+            PushOutbox.objects.filter(pk__in=[row.pk for row in rows]).update(available_at=lease)
+    for row in rows:
+        row.available_at = lease
+    return rows
+
+
+def renew(rows):
+    """Extend the lease on ``rows``; returns those still held (the rest were claimed again)."""
+    held = []
+    lease = lease_until()
+    for row in rows:
+        if PushOutbox.objects.filter(pk=row.pk, available_at=row.available_at).update(available_at=lease):
+            row.available_at = lease
+            held.append(row)
+        else:
+            logger.warning("lost the push lease on message %s", row.message_id)
+    return held
+
+
+def prune_dead():
+    """Drop rows left at CHAT_PUSH_MAX_ATTEMPTS (e.g. after lowering it); returns how many."""
+    deleted, _ = PushOutbox.objects.filter(attempts__gte=settings.CHAT_PUSH_MAX_ATTEMPTS).delete()
+    return deleted
+
+
+def recipients_of(rows):
+    """``{row id: [user ids]}``: every member but the sender, or what is left to retry."""
+    fresh = {row.message.conversation_id for row in rows if row.recipients is None}
+    members = {}
+    for conversation_id, user_id in (
+        Conversation.members.through.objects.filter(conversation_id__in=fresh)
+        .order_by("user_id")
+        .values_list("conversation_id", "user_id")
+    ):
+        members.setdefault(conversation_id, []).append(user_id)
+    return {
+        row.pk: row.recipients if row.recipients is not None else [
+            user_id for user_id in members.get(row.message.conversation_id, [])
+            if user_id != row.message.sender_id
+        ]
+        for row in rows
+    }
+
+
+def bump_inboxes(rows):
+    """Inbox order for every member of the rows' conversations, not only the inline few."""
+    latest = {}
+    for row in rows:
+        if row.recipients is None:
+            conversation_id, at = row.message.conversation_id, row.message.created_at
+            latest[conversation_id] = max(at, latest.get(conversation_id, at))
+    for conversation_id, at in latest.items():
+        ReadCursor.bump_activity(conversation_id, at)
+
+
+def _send_chunk(notifier, user_ids, payload):
+    try:
+        return set(notifier.send(user_ids, payload)) & set(user_ids), ""
+    except Exception as exc:
+        logger.warning("push to %d recipients failed: %r", len(user_ids), exc)
+        return set(user_ids), repr(exc)[:500]
+
+
+def deliver(rows, pool, notifier=None):
+    """
+    Fan claimed rows out to the notifier in CHAT_PUSH_CHUNK_SIZE chunks on
+    ``pool``, renewing the lease every third of it until all chunks are
+    back, then delete the delivered rows and reschedule the rest with only
+    their failed recipients; rows whose lease was lost are left to the
+    worker that took them. Returns (notifications sent, rows retried).
+    """
+    notifier = notifier or get_push_notifier()
+    size = settings.CHAT_PUSH_CHUNK_SIZE
+    bump_inboxes(rows)
+    recipients = recipients_of(rows)
+    pending = []
+    for row in rows:
+        user_ids = recipients[row.pk]
+        payload = notification_payload(row.message)
+        futures = [
+            pool.submit(_send_chunk, notifier, user_ids[i:i + size], payload)
+            for i in range(0, len(user_ids), size)
+        ]
+        pending.append((row, len(user_ids), futures))
+
+    in_flight = [future for _, _, futures in pending for future in futures]
+    held = rows
+    while wait(in_flight, timeout=settings.CHAT_PUSH_LEASE_SECONDS / 3).not_done:
+        held = renew(held)
+    held_ids = {row.pk for row in held}
+
+    sent = retried = 0
+    done = []
+    for row, total, futures in pending:
+        failed, errors = set(), []
+        for future in futures:
+            chunk_failed, error = future.result()
+            failed |= chunk_failed
+            if error:
+                errors.append(error)
+        sent += total - len(failed)
+        if row.pk not in held_ids:
+            continue
+        if not failed:
+            done.append(row)
+            continue
+        # only while the lease is ours: a worker that took the row over owns it now
+        leased = PushOutbox.objects.filter(pk=row.pk, available_at=row.available_at)
+        attempts = row.attempts + 1
+        last_error = errors[0] if errors else f"{len(failed)} recipients rejected"
+        if attempts >= settings.CHAT_PUSH_MAX_ATTEMPTS:
+            if leased.delete()[0]:
+                logger.error(
+                    "giving up on push to %d recipients of message %s after %d attempts: %s",
+                    len(failed), row.message_id, attempts, last_error,
+                )
+            continue
+        if leased.update(
+            attempts=attempts,
+            recipients=sorted(failed),
+            available_at=timezone.now() + timedelta(seconds=retry_delay(attempts)),
+            last_error=last_error,
+        ):
+            retried += 1
+        else:
+            logger.warning("lost the push lease on message %s", row.message_id)
+    if done:
+        # held rows share one lease: claimed together, renewed together
+        PushOutbox.objects.filter(pk__in=[row.pk for row in done], available_at=done[0].available_at).delete()
+    return sent, retried
+
+
+def drain(pool, batch_size=None, notifier=None):
+    """One worker iteration: claim a batch and deliver it. Returns (rows, sent, retried)."""
+    with use_primary():
+        rows = claim(batch_size or settings.CHAT_PUSH_BATCH_SIZE)
+        if not rows:
+            return 0, 0, 0
+        sent, retried = deliver(rows, pool, notifier)
+    return len(rows), sent, retried
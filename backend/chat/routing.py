@@ -0,0 +1,7 @@
+from django.urls import path
+from .consumers import ChatConsumer
+
+websocket_urlpatterns = [
+    # اتصال زنده برای دریافت پیام‌های جدید
+    path("ws/chat/", ChatConsumer.as_asgi(), name="chat-ws"),
+]
@@ -1,27 +1,56 @@
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import IntegrityError, transaction
+from django.urls import reverse
 from rest_framework import serializers
-from .models import Conversation, Message, MessageAttachment
+from .blobs import accessible_blobs
+from .compact import SelectableFieldsMixin
+from .membership import get_conversation_ids, is_member
+from .models import AttachmentVariant, Conversation, Message, MessageAttachment, Upload
 from users.serializers import SimpleUserSerializer
 
 User = get_user_model()
 
 
+class AttachmentVariantSerializer(serializers.ModelSerializer):
+    url = serializers.SerializerMethodField()
+
+    class Meta:
+        model = AttachmentVariant
+        fields = ["name", "url", "content_type", "width", "height", "size"]
+
+    def get_url(self, obj):
+        url = reverse("attachment-download", args=[obj.attachment_id]) + f"?variant={obj.name}"
+        req = self.context.get("request")
+        return req.build_absolute_uri(url) if req else url
+
+
 class MessageAttachmentSerializer(serializers.ModelSerializer):
     file_url = serializers.SerializerMethodField()
+    variants = AttachmentVariantSerializer(many=True, read_only=True)
 
     class Meta:
         model = MessageAttachment
-        fields = ["id", "file", "file_url", "content_type", "size", "uploaded_at"]
-        read_only_fields = ["id", "content_type", "size", "uploaded_at"]
+        fields = [
+            "id", "file", "file_url", "name", "content_type", "size", "uploaded_at",
+            "width", "height", "placeholder", "preview_status", "variants",
+        ]
+        read_only_fields = [
+            "id", "name", "content_type", "size", "uploaded_at",
+            "width", "height", "placeholder", "preview_status",
+        ]
 
     def get_file_url(self, obj):
+        # دانلود از endpoint احراز‌شده، نه مسیر مستقیم media
+        url = reverse("attachment-download", args=[obj.pk])
         req = self.context.get("request")
-        return req.build_absolute_uri(obj.file.url) if req else obj.file.url
+        return req.build_absolute_uri(url) if req else url
 
 
-class MessageSerializer(serializers.ModelSerializer):
+class MessageSerializer(SelectableFieldsMixin, serializers.ModelSerializer):
     sender_detail = SimpleUserSerializer(source="sender", read_only=True)
     attachments = MessageAttachmentSerializer(many=True, read_only=True)
+    user_fields = {"sender_detail": "sender"}
 
     class Meta:
         model = Message
@@ -36,34 +65,171 @@ class MessageSerializer(serializers.ModelSerializer):
         ]
 
 
+class BlobRefSerializer(serializers.Serializer):
+    """پیوست با hash محتوایی که سرور از قبل دارد (ارسال بدون آپلود)"""
+    sha256 = serializers.RegexField(r"^[0-9a-fA-F]{64}$")
+    name = serializers.CharField(max_length=255, required=False, allow_blank=True, default="")
+    content_type = serializers.CharField(max_length=100, required=False, allow_blank=True, default="")
+
+
+def resolve_blob_refs(user, refs):
+    """[(blob, name, content_type), ...]؛ hashهای ناشناخته/غیرمجاز → خطا با فهرست همان‌ها"""
+    blobs = accessible_blobs(user, [ref["sha256"].lower() for ref in refs])
+    missing = sorted({ref["sha256"].lower() for ref in refs} - set(blobs))
+    if missing:
+        raise serializers.ValidationError({"blobs": {"detail": "Unknown blob; upload it first.", "missing": missing}})
+    return [(blobs[ref["sha256"].lower()], ref["name"], ref["content_type"]) for ref in refs]
+
+
 class MessageCreateSerializer(serializers.Serializer):
     conversation_id = serializers.IntegerField()
     text = serializers.CharField(allow_blank=True, required=False, default="")
+    # آپلودهای تکه‌ای که complete شده‌اند
+    upload_ids = serializers.ListField(
+        child=serializers.UUIDField(), required=False, default=list
+    )
+    blobs = BlobRefSerializer(many=True, required=False, default=list)
 
     def validate(self, attrs):
         request = self.context["request"]
-        try:
-            conv = Conversation.objects.get(
-                id=attrs["conversation_id"], members=request.user
-            )
-        except Conversation.DoesNotExist:
+        if not is_member(request.user.id, attrs["conversation_id"]):
             raise serializers.ValidationError(
                 "Conversation not found or you're not a member."
             )
-        attrs["conversation"] = conv
+        # عضویت از cache تأیید شد؛ برای ساخت پیام فقط pk لازم است
+        attrs["conversation"] = Conversation(pk=attrs["conversation_id"])
         attrs["sender"] = request.user
+
+        upload_ids = set(attrs.get("upload_ids") or [])
+        uploads = []
+        if upload_ids:
+            uploads = list(
+                Upload.objects.filter(
+                    id__in=upload_ids, user=request.user, status=Upload.COMPLETE
+                )
+            )
+            if len(uploads) != len(upload_ids):
+                raise serializers.ValidationError(
+                    {"upload_ids": "Unknown, unfinished or already attached upload."}
+                )
+        attrs["uploads"] = uploads
+        attrs["blobs"] = resolve_blob_refs(request.user, attrs.get("blobs") or [])
         return attrs
 
 
-class ConversationSerializer(serializers.ModelSerializer):
+class MessageBatchItemSerializer(serializers.Serializer):
+    conversation_id = serializers.IntegerField()
+    text = serializers.CharField(allow_blank=True, required=False, default="")
+    upload_ids = serializers.ListField(
+        child=serializers.UUIDField(), required=False, default=list
+    )
+    blobs = BlobRefSerializer(many=True, required=False, default=list)
+
+
+class MessageBatchSerializer(serializers.Serializer):
+    messages = serializers.ListField(
+        child=MessageBatchItemSerializer(),
+        allow_empty=False,
+        max_length=settings.MESSAGE_BATCH_MAX,
+    )
+
+    def validate(self, attrs):
+        request = self.context["request"]
+        items = attrs["messages"]
+
+        # عضویت یک بار (از cache) برای همه‌ی گفتگوهای مقصد
+        my_conversations = get_conversation_ids(request.user.id)
+        errors = {
+            index: "Conversation not found or you're not a member."
+            for index, item in enumerate(items)
+            if item["conversation_id"] not in my_conversations
+        }
+        if errors:
+            raise serializers.ValidationError({"messages": errors})
+
+        upload_ids = [uid for item in items for uid in item.get("upload_ids") or []]
+        if len(upload_ids) != len(set(upload_ids)):
+            raise serializers.ValidationError({"upload_ids": "An upload can be attached only once."})
+        uploads = {}
+        if upload_ids:
+            uploads = Upload.objects.filter(
+                id__in=upload_ids, user=request.user, status=Upload.COMPLETE
+            ).in_bulk()
+            if len(uploads) != len(upload_ids):
+                raise serializers.ValidationError(
+                    {"upload_ids": "Unknown, unfinished or already attached upload."}
+                )
+        refs = iter(resolve_blob_refs(request.user, [ref for item in items for ref in item.get("blobs") or []]))
+        for item in items:
+            item["uploads"] = [uploads[uid] for uid in item.get("upload_ids") or []]
+            item["blobs"] = [next(refs) for _ in item.get("blobs") or []]
+        return attrs
+
+
+class UploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = Upload
+        fields = ["id", "filename", "content_type", "size", "offset", "sha256", "status", "created_at"]
+        read_only_fields = ["id", "offset", "status", "created_at"]
+
+    def validate_size(self, value):
+        if value < 1 or value > settings.CHUNKED_UPLOAD_MAX_SIZE:
+            raise serializers.ValidationError(
+                f"Size must be between 1 and {settings.CHUNKED_UPLOAD_MAX_SIZE} bytes."
+            )
+        return value
+
+    def validate_sha256(self, value):
+        value = value.lower()
+        if value and (len(value) != 64 or any(c not in "0123456789abcdef" for c in value)):
+            raise serializers.ValidationError("Must be a hex SHA-256 digest.")
+        return value
+
+
+class UploadCompleteSerializer(serializers.Serializer):
+    sha256 = serializers.RegexField(r"^[0-9a-fA-F]{64}$", required=False)
+
+
+class ConversationSerializer(SelectableFieldsMixin, serializers.ModelSerializer):
     members = serializers.PrimaryKeyRelatedField(many=True, read_only=True)
     members_detail = SimpleUserSerializer(source="members", many=True, read_only=True)
+    user_fields = {"members_detail": "members"}
 
     class Meta:
         model = Conversation
         fields = ["id", "name", "is_group", "members", "members_detail", "created_at"]
 
 
+class InboxConversationSerializer(ConversationSerializer):
+    last_message = MessageSerializer(read_only=True)
+    unread_count = serializers.IntegerField(read_only=True)
+    last_read_message_id = serializers.IntegerField(read_only=True)
+
+    class Meta(ConversationSerializer.Meta):
+        fields = ConversationSerializer.Meta.fields + [
+            "last_message",
+            "last_activity_at",
+            "unread_count",
+            "last_read_message_id",
+        ]
+
+
+class SyncSerializer(serializers.Serializer):
+    since = serializers.IntegerField(min_value=0, required=False, default=0)
+    after = serializers.DictField(child=serializers.IntegerField(min_value=0), required=False, default=dict)
+    cursor = serializers.CharField(required=False)
+
+    def validate_after(self, value):
+        try:
+            return {int(conv): last for conv, last in value.items()}
+        except ValueError:
+            raise serializers.ValidationError("Keys must be conversation ids.")
+
+
+class MarkReadSerializer(serializers.Serializer):
+    message_id = serializers.IntegerField(min_value=1, required=False)
+
+
 class ConversationCreateSerializer(serializers.Serializer):
     name = serializers.CharField(required=False, allow_blank=True, max_length=200)
     is_group = serializers.BooleanField(required=False, default=False)
@@ -90,29 +256,36 @@ class ConversationCreateSerializer(serializers.Serializer):
                     "Group must include at least you and one more user."
                 )
 
+        if User.objects.filter(id__in=members, is_active=True).count() != len(members):
+            raise serializers.ValidationError({"members": "Unknown or inactive user."})
+
         attrs["members"] = members
         return attrs
 
     def create(self, validated_data):
-        from django.db.models import Count
-
         is_group = validated_data.get("is_group", False)
         members = validated_data["members"]
         name = validated_data.get("name", "")
 
         if not is_group:
-            me, other = sorted(members)
-            qs = (
-                Conversation.objects.filter(is_group=False, members=me)
-                .filter(members=other)
-                .annotate(mcount=Count("members"))
-                .filter(mcount=2)
-            )
-            existing = qs.first()
+            # یک lookup روی ایندکس یکتا؛ ساخت همزمان با IntegrityError به همان DM می‌رسد
+            key = Conversation.make_dm_key(*members)
+            existing = Conversation.objects.filter(dm_key=key).first()
             if existing:
+                existing.created_now = False
+                return existing
+            try:
+                with transaction.atomic():
+                    conv = Conversation.objects.create(name=name or "", is_group=False, dm_key=key)
+                    conv.members.set(members)
+            except IntegrityError:
+                existing = Conversation.objects.get(dm_key=key)
+                existing.created_now = False
                 return existing
+            conv.created_now = True
+            return conv
 
         conv = Conversation.objects.create(name=name or "", is_group=is_group)
         conv.members.set(members)
+        conv.created_now = True
         return conv
-
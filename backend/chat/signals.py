@@ -0,0 +1,144 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
+from core.versions import bump_versions_on_commit
+
+from .blobs import release_refs
+from .events import publish_removed
+from .membership import conversations_scope, invalidate_contacts, invalidate_memberships
+from .models import Conversation, MessageAttachment, ReadCursor
+
+
+@receiver(m2m_changed, sender=Conversation.members.through)
+def sync_read_cursors(sender, instance, action, reverse, pk_set, **kwargs):
+    """هر عضو گفتگو یک ReadCursor دارد؛ با تغییر اعضا همگام می‌ماند."""
+    if reverse:
+        # user.conversations.add(...) — instance کاربر است
+        pairs = [(conv_id, instance.pk) for conv_id in (pk_set or ())]
+    else:
+        pairs = [(instance.pk, user_id) for user_id in (pk_set or ())]
+
+    if action == "post_add":
+        # عضو تازه تاریخچه را خوانده‌شده می‌بیند و گفتگو در جای فعلی‌اش در اینباکس قرار می‌گیرد
+        state = {
+            pk: (last_message_id or 0, last_activity_at)
+            for pk, last_message_id, last_activity_at in Conversation.objects.filter(
+                pk__in={c for c, _ in pairs}
+            ).values_list("pk", "last_message_id", "last_activity_at")
+        }
+        ReadCursor.objects.bulk_create(
+            [
+                ReadCursor(
+                    conversation_id=c, user_id=u,
+                    last_read_message_id=state[c][0], last_activity_at=state[c][1],
+                )
+                for c, u in pairs if c in state
+            ],
+            ignore_conflicts=True,
+        )
+    elif action == "post_remove":
+        for conv_id, user_id in pairs:
+            ReadCursor.objects.filter(conversation_id=conv_id, user_id=user_id).delete()
+    elif action == "pre_clear":
+        if reverse:
+            ReadCursor.objects.filter(user=instance).delete()
+        else:
+            ReadCursor.objects.filter(conversation=instance).delete()
+
+
+@receiver(m2m_changed, sender=Conversation.members.through)
+def touch_members_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if not reverse:
+        conv_ids = [instance.pk]
+    elif action == "pre_clear":
+        conv_ids = list(instance.conversations.values_list("id", flat=True))
+    else:
+        conv_ids = pk_set or ()
+    Conversation.objects.filter(pk__in=conv_ids).update(members_changed_at=timezone.now())
+
+
+def drop_memberships(user_ids):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    invalidate_memberships(user_ids)
+    # دوباره بعد از commit، تا خواننده‌ی همزمان داده‌ی قدیمی را کش نکرده باشد
+    transaction.on_commit(lambda: invalidate_memberships(user_ids))
+
+
+@receiver(m2m_changed, sender=Conversation.members.through)
+def invalidate_membership_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    if action in ("post_add", "post_remove"):
+        drop_memberships([instance.pk] if reverse else pk_set or ())
+    elif action == "pre_clear":
+        if reverse:
+            drop_memberships([instance.pk])
+        else:
+            drop_memberships(instance.members.values_list("id", flat=True))
+
+
+def drop_contacts(user_ids):
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    invalidate_contacts(user_ids)
+    transaction.on_commit(lambda: invalidate_contacts(user_ids))
+
+
+@receiver(m2m_changed, sender=Conversation.members.through)
+def invalidate_contacts_cache(sender, instance, action, reverse, pk_set, **kwargs):
+    """مخاطبان همه‌ی اعضای گفتگوهای درگیر عوض می‌شود، نه فقط عضو اضافه/حذف‌شده"""
+    if action not in ("post_add", "post_remove", "pre_clear"):
+        return
+    if not reverse:
+        conv_ids, user_ids = [instance.pk], set(pk_set or ())
+    elif action == "pre_clear":
+        conv_ids, user_ids = list(instance.conversations.values_list("id", flat=True)), {instance.pk}
+    else:
+        conv_ids, user_ids = list(pk_set or ()), {instance.pk}
+    user_ids.update(
+        sender.objects.filter(conversation_id__in=conv_ids).values_list("user_id", flat=True)
+    )
+    drop_contacts(user_ids)
+
+
+@receiver(m2m_changed, sender=Conversation.members.through)
+def announce_removed_members(sender, instance, action, reverse, pk_set, **kwargs):
+    """سوکت باز عضو حذف‌شده باید از گروه گفتگو جدا شود"""
+    if action == "post_remove":
+        if reverse:
+            publish_removed([instance.pk], pk_set or ())
+        else:
+            publish_removed(pk_set or (), [instance.pk])
+    elif action == "pre_clear":
+        if reverse:
+            publish_removed([instance.pk], instance.conversations.values_list("id", flat=True))
+        else:
+            publish_removed(instance.members.values_list("id", flat=True), [instance.pk])
+
+
+@receiver(pre_delete, sender=Conversation)
+def invalidate_deleted_conversation(sender, instance, **kwargs):
+    member_ids = list(instance.members.values_list("id", flat=True))
+    drop_memberships(member_ids)
+    drop_contacts(member_ids)
+    publish_removed(member_ids, [instance.pk])
+
+
+@receiver(post_save, sender=Conversation)
+def bump_conversation_lists(sender, instance, created, **kwargs):
+    # گفتگوی تازه هنوز عضوی ندارد؛ اضافه شدن اعضا خودش نسخه را بالا می‌برد
+    if not created:
+        bump_versions_on_commit(
+            conversations_scope(user_id) for user_id in instance.members.values_list("id", flat=True)
+        )
+
+
+@receiver(post_delete, sender=MessageAttachment)
+def release_blob(sender, instance, **kwargs):
+    # فایل پاک نمی‌شود؛ blob بی‌استفاده را collect_blobs جمع می‌کند
+    release_refs([instance.blob_id])
@@ -0,0 +1,127 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import Conversation, Message
+from .serializers import ConversationSerializer, MessageSerializer
+
+
+class InvalidSyncCursor(ValueError):
+    pass
+
+
+def encode_sync_cursor(since, after, changed_since):
+    payload = {"m": since, "a": {str(c): last for c, last in after.items()}, "t": changed_since.isoformat()}
+    return urlsafe_b64encode(json.dumps(payload, separators=(",", ":")).encode()).decode("ascii")
+
+
+def decode_sync_cursor(cursor):
+    """Returns ``(since, after, changed_since)``."""
+    try:
+        payload = json.loads(urlsafe_b64decode(cursor.encode("ascii")))
+        changed_since = parse_datetime(payload["t"])
+        if changed_since is None:
+            raise ValueError
+        after = {int(c): int(last) for c, last in payload["a"].items()}
+        return int(payload["m"]), after, changed_since
+    except (ValueError, TypeError, KeyError, AttributeError, UnicodeError):
+        raise InvalidSyncCursor()
+
+
+class DeltaSync:
+    """
+    Everything a client is missing, as one streamed JSON object::
+
+        {"conversation_ids": [...], "conversations": [...],
+         "messages": [...], "has_more": bool, "cursor": "..."}
+
+    ``after`` maps conversation id -> last seen message id; every other
+    member conversation uses ``since``. Messages come in global id order in
+    keyset batches, so a page cut off by ``CHAT_SYNC_MAX_MESSAGES`` /
+    ``CHAT_SYNC_MAX_BYTES`` resumes exactly where it stopped. Conversations
+    are all of them on a cold start (``changed_since`` None) and otherwise
+    only those whose members changed; ``conversation_ids`` is the full list
+    so clients can drop conversations they left.
+    """
+
+    def __init__(self, request, conversation_ids, since=0, after=None, changed_since=None):
+        self.request = request
+        self.conversation_ids = sorted(conversation_ids)
+        self.changed_since = changed_since
+        self.started_at = timezone.now()
+        self.since = since
+        # an entry equal to ``since`` is the same as leaving it out
+        self.after = {c: last for c, last in (after or {}).items() if c in conversation_ids and last != since}
+
+    def stream(self):
+        encoder = JSONEncoder()
+        context = {"request": self.request}
+        yield b'{"conversation_ids":' + encoder.encode(self.conversation_ids).encode()
+
+        yield b',"conversations":['
+        first = True
+        for conv in self.changed_conversations():
+            chunk = encoder.encode(ConversationSerializer(conv, context=context).data).encode()
+            yield (b"" if first else b",") + chunk
+            first = False
+        yield b'],"messages":['
+
+        sent = size = 0
+        has_more = False
+        first = True
+        while True:
+            remaining = settings.CHAT_SYNC_MAX_MESSAGES - sent
+            if remaining <= 0 or size >= settings.CHAT_SYNC_MAX_BYTES:
+                # capped: is anything left past the last message sent?
+                has_more = bool(self.next_batch(1))
+                break
+            limit = min(settings.CHAT_SYNC_BATCH_SIZE, remaining)
+            batch = self.next_batch(limit)
+            for message in batch:
+                chunk = encoder.encode(MessageSerializer(message, context=context).data).encode()
+                yield (b"" if first else b",") + chunk
+                first = False
+                sent += 1
+                size += len(chunk)
+                self.advance(message)
+                if size >= settings.CHAT_SYNC_MAX_BYTES:
+                    break
+            if len(batch) < limit and size < settings.CHAT_SYNC_MAX_BYTES:
+                break
+
+        cursor = encode_sync_cursor(self.since, self.after, self.started_at)
+        yield b'],"has_more":' + (b"true" if has_more else b"false")
+        yield b',"cursor":' + encoder.encode(cursor).encode() + b"}"
+
+    def changed_conversations(self):
+        qs = Conversation.objects.filter(id__in=self.conversation_ids)
+        if self.changed_since is not None:
+            qs = qs.filter(members_changed_at__gte=self.changed_since)
+        return qs.order_by("id").prefetch_related("members").iterator(chunk_size=500)
+
+    def next_batch(self, limit):
+        condition = Q()
+        default = [c for c in self.conversation_ids if c not in self.after]
+        if default:
+            condition |= Q(conversation_id__in=default, id__gt=self.since)
+        for conv, last in self.after.items():
+            condition |= Q(conversation_id=conv, id__gt=last)
+        if not condition:
+            return []
+        return list(
+            Message.objects.filter(condition)
+            .select_related("sender")
+            .prefetch_related("attachments__variants")
+            .order_by("id")[:limit]
+        )
+
+    def advance(self, message):
+        # every matching message up to this id has been sent, in every conversation
+        self.since = max(self.since, message.id)
+        after = {c: max(last, message.id) for c, last in self.after.items()}
+        self.after = {c: last for c, last in after.items() if last != self.since}
@@ -1,3 +1,2026 @@
-from django.test import TestCase
+import asyncio
+import csv
+import decimal
+import gzip
+import hashlib
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from channels.db import database_sync_to_async
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import CommandError, call_command
+from django.db import connection, connections
+from django.db.models import Count
+from django.http import HttpResponse
+from django.test import RequestFactory, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient, APIRequestFactory, force_authenticate
+from rest_framework.test import APITestCase as BaseAPITestCase
+
+from core.asgi import application
+from core.db_router import ReplicaPinningMiddleware, ReplicaRouter, use_primary
+from core.metrics import render_metrics
+from core import throttling
+from core.renderers import MessagePackRenderer, ORJSONRenderer
+from . import partitions, presence, push
+from .async_views import AsyncMessageListView, AsyncMessageSendView
+from .bench import compare
+from .export import export_rows
+from .management.commands.benchmark import SCENARIOS
+from .presence import LocalPresenceStore, allow_typing
+from .previews import generate_previews
+from .push import LocalPushNotifier, claim, deliver, drain
+from .uploads import locked_partial, partial_path
+from .models import (
+    AttachmentVariant, Blob, Conversation, Message, MessageAttachment, PushOutbox, ReadCursor, Upload,
+)
+from .membership import get_contact_ids, get_conversation_ids
+from .notify import LocalNotifier, notify_message
+
+User = get_user_model()
+
+
+class CacheResetMixin:
+    # ids are reused after each test's rollback, so cached memberships must not leak
+    def run(self, result=None):
+        cache.clear()
+        presence._store = None
+        throttling._store = None
+        return super().run(result)
+
+
+class APITestCase(CacheResetMixin, BaseAPITestCase):
+    pass
+
+
+class RealtimeDeliveryTests(CacheResetMixin, TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.alice_token = Token.objects.create(user=self.alice).key
+        self.bob_token = Token.objects.create(user=self.bob).key
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice, self.bob])
+
+    def api(self, token):
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f"Token {token}")
+        return client
+
+    async def connect(self, path):
+        communicator = WebsocketCommunicator(application, path)
+        connected, _ = await communicator.connect()
+        return communicator, connected
+
+    async def test_rejects_missing_or_bad_token(self):
+        for path in ["/ws/chat/", "/ws/chat/?token=nope"]:
+            communicator, connected = await self.connect(path)
+            self.assertFalse(connected)
+
+    async def test_socket_auth_uses_cached_token_lookup(self):
+        path = f"/ws/chat/?token={self.bob_token}"
+        communicator, connected = await self.connect(path)
+        self.assertTrue(connected)
+        await communicator.disconnect()
+        with patch("users.authentication.Token.objects.select_related") as lookup:
+            communicator, connected = await self.connect(path)
+        self.assertTrue(connected)
+        lookup.assert_not_called()
+        await communicator.disconnect()
+
+        # logout drops the cached entry for sockets too
+        await database_sync_to_async(self.api(self.bob_token).post)("/api/chat/logout/")
+        communicator, connected = await self.connect(path)
+        self.assertFalse(connected)
+
+    async def test_sent_message_is_pushed_to_members(self):
+        communicator, connected = await self.connect(f"/ws/chat/?token={self.bob_token}")
+        self.assertTrue(connected)
+
+        resp = await database_sync_to_async(self.api(self.alice_token).post)(
+            "/api/chat/messages/send/",
+            {"conversation_id": self.conv.id, "text": "hi"},
+            format="json",
+        )
+        self.assertEqual(resp.status_code, 201)
+
+        event = await communicator.receive_json_from(timeout=2)
+        self.assertEqual(event["type"], "message")
+        self.assertEqual(event["message"]["id"], resp.data["id"])
+        self.assertEqual(event["message"]["text"], "hi")
+        self.assertEqual(event["message"]["attachments"], [])
+        await communicator.disconnect()
+
+    async def test_new_conversation_is_subscribed(self):
+        carol = await database_sync_to_async(User.objects.create_user)("carol", password="pass12345")
+        communicator, connected = await self.connect(f"/ws/chat/?token={self.bob_token}")
+        self.assertTrue(connected)
+
+        resp = await database_sync_to_async(self.api(self.alice_token).post)(
+            "/api/chat/conversations/",
+            {"is_group": True, "name": "team", "members": [self.bob.id, carol.id]},
+            format="json",
+        )
+        self.assertEqual(resp.status_code, 201)
+        event = await communicator.receive_json_from(timeout=2)
+        self.assertEqual(event["type"], "conversation")
+        self.assertEqual(event["conversation"]["id"], resp.data["id"])
+
+        await database_sync_to_async(self.api(self.alice_token).post)(
+            "/api/chat/messages/send/",
+            {"conversation_id": resp.data["id"], "text": "welcome"},
+            format="json",
+        )
+        event = await communicator.receive_json_from(timeout=2)
+        self.assertEqual(event["message"]["conversation"], resp.data["id"])
+        await communicator.disconnect()
+
+    async def test_removed_member_stops_receiving(self):
+        carol = await database_sync_to_async(User.objects.create_user)("carol", password="pass12345")
+        group = await database_sync_to_async(Conversation.objects.create)(is_group=True, name="team")
+        await database_sync_to_async(group.members.set)([self.alice, self.bob, carol])
+        communicator, connected = await self.connect(f"/ws/chat/?token={self.bob_token}")
+        self.assertTrue(connected)
+
+        await database_sync_to_async(group.members.remove)(self.bob)
+        self.assertEqual(
+            await communicator.receive_json_from(timeout=2), {"type": "removed", "conversation": group.id}
+        )
+        await database_sync_to_async(self.api(self.alice_token).post)(
+            "/api/chat/messages/send/", {"conversation_id": group.id, "text": "without bob"}, format="json"
+        )
+        self.assertTrue(await communicator.receive_nothing(timeout=0.3))
+
+        # deleting a conversation unsubscribes everyone still in it
+        conv_id = self.conv.id
+        await database_sync_to_async(self.conv.delete)()
+        self.assertEqual(
+            await communicator.receive_json_from(timeout=2), {"type": "removed", "conversation": conv_id}
+        )
+        await communicator.disconnect()
+
+
+class MessagePaginationTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice])
+        self.ids = [
+            Message.objects.create(conversation=self.conv, sender=self.alice, text=str(i)).id
+            for i in range(7)
+        ]
+        self.client.force_authenticate(self.alice)
+        self.url = f"/api/chat/messages/{self.conv.id}/"
+
+    def ids_of(self, resp):
+        return [m["id"] for m in resp.data["results"]]
+
+    def test_latest_page_then_walk_back_and_forward(self):
+        resp = self.client.get(self.url, {"limit": 3})
+        self.assertEqual(self.ids_of(resp), self.ids[4:])
+        self.assertNotIn("count", resp.data)
+        self.assertIsNone(resp.data["next"])
+
+        older = self.client.get(resp.data["previous"])
+        self.assertEqual(self.ids_of(older), self.ids[1:4])
+        oldest = self.client.get(older.data["previous"])
+        self.assertEqual(self.ids_of(oldest), self.ids[:1])
+        self.assertIsNone(oldest.data["previous"])
+
+        newer = self.client.get(oldest.data["next"])
+        self.assertEqual(self.ids_of(newer), self.ids[1:4])
+
+    def test_after_id_and_before_id(self):
+        resp = self.client.get(self.url, {"after_id": self.ids[2], "limit": 2})
+        self.assertEqual(self.ids_of(resp), self.ids[3:5])
+        self.assertEqual(self.ids_of(self.client.get(resp.data["next"])), self.ids[5:7])
+
+        resp = self.client.get(self.url, {"before_id": self.ids[2]})
+        self.assertEqual(self.ids_of(resp), self.ids[:2])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get(self.url, {"cursor": "!!"}).status_code, 404)
+        self.assertEqual(self.client.get(self.url, {"after_id": "x"}).status_code, 404)
+
+    def test_no_count_or_offset_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self.client.get(self.url, {"before_id": self.ids[-1], "limit": 2})
+        sql = " ".join(q["sql"] for q in ctx.captured_queries).upper()
+        self.assertNotIn("COUNT(", sql)
+        self.assertNotIn("OFFSET", sql)
+
+
+class ListQueryCountTests(APITestCase):
+    """Page size must not change the number of queries (no N+1)."""
+
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.client.force_authenticate(self.alice)
+
+    def make_messages(self, conv, n):
+        for i in range(n):
+            other = User.objects.create_user(f"sender{conv.id}_{i}")
+            conv.members.add(other)
+            msg = Message.objects.create(conversation=conv, sender=other, text=str(i))
+            MessageAttachment.objects.create(message=msg, file=f"attachments/{i}.txt", size=1)
+
+    def make_conversations(self, n):
+        for i in range(n):
+            conv = Conversation.objects.create(is_group=True)
+            conv.members.set([self.alice, User.objects.create_user(f"peer{n}_{i}")])
+
+    def test_message_list_query_count(self):
+        for n in (2, 40):
+            conv = Conversation.objects.create()
+            conv.members.set([self.alice])
+            self.make_messages(conv, n)
+            # membership, page, attachments and variants prefetch
+            with self.assertNumQueries(4):
+                resp = self.client.get(f"/api/chat/messages/{conv.id}/", {"limit": 200})
+            self.assertEqual(len(resp.data["results"]), n)
+
+    def test_conversation_list_query_count(self):
+        for n in (2, 40):
+            Conversation.objects.all().delete()
+            self.make_conversations(n)
+            # count, page, members prefetch
+            with self.assertNumQueries(3):
+                resp = self.client.get("/api/chat/conversations/", {"limit": 200})
+            self.assertEqual(len(resp.data["results"]), n)
+
+
+class InboxTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.first = Conversation.objects.create()
+        self.first.members.set([self.alice, self.bob])
+        self.second = Conversation.objects.create(is_group=True, name="team")
+        self.second.members.set([self.alice, self.bob])
+
+    def send(self, user, conv, text):
+        self.client.force_authenticate(user)
+        resp = self.client.post(
+            "/api/chat/messages/send/", {"conversation_id": conv.id, "text": text}, format="json"
+        )
+        self.assertEqual(resp.status_code, 201)
+        return resp.data["id"]
+
+    def inbox(self, user):
+        self.client.force_authenticate(user)
+        return self.client.get("/api/chat/inbox/").data["results"]
+
+    def test_ordering_last_message_and_unread(self):
+        self.send(self.bob, self.second, "one")
+        last = self.send(self.bob, self.first, "two")
+        self.send(self.alice, self.first, "mine")
+
+        results = self.inbox(self.alice)
+        self.assertEqual([c["id"] for c in results], [self.first.id, self.second.id])
+        self.assertEqual(results[0]["last_message"]["text"], "mine")
+        # own message marks everything before it read
+        self.assertEqual(results[0]["unread_count"], 0)
+        self.assertEqual(results[1]["unread_count"], 1)
+
+        bob_view = {c["id"]: c for c in self.inbox(self.bob)}
+        self.assertEqual(bob_view[self.first.id]["unread_count"], 1)
+        self.assertEqual(bob_view[self.first.id]["last_read_message_id"], last)
+
+    def test_mark_read(self):
+        first = self.send(self.bob, self.second, "one")
+        self.send(self.bob, self.second, "two")
+        self.client.force_authenticate(self.alice)
+        url = f"/api/chat/conversations/{self.second.id}/read/"
+
+        resp = self.client.post(url, {"message_id": first}, format="json")
+        self.assertEqual(resp.data["unread_count"], 1)
+        resp = self.client.post(url, {}, format="json")
+        self.assertEqual(resp.data["unread_count"], 0)
+
+        outsider = User.objects.create_user("eve")
+        self.client.force_authenticate(outsider)
+        self.assertEqual(self.client.post(url, {}, format="json").status_code, 404)
+
+    def test_inbox_query_count_is_independent_of_page_size(self):
+        for i in range(10):
+            conv = Conversation.objects.create()
+            conv.members.set([self.alice, self.bob])
+            self.send(self.bob, conv, str(i))
+        self.client.force_authenticate(self.alice)
+        # page, members prefetch, last_message attachments prefetch
+        with self.assertNumQueries(3):
+            resp = self.client.get("/api/chat/inbox/")
+        self.assertEqual(len(resp.data["results"]), 12)
+
+
+class MessageSearchTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.shared = Conversation.objects.create()
+        self.shared.members.set([self.alice, self.bob])
+        self.private = Conversation.objects.create()
+        self.private.members.set([self.bob])
+        self.hits = [
+            Message.objects.create(conversation=self.shared, sender=self.bob, text=f"Budget report v{i}").id
+            for i in range(3)
+        ]
+        Message.objects.create(conversation=self.shared, sender=self.bob, text="lunch?")
+        Message.objects.create(conversation=self.private, sender=self.bob, text="secret budget")
+        self.client.force_authenticate(self.alice)
+
+    def test_finds_only_member_conversations_with_cursor(self):
+        resp = self.client.get("/api/chat/messages/search/", {"q": "budget", "limit": 2})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([m["id"] for m in resp.data["results"]], self.hits[:0:-1])
+        rest = self.client.get(resp.data["next"])
+        self.assertEqual([m["id"] for m in rest.data["results"]], self.hits[:1])
+        self.assertIsNone(rest.data["next"])
+
+    def test_short_query_rejected(self):
+        resp = self.client.get("/api/chat/messages/search/", {"q": "bu"})
+        self.assertEqual(resp.status_code, 400)
+
+
+class ChunkedUploadTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.tmp, CHUNKED_UPLOAD_DIR=f"{self.tmp}/partial")
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice])
+        self.client.force_authenticate(self.alice)
+        self.payload = b"0123456789" * 1000
+
+    def start(self, **extra):
+        resp = self.client.post(
+            "/api/chat/uploads/",
+            {"filename": "report.pdf", "size": len(self.payload), "content_type": "application/pdf", **extra},
+            format="json",
+        )
+        self.assertEqual(resp.status_code, 201)
+        return f"/api/chat/uploads/{resp.data['id']}/", resp.data["id"]
+
+    def put(self, url, offset, data):
+        return self.client.put(
+            url, data=data, content_type="application/octet-stream", HTTP_UPLOAD_OFFSET=str(offset)
+        )
+
+    def test_resume_complete_and_attach(self):
+        url, upload_id = self.start()
+        self.assertEqual(self.put(url, 0, self.payload[:4000]).data["offset"], 4000)
+
+        # stale offset from a retried request
+        resp = self.put(url, 0, self.payload[:4000])
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.data["offset"], 4000)
+        self.assertEqual(self.client.get(url)["Upload-Offset"], "4000")
+
+        self.assertEqual(self.put(url, 4000, self.payload[4000:]).data["offset"], len(self.payload))
+        resp = self.client.post(
+            f"{url}complete/", {"sha256": hashlib.sha256(self.payload).hexdigest()}, format="json"
+        )
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["status"], Upload.COMPLETE)
+
+        resp = self.client.post(
+            "/api/chat/messages/send/",
+            {"conversation_id": self.conv.id, "upload_ids": [upload_id]},
+            format="json",
+        )
+        self.assertEqual(resp.status_code, 201)
+        attachment = MessageAttachment.objects.get(message_id=resp.data["id"])
+        self.assertEqual(attachment.size, len(self.payload))
+        with attachment.file.open("rb") as fh:
+            self.assertEqual(fh.read(), self.payload)
+
+        # an upload attaches only once
+        resp = self.client.post(
+            "/api/chat/messages/send/",
+            {"conversation_id": self.conv.id, "upload_ids": [upload_id]},
+            format="json",
+        )
+        self.assertEqual(resp.status_code, 400)
+
+    def test_overflow_and_checksum_mismatch(self):
+        url, _ = self.start(sha256="0" * 64)
+        self.assertEqual(self.put(url, 0, self.payload + b"x").status_code, 400)
+        self.assertEqual(self.client.get(url).data["offset"], 0)
+
+        self.put(url, 0, self.payload)
+        resp = self.client.post(f"{url}complete/", {}, format="json")
+        self.assertEqual(resp.status_code, 422)
+        self.assertEqual(self.client.get(url).data["offset"], 0)
+
+    def test_incomplete_upload_cannot_finish(self):
+        url, _ = self.start()
+        self.put(url, 0, self.payload[:10])
+        self.assertEqual(self.client.post(f"{url}complete/", {}, format="json").status_code, 409)
+
+
+    def test_concurrent_writer_gets_conflict(self):
+        url, upload_id = self.start()
+        upload = Upload.objects.get(pk=upload_id)
+        with locked_partial(upload):
+            resp = self.put(url, 0, self.payload[:10])
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(self.client.get(url).data["offset"], 0)
+        self.assertEqual(self.client.post(f"{url}complete/", {}, format="json").status_code, 409)
+
+    def test_chunk_not_confirmed_when_offset_moved(self):
+        url, upload_id = self.start()
+
+        def overtaken(fh, upload, stream, offset):
+            # another writer confirmed its chunk while this one was streaming
+            Upload.objects.filter(pk=upload.pk).update(offset=100)
+            return 10
+
+        with patch("chat.views.write_chunk", overtaken):
+            resp = self.put(url, 0, self.payload[:10])
+        self.assertEqual(resp.status_code, 409)
+        self.assertEqual(resp.data["offset"], 100)
+
+    def test_expire_stale_uploads(self):
+        stale_url, stale_id = self.start()
+        self.put(stale_url, 0, self.payload[:10])
+        fresh_url, fresh_id = self.start()
+        self.put(fresh_url, 0, self.payload[:10])
+        Upload.objects.filter(pk=stale_id).update(updated_at=timezone.now() - timedelta(days=2))
+        stray = partial_path(Upload(pk=uuid.uuid4()))
+        stray.write_bytes(b"x")
+        old = time.time() - 2 * 86400
+        os.utime(stray, (old, old))
+
+        out = io.StringIO()
+        call_command("expire_uploads", stdout=out)
+        self.assertIn("deleted 1 expired uploads, 1 stray partial files", out.getvalue())
+        self.assertEqual(list(Upload.objects.values_list("pk", flat=True)), [uuid.UUID(fresh_id)])
+        self.assertFalse(partial_path(Upload(pk=stale_id)).exists())
+        self.assertFalse(stray.exists())
+        self.assertEqual(self.put(fresh_url, 10, self.payload[10:20]).data["offset"], 20)
+
+    def test_expire_unattached_completed_uploads(self):
+        unused_url, _ = self.start()
+        self.put(unused_url, 0, self.payload[::-1])
+        self.client.post(f"{unused_url}complete/", {}, format="json")
+        sent_url, sent_id = self.start()
+        self.put(sent_url, 0, self.payload)
+        self.client.post(f"{sent_url}complete/", {}, format="json")
+        self.client.post(
+            "/api/chat/messages/send/", {"conversation_id": self.conv.id, "upload_ids": [sent_id]}, format="json"
+        )
+        Upload.objects.update(updated_at=timezone.now() - timedelta(days=2))
+        Blob.objects.update(updated_at=timezone.now() - timedelta(days=2))
+        call_command("collect_blobs", "--grace-seconds", "0", stdout=io.StringIO())
+        self.assertEqual(Blob.objects.count(), 2)
+
+        out = io.StringIO()
+        call_command("expire_uploads", stdout=out)
+        self.assertIn("deleted 1 expired uploads", out.getvalue())
+        self.assertEqual(list(Upload.objects.values_list("pk", flat=True)), [uuid.UUID(sent_id)])
+        # the unsent upload's blob is no longer pinned; the attached one stays
+        call_command("collect_blobs", "--grace-seconds", "0", stdout=io.StringIO())
+        self.assertEqual(list(Blob.objects.values_list("sha256", flat=True)), [hashlib.sha256(self.payload).hexdigest()])
+
+
+class AttachmentDownloadTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.tmp)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        conv = Conversation.objects.create()
+        conv.members.set([self.alice])
+        msg = Message.objects.create(conversation=conv, sender=self.alice)
+        self.body = bytes(range(256)) * 4
+        self.attachment = MessageAttachment(message=msg, content_type="video/mp4", size=len(self.body))
+        self.attachment.file.save("clip.mp4", ContentFile(self.body))
+        self.url = f"/api/chat/attachments/{self.attachment.id}/download/"
+        self.client.force_authenticate(self.alice)
+
+    def content(self, resp):
+        return b"".join(resp.streaming_content)
+
+    def test_full_download_and_serializer_url(self):
+        resp = self.client.get(self.url)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.content(resp), self.body)
+        self.assertEqual(resp["Accept-Ranges"], "bytes")
+        self.assertIn("ETag", resp)
+
+        listing = self.client.get(f"/api/chat/messages/{self.attachment.message.conversation_id}/")
+        file_url = listing.data["results"][0]["attachments"][0]["file_url"]
+        self.assertTrue(file_url.endswith(self.url))
+
+    def test_ranges(self):
+        resp = self.client.get(self.url, HTTP_RANGE="bytes=10-19")
+        self.assertEqual(resp.status_code, 206)
+        self.assertEqual(resp["Content-Range"], f"bytes 10-19/{len(self.body)}")
+        self.assertEqual(self.content(resp), self.body[10:20])
+
+        resp = self.client.get(self.url, HTTP_RANGE="bytes=-5")
+        self.assertEqual(self.content(resp), self.body[-5:])
+
+        resp = self.client.get(self.url, HTTP_RANGE=f"bytes={len(self.body)}-")
+        self.assertEqual(resp.status_code, 416)
+
+        # stale If-Range falls back to the full body
+        resp = self.client.get(self.url, HTTP_RANGE="bytes=0-1", HTTP_IF_RANGE='"stale"')
+        self.assertEqual(resp.status_code, 200)
+
+    def test_conditional_get(self):
+        etag = self.client.get(self.url)["ETag"]
+        self.assertEqual(self.client.get(self.url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    @override_settings(ATTACHMENT_SENDFILE="nginx", ATTACHMENT_ACCEL_PREFIX="/protected/")
+    def test_accel_redirect(self):
+        resp = self.client.get(self.url)
+        self.assertEqual(resp["X-Accel-Redirect"], f"/protected/{self.attachment.file.name}")
+        self.assertEqual(resp.content, b"")
+
+    def test_non_member_gets_404(self):
+        self.client.force_authenticate(User.objects.create_user("eve"))
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+
+
+@override_settings(ATTACHMENT_PREVIEW_SYNC=True)
+class AttachmentPreviewTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.tmp)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice])
+        self.client.force_authenticate(self.alice)
+
+    def image_file(self, size=(2000, 1000)):
+        from io import BytesIO
+        from django.core.files.uploadedfile import SimpleUploadedFile
+        from PIL import Image
+
+        buf = BytesIO()
+        Image.new("RGB", size, "red").save(buf, "JPEG")
+        return SimpleUploadedFile("photo.jpg", buf.getvalue(), content_type="image/jpeg")
+
+    def test_send_generates_variants_after_commit(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            resp = self.client.post(
+                "/api/chat/messages/send/",
+                {"conversation_id": self.conv.id, "file": self.image_file()},
+                format="multipart",
+            )
+        self.assertEqual(resp.status_code, 201)
+        # the response is built before the background job runs
+        self.assertEqual(resp.data["attachments"][0]["preview_status"], "pending")
+
+        listing = self.client.get(f"/api/chat/messages/{self.conv.id}/")
+        attachment = listing.data["results"][0]["attachments"][0]
+        self.assertEqual((attachment["width"], attachment["height"]), (2000, 1000))
+        self.assertTrue(attachment["placeholder"].startswith("data:image/jpeg;base64,"))
+        variants = {v["name"]: v for v in attachment["variants"]}
+        self.assertEqual((variants["thumb"]["width"], variants["thumb"]["height"]), (320, 160))
+        self.assertEqual(variants["medium"]["width"], 1280)
+
+        thumb = self.client.get(variants["thumb"]["url"])
+        self.assertEqual(thumb.status_code, 200)
+        self.assertEqual(thumb["Content-Type"], "image/jpeg")
+
+    def test_failure_after_decoding_marks_failed_and_cleans_up(self):
+        msg = Message.objects.create(conversation=self.conv, sender=self.alice)
+        image = MessageAttachment.objects.create(message=msg, file=self.image_file(), content_type="image/jpeg")
+        variants_dir = os.path.join(self.tmp, "attachments", "variants")
+
+        failures = [
+            patch.object(AttachmentVariant.objects, "bulk_create", side_effect=RuntimeError("db gone")),
+            patch("chat.previews.encode", side_effect=OSError("encoder broke")),
+        ]
+        for failure in failures:
+            MessageAttachment.objects.filter(pk=image.pk).update(preview_status=MessageAttachment.PREVIEW_PENDING)
+            with failure, self.assertLogs("chat.previews", "ERROR"):
+                generate_previews(MessageAttachment.objects.get(pk=image.pk))
+            image.refresh_from_db()
+            self.assertEqual(image.preview_status, MessageAttachment.PREVIEW_FAILED)
+            self.assertFalse(image.variants.exists())
+            leftovers = [f for _, _, files in os.walk(variants_dir) for f in files]
+            self.assertEqual(leftovers, [])
+
+    def test_backfill_command(self):
+        msg = Message.objects.create(conversation=self.conv, sender=self.alice)
+        image = MessageAttachment.objects.create(message=msg, file=self.image_file((100, 50)), content_type="image/jpeg")
+        other = MessageAttachment.objects.create(
+            message=msg, file=ContentFile(b"%PDF", name="doc.pdf"), content_type="application/pdf"
+        )
+        call_command("generate_previews", workers=1, stdout=open(os.devnull, "w"))
+
+        image.refresh_from_db()
+        other.refresh_from_db()
+        self.assertEqual(image.preview_status, MessageAttachment.PREVIEW_READY)
+        # small images still get a thumb, but no upscaled medium
+        self.assertEqual(list(image.variants.values_list("name", flat=True)), ["thumb"])
+        self.assertEqual(other.preview_status, MessageAttachment.PREVIEW_NONE)
+
+
+class CachedLookupTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice])
+        Message.objects.create(conversation=self.conv, sender=self.alice, text="hi")
+        self.token = Token.objects.create(user=self.alice).key
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {self.token}")
+        self.url = f"/api/chat/messages/{self.conv.id}/"
+
+    def count_queries(self, url=None):
+        with CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url or self.url)
+        return resp, len(ctx.captured_queries)
+
+    def test_warm_cache_skips_auth_and_membership_queries(self):
+        _, cold = self.count_queries()
+        resp, warm = self.count_queries()
+        self.assertEqual(len(resp.data["results"]), 1)
+        # token lookup and membership check now come from the cache
+        self.assertEqual(cold - warm, 2)
+        self.assertEqual(warm, 2)  # page + attachments prefetch
+
+    def test_membership_changes_invalidate(self):
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.client.get(self.url).data["results"], [])
+        self.conv.members.add(self.bob)
+        self.assertEqual(len(self.client.get(self.url).data["results"]), 1)
+        self.conv.members.remove(self.bob)
+        self.assertEqual(self.client.get(self.url).data["results"], [])
+
+    def test_logout_invalidates_token(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.assertEqual(self.client.post("/api/chat/logout/").status_code, 200)
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+    def test_deactivated_user_is_rejected(self):
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+        self.alice.is_active = False
+        self.alice.save()
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+
+class BatchSendTests(APITestCase):
+    def setUp(self):
+        self.bot = User.objects.create_user("bot", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.convs = []
+        for _ in range(2):
+            conv = Conversation.objects.create(is_group=True)
+            conv.members.set([self.bot, self.bob])
+            self.convs.append(conv)
+        self.client.force_authenticate(self.bot)
+
+    def batch(self, n):
+        return [
+            {"conversation_id": self.convs[i % 2].id, "text": f"m{i}"} for i in range(n)
+        ]
+
+    def test_batch_creates_all_and_updates_inbox(self):
+        resp = self.client.post("/api/chat/messages/send/batch/", {"messages": self.batch(5)}, format="json")
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual([m["text"] for m in resp.data["results"]], [f"m{i}" for i in range(5)])
+
+        self.client.force_authenticate(self.bob)
+        inbox = {c["id"]: c for c in self.client.get("/api/chat/inbox/").data["results"]}
+        self.assertEqual(inbox[self.convs[0].id]["unread_count"], 3)
+        self.assertEqual(inbox[self.convs[0].id]["last_message"]["text"], "m4")
+        self.assertEqual(inbox[self.convs[1].id]["unread_count"], 2)
+
+    def test_non_member_target_rejects_whole_batch(self):
+        outside = Conversation.objects.create()
+        items = self.batch(2) + [{"conversation_id": outside.id, "text": "x"}]
+        resp = self.client.post("/api/chat/messages/send/batch/", {"messages": items}, format="json")
+        self.assertEqual(resp.status_code, 400)
+        self.assertIn(2, resp.data["messages"])
+        self.assertFalse(Message.objects.exists())
+
+    def test_batch_query_count_is_flat(self):
+        def queries(n):
+            with CaptureQueriesContext(connection) as ctx:
+                self.client.post("/api/chat/messages/send/batch/", {"messages": self.batch(n)}, format="json")
+            return len(ctx.captured_queries)
+
+        queries(1)  # warm the membership cache
+        self.assertEqual(queries(4), queries(40))
+
+        with CaptureQueriesContext(connection) as ctx:
+            for item in self.batch(40):
+                self.client.post("/api/chat/messages/send/", item, format="json")
+        self.assertGreater(len(ctx.captured_queries), 10 * queries(40))
+
+
+class DirectConversationTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+
+    def create_dm(self, user, other):
+        self.client.force_authenticate(user)
+        return self.client.post("/api/chat/conversations/", {"members": [other.id]}, format="json")
+
+    def test_dm_is_created_once_per_pair(self):
+        first = self.create_dm(self.alice, self.bob)
+        self.assertEqual(first.status_code, 201)
+        again = self.create_dm(self.bob, self.alice)
+        self.assertEqual(again.status_code, 200)
+        self.assertEqual(again.data["id"], first.data["id"])
+        conv = Conversation.objects.get()
+        self.assertEqual(conv.dm_key, Conversation.make_dm_key(self.bob.id, self.alice.id))
+
+    def test_lookup_is_a_single_indexed_query(self):
+        self.create_dm(self.alice, self.bob)
+        with CaptureQueriesContext(connection) as ctx:
+            self.create_dm(self.alice, self.bob)
+        lookups = [q["sql"] for q in ctx.captured_queries if 'FROM "chat_conversation"' in q["sql"]]
+        self.assertEqual(len(lookups), 1)
+        self.assertIn('"dm_key" =', lookups[0])
+        self.assertNotIn("COUNT(", lookups[0].upper())
+
+    def test_groups_are_not_deduplicated(self):
+        self.client.force_authenticate(self.alice)
+        for _ in range(2):
+            resp = self.client.post(
+                "/api/chat/conversations/", {"is_group": True, "members": [self.bob.id]}, format="json"
+            )
+            self.assertEqual(resp.status_code, 201)
+        self.assertEqual(Conversation.objects.filter(dm_key__isnull=True).count(), 2)
+
+    def test_unknown_member_rejected(self):
+        self.client.force_authenticate(self.alice)
+        resp = self.client.post("/api/chat/conversations/", {"members": [9999]}, format="json")
+        self.assertEqual(resp.status_code, 400)
+
+
+class AsyncViewTests(CacheResetMixin, TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice, self.bob])
+        for i in range(5):
+            Message.objects.create(conversation=self.conv, sender=self.bob, text=str(i))
+        self.factory = APIRequestFactory()
+
+    def sync_list(self, **params):
+        client = APIClient()
+        client.force_authenticate(self.alice)
+        return client.get(f"/api/chat/messages/{self.conv.id}/", params).data
+
+    async def async_list(self, user, **params):
+        request = self.factory.get(f"/api/chat/messages/{self.conv.id}/", params)
+        force_authenticate(request, user)
+        resp = await AsyncMessageListView.as_view()(request, conversation_id=self.conv.id)
+        return resp.render()
+
+    async def test_list_matches_sync_view(self):
+        resp = await self.async_list(self.alice, limit=2)
+        self.assertEqual(resp.status_code, 200)
+        expected = await database_sync_to_async(self.sync_list)(limit=2)
+        self.assertEqual(json.loads(resp.content), json.loads(json.dumps(expected)))
+
+        outsider = await database_sync_to_async(User.objects.create_user)("mallory", password="pass12345")
+        resp = await self.async_list(outsider)
+        self.assertEqual(json.loads(resp.content)["results"], [])
+
+    async def test_long_poll_releases_connection_while_waiting(self):
+        last = await Message.objects.filter(conversation=self.conv).alatest("id")
+        events = []
+
+        async def wait(after, timeout):
+            # the ORM's sync thread, where the view's queries ran
+            events.append(("wait", await sync_to_async(threading.get_ident)()))
+            return []
+
+        # closing the in-memory test database is a no-op anyway, so only record it
+        close = patch.object(
+            type(connections["default"]), "close", autospec=True,
+            side_effect=lambda conn: events.append(("close", threading.get_ident())),
+        )
+        with close, patch("chat.async_views.await_messages", side_effect=wait):
+            resp = await self.async_list(self.alice, after_id=last.id, wait=5)
+        self.assertEqual(json.loads(resp.content)["results"], [])
+        self.assertEqual([kind for kind, _ in events], ["close", "wait"])
+        self.assertEqual(events[0][1], events[1][1])
+
+    async def test_send_creates_message(self):
+        request = self.factory.post(
+            "/api/chat/messages/send/", {"conversation_id": self.conv.id, "text": "async"}, format="json"
+        )
+        force_authenticate(request, self.alice)
+        resp = await AsyncMessageSendView.as_view()(request)
+        self.assertEqual(resp.status_code, 201)
+
+        message = await Message.objects.aget(pk=resp.data["id"])
+        self.assertEqual(message.text, "async")
+        conv = await Conversation.objects.aget(pk=self.conv.id)
+        self.assertEqual(conv.last_message_id, message.id)
+
+
+class AsgiStreamingTests(CacheResetMixin, TransactionTestCase):
+    """Streamed responses through the real ASGI app: sent block by block, never collected first."""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.tmp)
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.token = Token.objects.create(user=self.alice).key
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice])
+
+    async def get(self, path, query="", headers=()):
+        scope = {
+            "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+            "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": query.encode(),
+            "root_path": "", "client": ("127.0.0.1", 50000), "server": ("testserver", 80),
+            "headers": [
+                (b"host", b"testserver"), (b"authorization", f"Token {self.token}".encode()), *headers
+            ],
+        }
+        communicator = ApplicationCommunicator(application, scope)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            await communicator.send_input({"type": "http.request", "body": b""})
+            start = await communicator.receive_output(5)
+            parts = []
+            while True:
+                message = await communicator.receive_output(5)
+                parts.append(message.get("body", b""))
+                if not message.get("more_body"):
+                    break
+        await communicator.wait()
+        buffered = [w for w in caught if "StreamingHttpResponse must consume" in str(w.message)]
+        self.assertEqual(buffered, [])
+        return start["status"], dict(start["headers"]), [part for part in parts if part]
+
+    async def test_attachment_download_is_streamed(self):
+        body = os.urandom(3 * 64 * 1024 + 10)
+
+        def create():
+            msg = Message.objects.create(conversation=self.conv, sender=self.alice)
+            attachment = MessageAttachment(message=msg, content_type="video/mp4", size=len(body))
+            attachment.file.save("clip.mp4", ContentFile(body))
+            return attachment.id
+
+        attachment_id = await database_sync_to_async(create)()
+        path = f"/api/chat/attachments/{attachment_id}/download/"
+        status_code, headers, parts = await self.get(path)
+        self.assertEqual(status_code, 200)
+        self.assertEqual(headers[b"Content-Length"], str(len(body)).encode())
+        self.assertEqual(len(parts), 4)
+        self.assertEqual(b"".join(parts), body)
+
+        status_code, headers, parts = await self.get(path, headers=[(b"range", b"bytes=10-")])
+        self.assertEqual(status_code, 206)
+        self.assertEqual(b"".join(parts), body[10:])
+
+
+    async def test_sync_is_streamed(self):
+        def create():
+            Message.objects.bulk_create(
+                Message(conversation=self.conv, sender=self.alice, text=f"{i} " + "x" * 2000) for i in range(100)
+            )
+
+        await database_sync_to_async(create)()
+        status_code, _, parts = await self.get("/api/chat/sync/")
+        self.assertEqual(status_code, 200)
+        self.assertGreater(len(parts), 1)
+        data = json.loads(b"".join(parts))
+        self.assertEqual(len(data["messages"]), 100)
+        self.assertEqual(data["conversation_ids"], [self.conv.id])
+
+
+    async def test_export_is_streamed(self):
+        def create():
+            Message.objects.bulk_create(
+                Message(conversation=self.conv, sender=self.alice, text=f"{i} " + "x" * 100) for i in range(3000)
+            )
+
+        await database_sync_to_async(create)()
+        status_code, headers, parts = await self.get(f"/api/chat/conversations/{self.conv.id}/export/")
+        self.assertEqual(status_code, 200)
+        self.assertEqual(headers[b"Content-Type"], b"application/x-ndjson")
+        self.assertGreater(len(parts), 4)
+        rows = b"".join(parts).decode().splitlines()
+        self.assertEqual(len(rows), 3000)
+        self.assertEqual(json.loads(rows[-1])["text"], "2999 " + "x" * 100)
+
+
+@override_settings(DATABASE_REPLICAS=["replica1"])
+class ReplicaRoutingTests(APITestCase):
+    def setUp(self):
+        self.router = ReplicaRouter()
+
+    def test_reads_use_replica_unless_pinned(self):
+        self.assertEqual(self.router.db_for_read(Message), "replica1")
+        self.assertEqual(self.router.db_for_write(Message), "default")
+        with use_primary():
+            self.assertEqual(self.router.db_for_read(Message), "default")
+        self.assertFalse(self.router.allow_migrate("replica1", "chat"))
+
+    def test_cache_fills_read_from_primary(self):
+        with use_primary():
+            alice = User.objects.create_user("alice")
+            conv = Conversation.objects.create()
+            conv.members.set([alice])
+        # "replica1" is not a configured database: any fill routed to it would fail
+        self.assertEqual(get_conversation_ids(alice.id), {conv.id})
+        self.assertEqual(get_contact_ids(alice.id), {alice.id})
+        self.client.force_authenticate(alice)
+        self.assertEqual(self.client.get("/api/chat/conversations/").status_code, 200)
+
+    def test_write_pins_client_to_primary(self):
+        seen = []
+
+        def view(request):
+            seen.append(self.router.db_for_read(Message))
+            return HttpResponse(status=201 if request.method == "POST" else 200)
+
+        middleware = ReplicaPinningMiddleware(view)
+        factory = RequestFactory()
+        alice, bob = {"HTTP_AUTHORIZATION": "Token a"}, {"HTTP_AUTHORIZATION": "Token b"}
+
+        middleware(factory.get("/", **alice))
+        middleware(factory.post("/", **alice))
+        middleware(factory.get("/", **alice))
+        middleware(factory.get("/", **bob))
+        self.assertEqual(seen, ["replica1", "default", "default", "replica1"])
+
+
+@skipUnless(settings.DATABASE_REPLICAS, "run with DATABASE_REPLICA_URLS set")
+class ReplicaEndToEndTests(CacheResetMixin, TransactionTestCase):
+    # DATABASE_REPLICA_URLS=sqlite:///replica.sqlite3 python manage.py test chat.tests.ReplicaEndToEndTests
+    databases = "__all__"
+
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice])
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f"Token {Token.objects.create(user=self.alice).key}")
+        self.url = f"/api/chat/messages/{self.conv.id}/"
+
+    def replica_queries(self, method, *args, **kwargs):
+        replica = connections[settings.DATABASE_REPLICAS[0]]
+        with CaptureQueriesContext(replica) as ctx:
+            resp = getattr(self.client, method)(*args, **kwargs)
+        return resp, len(ctx.captured_queries)
+
+    def test_history_reads_replica_until_a_send(self):
+        _, count = self.replica_queries("get", self.url)
+        self.assertGreater(count, 0)
+
+        resp, count = self.replica_queries(
+            "post", "/api/chat/messages/send/", {"conversation_id": self.conv.id, "text": "hi"}, format="json"
+        )
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(count, 0)
+
+        resp, count = self.replica_queries("get", self.url)
+        self.assertEqual(count, 0)
+        self.assertEqual(resp.data["results"][-1]["text"], "hi")
+
+
+class LongPollTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice, self.bob])
+        self.other = Conversation.objects.create(is_group=True, name="other")
+        self.other.members.set([self.alice, self.bob])
+        self.hidden = Conversation.objects.create(is_group=True, name="hidden")
+        self.hidden.members.set([self.bob])
+        self.first = Message.objects.create(conversation=self.conv, sender=self.bob, text="first")
+        self.client.force_authenticate(self.alice)
+
+    def arrive(self, conv, text):
+        # what a send from another request looks like to the waiting one
+        def wait(after, timeout):
+            message = Message.objects.create(conversation=conv, sender=self.bob, text=text)
+            notify_message(conv.id, message.id)
+            return [conv.id]
+        return patch("chat.views.wait_for_messages", side_effect=wait)
+
+    def test_local_notifier_wakes_waiter(self):
+        notifier = LocalNotifier()
+        threading.Timer(0.05, notifier.notify, args=(1, 10)).start()
+        started = time.monotonic()
+        self.assertEqual(notifier.wait({1: 5, 2: 0}, timeout=5), [1])
+        self.assertLess(time.monotonic() - started, 2)
+
+        # already newer than the client's position: no waiting at all
+        self.assertEqual(notifier.wait({1: 9}, timeout=5), [1])
+        self.assertEqual(notifier.wait({1: 10}, timeout=0.05), [])
+
+    async def test_async_waiters_hold_no_threads(self):
+        notifier = LocalNotifier()
+        threads = threading.active_count()
+        waiting = [asyncio.ensure_future(notifier.await_news({1: 5, 2: 0}, timeout=5)) for _ in range(50)]
+        await asyncio.sleep(0.05)
+        self.assertLessEqual(threading.active_count(), threads + 1)
+        # woken from another thread, as the sending request's on_commit does
+        threading.Timer(0.05, notifier.notify, args=(1, 10)).start()
+        self.assertEqual(await asyncio.gather(*waiting), [[1]] * 50)
+        self.assertEqual(notifier.waiters, {})
+        self.assertEqual(await notifier.await_news({1: 10}, timeout=0.05), [])
+
+    def test_wait_requeries_once_on_notification(self):
+        url = f"/api/chat/messages/{self.conv.id}/"
+        with self.arrive(self.conv, "late") as waited, CaptureQueriesContext(connection) as ctx:
+            resp = self.client.get(url, {"after_id": self.first.id, "wait": 20})
+        self.assertEqual(waited.call_args.args, ({self.conv.id: self.first.id}, 20))
+        self.assertEqual([m["text"] for m in resp.data["results"]], ["late"])
+        message_selects = [q for q in ctx.captured_queries if q["sql"].startswith('SELECT "chat_message"')]
+        self.assertEqual(len(message_selects), 2)
+
+    def test_wait_is_skipped_when_there_is_news_or_no_forward_cursor(self):
+        url = f"/api/chat/messages/{self.conv.id}/"
+        with patch("chat.views.wait_for_messages") as waited:
+            self.client.get(url, {"after_id": 0, "wait": 5})
+            self.client.get(url, {"wait": 5})
+            self.client.get(url, {"before_id": self.first.id, "wait": 5})
+        waited.assert_not_called()
+
+    @override_settings(CHAT_LONGPOLL_MAX_WAIT=0.05)
+    def test_wait_times_out_with_empty_page(self):
+        resp = self.client.get(f"/api/chat/messages/{self.conv.id}/", {"after_id": self.first.id, "wait": 60})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["results"], [])
+
+    def test_multi_conversation_poll(self):
+        Message.objects.create(conversation=self.hidden, sender=self.bob, text="secret")
+        second = Message.objects.create(conversation=self.other, sender=self.bob, text="second")
+        after = f"{self.conv.id}:0,{self.other.id}:0,{self.hidden.id}:0"
+
+        resp = self.client.get("/api/chat/messages/poll/", {"after": after})
+        self.assertEqual([m["text"] for m in resp.data["results"]], ["first", "second"])
+        self.assertEqual(resp.data["after"], {str(self.conv.id): self.first.id, str(self.other.id): second.id})
+        self.assertFalse(resp.data["has_more"])
+
+        after = ",".join(f"{c}:{i}" for c, i in resp.data["after"].items())
+        with self.arrive(self.other, "third"):
+            resp = self.client.get("/api/chat/messages/poll/", {"after": after, "wait": 10})
+        self.assertEqual([m["text"] for m in resp.data["results"]], ["third"])
+
+    def test_poll_rejects_bad_after(self):
+        for after in ["", "x:1", f"{self.conv.id}:y"]:
+            resp = self.client.get("/api/chat/messages/poll/", {"after": after})
+            self.assertEqual(resp.status_code, 400)
+
+
+class DeltaSyncTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.dm = Conversation.objects.create()
+        self.dm.members.set([self.alice, self.bob])
+        self.team = Conversation.objects.create(is_group=True, name="team")
+        self.team.members.set([self.alice, self.bob])
+        self.hidden = Conversation.objects.create(is_group=True, name="hidden")
+        self.hidden.members.set([self.bob])
+        self.ids = []
+        for i in range(6):
+            conv = (self.dm, self.team, self.hidden)[i % 3]
+            self.ids.append(Message.objects.create(conversation=conv, sender=self.bob, text=str(i)).id)
+        self.visible = [mid for i, mid in enumerate(self.ids) if i % 3 != 2]
+        self.client.force_authenticate(self.alice)
+
+    def sync(self, method="get", **params):
+        resp = getattr(self.client, method)("/api/chat/sync/", params, format="json" if method == "post" else None)
+        self.assertEqual(resp.status_code, 200)
+        return json.loads(b"".join(resp.streaming_content))
+
+    def test_cold_start_returns_everything(self):
+        data = self.sync()
+        self.assertEqual(data["conversation_ids"], [self.dm.id, self.team.id])
+        self.assertEqual([c["id"] for c in data["conversations"]], [self.dm.id, self.team.id])
+        self.assertEqual([m["id"] for m in data["messages"]], self.visible)
+        self.assertFalse(data["has_more"])
+
+    def test_cursor_returns_only_changes(self):
+        cursor = self.sync()["cursor"]
+        new = Message.objects.create(conversation=self.team, sender=self.bob, text="new")
+        carol = User.objects.create_user("carol", password="pass12345")
+        self.dm.members.add(carol)
+
+        data = self.sync(cursor=cursor)
+        self.assertEqual([m["id"] for m in data["messages"]], [new.id])
+        self.assertEqual([c["id"] for c in data["conversations"]], [self.dm.id])
+
+        data = self.sync(cursor=data["cursor"])
+        self.assertEqual((data["messages"], data["conversations"]), ([], []))
+
+    def test_after_map_and_since(self):
+        data = self.sync(method="post", after={str(self.dm.id): self.ids[3]}, since=self.ids[1])
+        self.assertEqual([m["id"] for m in data["messages"]], [self.ids[4]])
+
+        data = self.sync(after=f"{self.dm.id}:0", since=self.ids[-1])
+        self.assertEqual([m["id"] for m in data["messages"]], [self.ids[0], self.ids[3]])
+
+    @override_settings(CHAT_SYNC_MAX_MESSAGES=3, CHAT_SYNC_BATCH_SIZE=2)
+    def test_capped_pages_resume_without_gaps(self):
+        for i in range(5):
+            self.visible.append(Message.objects.create(conversation=self.dm, sender=self.bob, text=f"x{i}").id)
+
+        seen, pages, params = [], [], {}
+        while True:
+            data = self.sync(**params)
+            seen += [m["id"] for m in data["messages"]]
+            pages.append(len(data["messages"]))
+            if not data["has_more"]:
+                break
+            params = {"cursor": data["cursor"]}
+        self.assertEqual(seen, self.visible)
+        self.assertEqual(pages, [3, 3, 3])
+
+    @override_settings(CHAT_SYNC_MAX_MESSAGES=1, CHAT_SYNC_BATCH_SIZE=1)
+    def test_resume_with_position_below_since(self):
+        newest = Message.objects.create(conversation=self.team, sender=self.bob, text="late").id
+        seen, params = [], {"after": f"{self.dm.id}:0", "since": self.ids[4]}
+        while True:
+            data = self.sync(**params)
+            seen += [m["id"] for m in data["messages"]]
+            if not data["has_more"]:
+                break
+            params = {"cursor": data["cursor"]}
+        self.assertEqual(seen, [self.ids[0], self.ids[3], newest])
+
+    @override_settings(CHAT_SYNC_MAX_BYTES=1)
+    def test_byte_cap(self):
+        data = self.sync()
+        self.assertEqual(len(data["messages"]), 1)
+        self.assertTrue(data["has_more"])
+
+    def test_query_count_independent_of_conversation_count(self):
+        def count_queries():
+            cache.clear()
+            with CaptureQueriesContext(connection) as ctx:
+                self.sync()
+            return len(ctx.captured_queries)
+
+        before = count_queries()
+        for i in range(15):
+            conv = Conversation.objects.create(is_group=True, name=f"g{i}")
+            conv.members.set([self.alice, self.bob])
+            Message.objects.create(conversation=conv, sender=self.bob, text="hi")
+        self.assertEqual(count_queries(), before)
+
+    def test_invalid_cursor(self):
+        resp = self.client.get("/api/chat/sync/", {"cursor": "nope"})
+        self.assertEqual(resp.status_code, 400)
+
+
+class ConversationExportTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice, self.bob])
+        self.ids = [
+            Message.objects.create(conversation=self.conv, sender=self.bob, text=f"سلام {i}").id
+            for i in range(5)
+        ]
+        MessageAttachment.objects.create(
+            message_id=self.ids[1], file="attachments/a.pdf", content_type="application/pdf", size=42
+        )
+        self.url = f"/api/chat/conversations/{self.conv.id}/export/"
+        self.client.force_authenticate(self.alice)
+
+    def body(self, resp):
+        self.assertEqual(resp.status_code, 200)
+        return b"".join(resp.streaming_content)
+
+    def test_ndjson(self):
+        resp = self.client.get(self.url)
+        self.assertEqual(resp["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in self.body(resp).decode().splitlines()]
+        self.assertEqual([r["id"] for r in rows], self.ids)
+        self.assertEqual(rows[0]["text"], "سلام 0")
+        self.assertEqual(rows[0]["sender_username"], "bob")
+        self.assertEqual(rows[1]["attachments"][0]["size"], 42)
+        self.assertEqual(rows[1]["attachments"][0]["file"], "attachments/a.pdf")
+
+    def test_csv_and_gzip(self):
+        text = self.body(self.client.get(self.url, {"as": "csv"})).decode()
+        rows = list(csv.DictReader(io.StringIO(text)))
+        self.assertEqual([int(r["id"]) for r in rows], self.ids)
+        self.assertEqual(json.loads(rows[1]["attachments"])[0]["content_type"], "application/pdf")
+
+        resp = self.client.get(self.url, {"as": "csv", "gzip": "1"})
+        self.assertIn(".csv.gz", resp["Content-Disposition"])
+        self.assertEqual(gzip.decompress(self.body(resp)).decode(), text)
+
+        self.assertEqual(self.client.get(self.url, {"as": "xml"}).status_code, 400)
+
+    def test_blob_attachment_keeps_its_filename(self):
+        sha = "ab" * 32
+        blob = Blob.objects.create(sha256=sha, size=7, file=f"blobs/ab/ab/{sha}", ref_count=1)
+        MessageAttachment.objects.create(
+            message_id=self.ids[3], blob=blob, file=blob.file.name, name="گزارش.pdf", size=7
+        )
+        rows = [json.loads(line) for line in self.body(self.client.get(self.url)).decode().splitlines()]
+        self.assertEqual(rows[3]["attachments"][0]["name"], "گزارش.pdf")
+        self.assertEqual(rows[3]["attachments"][0]["file"], f"blobs/ab/ab/{sha}")
+
+        text = self.body(self.client.get(self.url, {"as": "csv"})).decode()
+        rows = list(csv.DictReader(io.StringIO(text)))
+        self.assertEqual(rows[3]["attachment_names"], "گزارش.pdf")
+        self.assertEqual(json.loads(rows[3]["attachments"])[0]["name"], "گزارش.pdf")
+        self.assertEqual(rows[0]["attachment_names"], "")
+
+    def test_only_members_or_staff(self):
+        carol = User.objects.create_user("carol", password="pass12345")
+        self.client.force_authenticate(carol)
+        self.assertEqual(self.client.get(self.url).status_code, 404)
+        carol.is_staff = True
+        carol.save()
+        self.assertEqual(self.client.get(self.url).status_code, 200)
+
+    def test_batches_are_keyset_queries(self):
+        with CaptureQueriesContext(connection) as ctx:
+            rows = list(export_rows(self.conv.id, batch_size=2))
+        self.assertEqual(len(rows), 5)
+        # three message batches, each with one attachment lookup
+        self.assertEqual(len(ctx.captured_queries), 6)
+        self.assertNotIn("OFFSET", " ".join(q["sql"] for q in ctx.captured_queries).upper())
+
+    def test_management_command(self):
+        path = os.path.join(tempfile.mkdtemp(), "out.ndjson.gz")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path), ignore_errors=True)
+        call_command("export_conversation", self.conv.id, "--gzip", "-o", path, "--batch-size", "2", stderr=io.StringIO())
+        with gzip.open(path, "rt") as fh:
+            self.assertEqual([json.loads(line)["id"] for line in fh], self.ids)
+
+
+class SeedAndBenchmarkTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.tmp)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def seed(self, *args):
+        call_command(
+            "seed_chat", "--users", "12", "--dms", "15", "--groups", "3", "--group-size", "3", "6",
+            "--messages", "600", "--attachment-ratio", "0.1", "--batch-size", "100", *args,
+            stdout=io.StringIO(),
+        )
+
+    def test_seed_is_skewed_and_consistent(self):
+        self.seed()
+        self.assertEqual(User.objects.filter(username__startswith="seed_").count(), 12)
+        self.assertEqual(Conversation.objects.count(), 18)
+        self.assertEqual(Message.objects.count(), 600)
+        self.assertTrue(MessageAttachment.objects.exists())
+
+        counts = sorted(Conversation.objects.annotate(n=Count("messages")).values_list("n", flat=True))
+        self.assertGreater(counts[-1], 5 * counts[len(counts) // 2])
+
+        for conv in Conversation.objects.exclude(last_message=None):
+            self.assertEqual(conv.last_message_id, conv.messages.order_by("-id").first().id)
+        for conv in Conversation.objects.filter(is_group=False).prefetch_related("members"):
+            self.assertEqual(conv.dm_key, Conversation.make_dm_key(*[m.id for m in conv.members.all()]))
+
+        with self.assertRaises(CommandError):
+            self.seed()
+        self.seed("--flush")
+        self.assertEqual(User.objects.filter(username__startswith="seed_").count(), 12)
+
+    def test_benchmark_reports_and_compares(self):
+        self.seed()
+        messages = Message.objects.count()
+        out = os.path.join(self.tmp, "bench.json")
+        call_command(
+            "benchmark", "--iterations", "2", "--warmup", "0", "--output", out,
+            stdout=io.StringIO(), stderr=io.StringIO(),
+        )
+        with open(out) as fh:
+            report = json.load(fh)
+        self.assertEqual(set(report["scenarios"]), set(SCENARIOS))
+        for name, result in report["scenarios"].items():
+            self.assertEqual(result["errors"], 0, name)
+            self.assertEqual(result["requests"], 2)
+            self.assertGreater(result["queries_max"], 0)
+        # what the benchmark created is removed again
+        self.assertEqual(Message.objects.count(), messages)
+        self.assertFalse(User.objects.filter(username__startswith="bench_").exists())
+
+        baseline = {name: dict(result, p95_ms=0.001, queries_max=0) for name, result in report["scenarios"].items()}
+        self.assertEqual(len(compare(report["scenarios"], baseline, 0.2)), 2 * len(SCENARIOS))
+        self.assertEqual(compare(report["scenarios"], report["scenarios"], 0.2), [])
+
+    def test_payload_benchmark(self):
+        self.seed()
+        out = io.StringIO()
+        call_command("benchmark_payloads", "--iterations", "2", "--limit", "20", stdout=out, stderr=io.StringIO())
+        report = json.loads(out.getvalue())
+        for dataset in ("message_list", "inbox"):
+            variants = report[dataset]["variants"]
+            self.assertEqual(variants["orjson"]["bytes"], variants["drf_json"]["bytes"])
+            self.assertLess(variants["compact_orjson"]["bytes"], variants["drf_json"]["bytes"])
+            self.assertLess(variants["compact_msgpack"]["bytes"], variants["compact_orjson"]["bytes"])
+
+
+@override_settings(METRICS_SAMPLE_RATE=1.0, METRICS_SLOW_REQUEST_MS=60000)
+class MetricsTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice])
+        Message.objects.create(conversation=self.conv, sender=self.alice, text="hi")
+        self.client.force_authenticate(self.alice)
+        self.url = f"/api/chat/messages/{self.conv.id}/"
+
+    def sample(self, line_prefix):
+        for line in render_metrics().splitlines():
+            if line.startswith(line_prefix):
+                return float(line.rsplit(" ", 1)[1])
+        return 0.0
+
+    def test_records_view_db_and_serializer_metrics(self):
+        labels = '{view="message-list",method="GET"}'
+        requests = self.sample('http_requests_total{view="message-list",method="GET",status="200"}')
+        queries = self.sample(f"db_queries_per_request_sum{labels}")
+        serialized = self.sample(f"serializer_time_seconds_count{labels}")
+
+        self.client.get(self.url)
+        self.assertEqual(self.sample('http_requests_total{view="message-list",method="GET",status="200"}'), requests + 1)
+        self.assertGreater(self.sample(f"db_queries_per_request_sum{labels}"), queries)
+        self.assertEqual(self.sample(f"serializer_time_seconds_count{labels}"), serialized + 1)
+        self.assertGreater(self.sample(f"http_response_size_bytes_sum{labels}"), 0)
+
+    def test_unsampled_requests_skip_the_breakdown(self):
+        labels = '{view="message-list",method="GET"}'
+        queries = self.sample(f"db_queries_per_request_count{labels}")
+        durations = self.sample(f"http_request_duration_seconds_count{labels}")
+        with override_settings(METRICS_SAMPLE_RATE=0.0):
+            self.client.get(self.url)
+        self.assertEqual(self.sample(f"db_queries_per_request_count{labels}"), queries)
+        self.assertEqual(self.sample(f"http_request_duration_seconds_count{labels}"), durations + 1)
+
+    @override_settings(METRICS_SLOW_REQUEST_MS=0)
+    def test_slow_request_log_lists_queries(self):
+        with self.assertLogs("core.metrics", "WARNING") as logs:
+            self.client.get(self.url)
+        self.assertIn("view=message-list", logs.output[0])
+        self.assertIn("SELECT", logs.output[0])
+
+    @override_settings(METRICS_TOKEN="s3cret")
+    def test_metrics_endpoint_access(self):
+        resp = self.client.get("/metrics")
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("# TYPE http_request_duration_seconds histogram", resp.content.decode())
+
+        self.assertEqual(self.client.get("/metrics", REMOTE_ADDR="10.0.0.9").status_code, 403)
+        resp = self.client.get("/metrics", REMOTE_ADDR="10.0.0.9", HTTP_AUTHORIZATION="Bearer s3cret")
+        self.assertEqual(resp.status_code, 200)
+
+
+class MessagePartitioningTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice])
+        self.client.force_authenticate(self.alice)
+
+    @skipUnless(connection.vendor != "postgresql", "plain-table behaviour")
+    def test_commands_are_noops_without_postgres(self):
+        self.assertFalse(partitions.is_partitioned(connection))
+        self.assertEqual(partitions.ensure_partitions(connection), [])
+        for command in ("create_message_partitions", "archive_message_partitions"):
+            err = io.StringIO()
+            call_command(command, stdout=io.StringIO(), stderr=err)
+            self.assertIn("nothing to do", err.getvalue())
+
+    @skipUnless(connection.vendor == "postgresql", "needs PostgreSQL")
+    def test_messages_span_partitions(self):
+        self.assertTrue(partitions.is_partitioned(connection))
+        first = Message.objects.create(conversation=self.conv, sender=self.alice, text="old")
+        current = next(p for p in partitions.list_partitions(connection) if p.end > first.id)
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT setval(pg_get_serial_sequence('chat_message', 'id'), %s)", [current.end])
+        partitions.ensure_partitions(connection, ahead=1)
+
+        resp = self.client.post("/api/chat/messages/send/", {"conversation_id": self.conv.id, "text": "new"}, format="json")
+        self.assertEqual(resp.status_code, 201)
+        self.assertGreater(resp.data["id"], current.end)
+
+        resp = self.client.get(f"/api/chat/messages/{self.conv.id}/")
+        self.assertEqual([m["text"] for m in resp.data["results"]], ["old", "new"])
+        self.assertIn(current, partitions.cold_partitions(connection, timezone.now() + timedelta(days=1)))
+
+
+class ListCachingTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345", first_name="Alice")
+        self.bob = User.objects.create_user("bob", password="pass12345", last_name="Builder")
+        self.carol = User.objects.create_user("carol", password="pass12345")
+        self.conv = Conversation.objects.create(is_group=True, name="team")
+        self.conv.members.set([self.alice, self.bob])
+        self.client.force_authenticate(self.alice)
+
+    def get(self, url, etag=None, **params):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client.get(url, params, **headers)
+
+    def test_conversation_list_versions_are_per_user(self):
+        alice_etag = self.get("/api/chat/conversations/")["ETag"]
+        self.client.force_authenticate(self.carol)
+        carol_etag = self.get("/api/chat/conversations/")["ETag"]
+        self.assertNotEqual(alice_etag, carol_etag)
+
+        # bob joins a conversation carol is not in: carol's list is unchanged
+        Conversation.objects.create(is_group=True).members.set([self.bob])
+        self.assertEqual(self.get("/api/chat/conversations/", carol_etag).status_code, 304)
+        self.client.force_authenticate(self.alice)
+        self.assertEqual(self.get("/api/chat/conversations/", alice_etag).status_code, 304)
+
+        self.conv.name = "renamed"
+        self.conv.save()
+        resp = self.get("/api/chat/conversations/", alice_etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.data["results"][0]["name"], "renamed")
+
+        self.conv.members.add(self.carol)
+        self.client.force_authenticate(self.carol)
+        resp = self.get("/api/chat/conversations/", carol_etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual([c["id"] for c in resp.data["results"]], [self.conv.id])
+
+
+class BlobStorageTests(APITestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=self.tmp, CHUNKED_UPLOAD_DIR=f"{self.tmp}/partial")
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.carol = User.objects.create_user("carol", password="pass12345")
+        self.conv = Conversation.objects.create(is_group=True)
+        self.conv.members.set([self.alice, self.bob])
+        self.other = Conversation.objects.create()
+        self.other.members.set([self.bob, self.carol])
+        self.payload = b"same bytes " * 500
+        self.sha = hashlib.sha256(self.payload).hexdigest()
+
+    def send_file(self, user, conv, name="report.pdf"):
+        self.client.force_authenticate(user)
+        resp = self.client.post(
+            "/api/chat/messages/send/",
+            {"conversation_id": conv.id, "file": ContentFile(self.payload, name=name)},
+            format="multipart",
+        )
+        self.assertEqual(resp.status_code, 201)
+        return MessageAttachment.objects.get(message_id=resp.data["id"])
+
+    def send_by_hash(self, user, conv, sha256):
+        self.client.force_authenticate(user)
+        return self.client.post(
+            "/api/chat/messages/send/",
+            {"conversation_id": conv.id, "blobs": [{"sha256": sha256, "name": "fwd.pdf"}]},
+            format="json",
+        )
+
+    def test_identical_uploads_share_one_blob(self):
+        first = self.send_file(self.alice, self.conv)
+        second = self.send_file(self.carol, self.other, name="copy.pdf")
+        blob = Blob.objects.get()
+        self.assertEqual((blob.sha256, blob.ref_count), (self.sha, 2))
+        self.assertEqual(first.file.name, second.file.name)
+        self.assertEqual((first.name, second.name), ("report.pdf", "copy.pdf"))
+
+        self.client.force_authenticate(self.carol)
+        resp = self.client.get(f"/api/chat/attachments/{second.id}/download/", {"download": 1})
+        self.assertIn('filename="copy.pdf"', resp["Content-Disposition"])
+        self.assertEqual(b"".join(resp.streaming_content), self.payload)
+
+    def test_chunked_upload_of_known_content_reuses_blob(self):
+        self.send_file(self.alice, self.conv)
+        resp = self.client.post(
+            "/api/chat/uploads/", {"filename": "again.pdf", "size": len(self.payload)}, format="json"
+        )
+        url = f"/api/chat/uploads/{resp.data['id']}/"
+        self.client.put(url, data=self.payload, content_type="application/octet-stream", HTTP_UPLOAD_OFFSET="0")
+        self.assertEqual(self.client.post(f"{url}complete/", {}, format="json").status_code, 200)
+        self.assertEqual(Upload.objects.get().blob, Blob.objects.get())
+        self.assertEqual(os.listdir(f"{self.tmp}/partial"), [])
+
+    def test_send_by_hash_needs_access_to_the_blob(self):
+        self.send_file(self.alice, self.conv)
+
+        # bob sees the file in a shared conversation, so he can forward it
+        self.client.force_authenticate(self.bob)
+        self.assertEqual(self.client.get(f"/api/chat/blobs/{self.sha}/").data["size"], len(self.payload))
+        resp = self.send_by_hash(self.bob, self.other, self.sha)
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.data["attachments"][0]["name"], "fwd.pdf")
+        self.assertEqual(Blob.objects.get().ref_count, 2)
+
+        # knowing the hash is not enough
+        outsider = User.objects.create_user("dave", password="pass12345")
+        alone = Conversation.objects.create()
+        alone.members.set([outsider])
+        self.client.force_authenticate(outsider)
+        self.assertEqual(self.client.get(f"/api/chat/blobs/{self.sha}/").status_code, 404)
+        resp = self.send_by_hash(outsider, alone, self.sha)
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.data["blobs"]["missing"], [self.sha])
+
+    def test_collect_blobs_removes_unreferenced(self):
+        attachment = self.send_file(self.alice, self.conv)
+        path = os.path.join(self.tmp, attachment.file.name)
+        stray = os.path.join(self.tmp, "blobs", "ab", "cd", "ab" + "0" * 62)
+        os.makedirs(os.path.dirname(stray))
+        open(stray, "wb").close()
+
+        call_command("collect_blobs", "--grace-seconds", "0", "--scan-storage", stdout=io.StringIO())
+        self.assertTrue(os.path.exists(path))
+        self.assertFalse(os.path.exists(stray))
+
+        attachment.message.delete()
+        self.assertEqual(Blob.objects.get().ref_count, 0)
+        call_command("collect_blobs", "--grace-seconds", "3600", stdout=io.StringIO())
+        self.assertTrue(Blob.objects.exists())
+        call_command("collect_blobs", "--grace-seconds", "0", stdout=io.StringIO())
+        self.assertFalse(Blob.objects.exists())
+        self.assertFalse(os.path.exists(path))
+
+    def test_dedupe_moves_legacy_attachments(self):
+        msg = Message.objects.create(conversation=self.conv, sender=self.alice)
+        legacy = [
+            MessageAttachment.objects.create(message=msg, file=ContentFile(self.payload, name=name), size=len(self.payload))
+            for name in ("a.pdf", "b.pdf")
+        ]
+        old_paths = [os.path.join(self.tmp, a.file.name) for a in legacy]
+
+        call_command("dedupe_attachments", stdout=io.StringIO())
+        blob = Blob.objects.get()
+        self.assertEqual(blob.ref_count, 2)
+        for attachment, name in zip(MessageAttachment.objects.order_by("id"), ("a.pdf", "b.pdf")):
+            self.assertEqual((attachment.blob, attachment.file.name, attachment.name), (blob, blob.file.name, name))
+        self.assertFalse(any(os.path.exists(p) for p in old_paths))
+
+
+class PresenceTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.carol = User.objects.create_user("carol", password="pass12345")
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice, self.bob])
+        self.client.force_authenticate(self.alice)
+
+    def test_store_tracks_connections_and_expiry(self):
+        store = LocalPresenceStore()
+        self.assertTrue(store.touch(1, "a", 60))
+        self.assertFalse(store.touch(1, "b", 60))
+        self.assertFalse(store.leave(1, "a"))
+        self.assertTrue(store.leave(1, "b"))
+        store.touch(2, "a", 0.01)
+        store.touch(3, "a", 60)
+        time.sleep(0.02)
+        online, last_seen = store.lookup([2])[2]
+        self.assertFalse(online)
+        self.assertIsNotNone(last_seen)
+        # فقط انقضایی که اعلام نشده، و هر کدام یک‌بار
+        self.assertEqual(store.sweep(100), [2])
+        self.assertEqual(store.sweep(100), [])
+
+    @override_settings(CHAT_TYPING_COALESCE=60, CHAT_TYPING_RATE=3)
+    def test_typing_is_coalesced_and_rate_capped(self):
+        self.assertTrue(allow_typing(1, 10))
+        self.assertFalse(allow_typing(1, 10))
+        self.assertTrue(allow_typing(1, 10, typing=False))
+        self.assertTrue(allow_typing(1, 11))
+        # سقف نرخ کاربر در همه‌ی گفتگوها
+        self.assertFalse(allow_typing(1, 12))
+
+    def test_bulk_presence_of_contacts_without_queries(self):
+        presence.heartbeat(self.bob.id, "ws")
+        presence.heartbeat(self.carol.id, "ws")
+        self.client.get("/api/chat/presence/")  # warm the contact cache
+        with self.assertNumQueries(0):
+            resp = self.client.get("/api/chat/presence/")
+        results = resp.json()["results"]
+        # carol has no conversation with alice, so isn't visible
+        self.assertEqual(set(results), {str(self.alice.id), str(self.bob.id)})
+        self.assertTrue(results[str(self.bob.id)]["online"])
+        self.assertFalse(results[str(self.alice.id)]["online"])
+
+        resp = self.client.get("/api/chat/presence/", {"users": f"{self.alice.id},{self.carol.id}"})
+        self.assertEqual(set(resp.json()["results"]), {str(self.alice.id)})
+
+    def test_new_conversation_updates_contacts(self):
+        self.client.get("/api/chat/presence/")
+        conv = Conversation.objects.create()
+        conv.members.set([self.alice, self.carol])
+        resp = self.client.get("/api/chat/presence/")
+        self.assertIn(str(self.carol.id), resp.json()["results"])
+
+    def test_http_heartbeat(self):
+        resp = self.client.post("/api/chat/presence/heartbeat/", {"device": "web"}, format="json")
+        self.assertEqual(resp.status_code, 200)
+        self.assertTrue(presence.presence_of([self.alice.id])[self.alice.id]["online"])
+
+    def test_typing_endpoint(self):
+        url = f"/api/chat/conversations/{self.conv.id}/typing/"
+        resp = self.client.post(url, {"typing": True}, format="json")
+        self.assertEqual(resp.status_code, 202)
+        self.assertTrue(resp.data["sent"])
+        with self.assertNumQueries(0):
+            resp = self.client.post(url, {"typing": True}, format="json")
+        self.assertFalse(resp.data["sent"])
+        self.assertTrue(self.client.post(url, {"typing": False}, format="json").data["sent"])
+
+        self.client.force_authenticate(self.carol)
+        self.assertEqual(self.client.post(url, format="json").status_code, 404)
+
+
+class RealtimePresenceTests(CacheResetMixin, TransactionTestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.alice_token = Token.objects.create(user=self.alice).key
+        self.bob_token = Token.objects.create(user=self.bob).key
+        self.conv = Conversation.objects.create()
+        self.conv.members.set([self.alice, self.bob])
+
+    async def connect(self, token):
+        communicator = WebsocketCommunicator(application, f"/ws/chat/?token={token}")
+        connected, _ = await communicator.connect()
+        self.assertTrue(connected)
+        return communicator
+
+    async def test_presence_and_typing_over_socket(self):
+        bob = await self.connect(self.bob_token)
+        alice = await self.connect(self.alice_token)
+        event = await bob.receive_json_from(timeout=2)
+        self.assertEqual(event, {"type": "presence", "user": self.alice.id, "online": True})
+
+        await alice.send_json_to({"type": "typing", "conversation": self.conv.id})
+        event = await bob.receive_json_from(timeout=2)
+        self.assertEqual(event["type"], "typing")
+        self.assertEqual(event["user"], self.alice.id)
+        self.assertTrue(event["typing"])
+        # فرستنده رویداد خودش را نمی‌گیرد
+        self.assertTrue(await alice.receive_nothing(timeout=0.2))
+
+        await alice.send_json_to({"type": "ping"})
+        self.assertEqual(await alice.receive_json_from(timeout=2), {"type": "pong"})
+
+        await alice.disconnect()
+        event = await bob.receive_json_from(timeout=2)
+        self.assertEqual(event, {"type": "presence", "user": self.alice.id, "online": False})
+        await bob.disconnect()
+
+    @override_settings(CHAT_PRESENCE_TTL=0.05)
+    async def test_lapsed_heartbeat_is_announced_offline(self):
+        bob = await self.connect(self.bob_token)
+        # کلاینت HTTP: heartbeat می‌دهد و بی‌خبر می‌رود
+        await sync_to_async(presence.heartbeat)(self.alice.id, "web")
+        await asyncio.sleep(0.1)
+        await sync_to_async(call_command)("expire_presence", "--once", stdout=io.StringIO())
+        event = await bob.receive_json_from(timeout=2)
+        self.assertEqual(event, {"type": "presence", "user": self.alice.id, "online": False})
+        await sync_to_async(call_command)("expire_presence", "--once", stdout=io.StringIO())
+        self.assertTrue(await bob.receive_nothing(timeout=0.2))
+        await bob.disconnect()
+
+
+class SlowPushNotifier(LocalPushNotifier):
+    def __init__(self, delay):
+        super().__init__()
+        self.delay = delay
+
+    def send(self, user_ids, payload):
+        time.sleep(self.delay)
+        return super().send(user_ids, payload)
+
+
+class FlakyPushNotifier(LocalPushNotifier):
+    def __init__(self, rejects=(), error=False):
+        super().__init__()
+        self.rejects, self.error = set(rejects), error
+
+    def send(self, user_ids, payload):
+        if self.error:
+            raise OSError("gateway down")
+        super().send([u for u in user_ids if u not in self.rejects], payload)
+        return [u for u in user_ids if u in self.rejects]
+
+
+@override_settings(CHAT_PUSH_CHUNK_SIZE=4)
+class PushOutboxTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.members = [User.objects.create_user(f"m{i}", password="pass12345") for i in range(10)]
+        self.group = Conversation.objects.create(is_group=True, name="big")
+        self.group.members.set([self.alice, *self.members])
+        self.dm = Conversation.objects.create()
+        self.dm.members.set([self.alice, self.members[0]])
+        self.client.force_authenticate(self.alice)
+        self.pool = ThreadPoolExecutor(max_workers=4)
+        self.addCleanup(self.pool.shutdown)
+
+    def send(self, conv):
+        return self.client.post(
+            "/api/chat/messages/send/", {"conversation_id": conv.id, "text": "hello"}, format="json"
+        )
+
+    def test_send_cost_does_not_grow_with_group(self):
+        self.send(self.dm)
+        self.send(self.group)  # warm caches
+        with CaptureQueriesContext(connection) as small:
+            self.send(self.dm)
+        with CaptureQueriesContext(connection) as big:
+            self.send(self.group)
+        self.assertEqual(len(small), len(big))
+        self.assertEqual(PushOutbox.objects.count(), 4)
+
+    def test_fan_out_excludes_sender_and_empties_outbox(self):
+        msg_id = self.send(self.group).data["id"]
+        notifier = LocalPushNotifier()
+        self.assertEqual(drain(self.pool, notifier=notifier), (1, 10, 0))
+        self.assertEqual(sorted(u for u, _ in notifier.sent), [m.id for m in self.members])
+        self.assertEqual(notifier.sent[0][1]["message"], msg_id)
+        self.assertFalse(PushOutbox.objects.exists())
+        self.assertEqual(drain(self.pool, notifier=notifier), (0, 0, 0))
+
+    @override_settings(CHAT_INBOX_INLINE_BUMP=3)
+    def test_worker_finishes_inbox_order_of_large_group(self):
+        created_at = Message.objects.get(pk=self.send(self.group).data["id"]).created_at
+        moved = ReadCursor.objects.filter(conversation=self.group, last_activity_at=created_at)
+        # the sender's cursor and three more in the send; the other seven by the worker
+        self.assertEqual(moved.count(), 4)
+        drain(self.pool, notifier=LocalPushNotifier())
+        self.assertEqual(moved.count(), 11)
+        self.client.force_authenticate(self.members[9])
+        self.assertEqual(self.client.get("/api/chat/inbox/").data["results"][0]["id"], self.group.id)
+
+    def test_rejected_recipients_are_retried_with_backoff(self):
+        self.send(self.group)
+        rejected = [self.members[2].id, self.members[7].id]
+        self.assertEqual(drain(self.pool, notifier=FlakyPushNotifier(rejected)), (1, 8, 1))
+        row = PushOutbox.objects.get()
+        self.assertEqual((row.attempts, row.recipients), (1, rejected))
+        self.assertGreater(row.available_at, timezone.now())
+        self.assertEqual(drain(self.pool, notifier=LocalPushNotifier()), (0, 0, 0))
+
+        PushOutbox.objects.update(available_at=timezone.now())
+        notifier = LocalPushNotifier()
+        drain(self.pool, notifier=notifier)
+        self.assertEqual(sorted(u for u, _ in notifier.sent), rejected)
+        self.assertFalse(PushOutbox.objects.exists())
+
+    @override_settings(CHAT_PUSH_MAX_ATTEMPTS=2)
+    def test_failing_notifier_gives_up_after_max_attempts(self):
+        self.send(self.dm)
+        with self.assertLogs("chat.push", "WARNING") as logs:
+            for _ in range(3):
+                drain(self.pool, notifier=FlakyPushNotifier(error=True))
+                PushOutbox.objects.update(available_at=timezone.now())
+        self.assertIn("giving up", logs.output[-1])
+        self.assertIn("gateway down", logs.output[-1])
+        self.assertFalse(PushOutbox.objects.exists())
+
+    @override_settings(CHAT_PUSH_MAX_ATTEMPTS=2)
+    def test_worker_drops_rows_past_max_attempts(self):
+        self.send(self.dm)
+        PushOutbox.objects.update(attempts=2)
+        err = io.StringIO()
+        call_command("send_push_notifications", "--once", stdout=io.StringIO(), stderr=err)
+        self.assertIn("dropped 1 messages", err.getvalue())
+        self.assertFalse(PushOutbox.objects.exists())
+
+    def test_late_worker_leaves_row_to_the_one_that_took_it_over(self):
+        self.send(self.group)
+        rows = claim(10)
+        PushOutbox.objects.update(available_at=timezone.now())  # the lease ran out
+        taken = claim(10)
+        with self.assertLogs("chat.push", "WARNING"):
+            self.assertEqual(deliver(rows, self.pool, FlakyPushNotifier([self.members[0].id])), (9, 0))
+        self.assertEqual(PushOutbox.objects.get().attempts, 0)
+        # nor does a late success delete it
+        self.assertEqual(deliver(rows, self.pool, LocalPushNotifier()), (10, 0))
+        self.assertTrue(PushOutbox.objects.exists())
+        self.assertEqual(deliver(taken, self.pool, LocalPushNotifier()), (10, 0))
+        self.assertFalse(PushOutbox.objects.exists())
+
+    @override_settings(CHAT_PUSH_LEASE_SECONDS=0.15)
+    def test_lease_is_renewed_while_chunks_are_in_flight(self):
+        self.send(self.group)
+        rows = claim(10)
+        with patch("chat.push.renew", wraps=push.renew) as renew:
+            self.assertEqual(deliver(rows, self.pool, SlowPushNotifier(0.3)), (10, 0))
+        self.assertTrue(renew.called)
+        self.assertFalse(PushOutbox.objects.exists())
+
+    def test_expired_lease_is_claimed_again(self):
+        self.send(self.dm)
+        with patch("chat.push.deliver", side_effect=RuntimeError("worker died")):
+            with self.assertRaises(RuntimeError):
+                drain(self.pool, notifier=LocalPushNotifier())
+        self.assertEqual(drain(self.pool, notifier=LocalPushNotifier()), (0, 0, 0))
+        PushOutbox.objects.update(available_at=timezone.now())
+        self.assertEqual(drain(self.pool, notifier=LocalPushNotifier()), (1, 1, 0))
+
+    def test_worker_command(self):
+        self.send(self.group)
+        out = io.StringIO()
+        call_command("send_push_notifications", "--once", "--workers", "2", stdout=out)
+        self.assertIn("delivered 10 notifications for 1 messages", out.getvalue())
+
+
+class CompactResponseTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.conv = Conversation.objects.create(is_group=True, name="team")
+        self.conv.members.set([self.alice, self.bob])
+        for i in range(4):
+            msg = Message.objects.create(conversation=self.conv, sender=[self.alice, self.bob][i % 2], text=str(i))
+        self.conv.register_message(msg)
+        self.client.force_authenticate(self.alice)
+        self.url = f"/api/chat/messages/{self.conv.id}/"
+
+    def test_compact_moves_users_to_side_table(self):
+        full = self.client.get(self.url).json()
+        self.assertIn("sender_detail", full["results"][0])
+        self.assertNotIn("users", full)
+
+        compact = self.client.get(self.url, {"compact": 1}).json()
+        self.assertNotIn("sender_detail", compact["results"][0])
+        self.assertEqual([u["id"] for u in compact["users"]], [self.alice.id, self.bob.id])
+        self.assertEqual(compact["users"][1], full["results"][1]["sender_detail"])
+        self.assertEqual([m["id"] for m in compact["results"]], [m["id"] for m in full["results"]])
+
+        inbox = self.client.get("/api/chat/inbox/", {"compact": "true"}).json()
+        item = inbox["results"][0]
+        self.assertNotIn("members_detail", item)
+        self.assertNotIn("sender_detail", item["last_message"])
+        self.assertEqual(len(inbox["users"]), 2)
+
+    def test_sparse_fields_apply_to_top_level_items(self):
+        resp = self.client.get(self.url, {"fields": "id,text"})
+        self.assertEqual(set(resp.json()["results"][0]), {"id", "text"})
+
+        resp = self.client.get("/api/chat/inbox/", {"fields": "id,last_message", "compact": 1})
+        item = resp.json()["results"][0]
+        self.assertEqual(set(item), {"id", "last_message"})
+        self.assertIn("attachments", item["last_message"])
+        # members was not selected, but the last message's sender still is in the table
+        self.assertEqual([u["id"] for u in resp.json()["users"]], [self.bob.id])
+
+        resp = self.client.get("/api/chat/conversations/", {"fields": "id,members", "compact": 1})
+        self.assertEqual(set(resp.json()["results"][0]), {"id", "members"})
+
+    def test_sends_keep_the_full_representation(self):
+        resp = self.client.post(
+            "/api/chat/messages/send/?compact=1&fields=id",
+            {"conversation_id": self.conv.id, "text": "hi"}, format="json",
+        )
+        self.assertEqual(resp.data["sender_detail"]["id"], self.alice.id)
+
+    def test_msgpack_by_content_negotiation(self):
+        import msgpack
+
+        expected = self.client.get(self.url, {"compact": 1}).json()
+        resp = self.client.get(self.url, {"compact": 1}, HTTP_ACCEPT="application/msgpack")
+        self.assertEqual(resp["Content-Type"], "application/msgpack")
+        self.assertEqual(msgpack.unpackb(resp.content), expected)
+        self.assertLess(len(resp.content), len(json.dumps(expected, separators=(",", ":"))))
+
+        resp = self.client.get("/api/chat/conversations/", HTTP_ACCEPT="application/msgpack")
+        etag = resp["ETag"]
+        resp = self.client.get("/api/chat/conversations/", HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(resp.status_code, 200)
+
+    def test_orjson_output_matches_drf(self):
+        data = {
+            "when": timezone.now(),
+            "day": timezone.now().date(),
+            "price": decimal.Decimal("1.50"),
+            "id": Upload().id,
+            "text": "سلام\u2028",
+            1: [None, True, 1.5],
+        }
+        self.assertEqual(ORJSONRenderer().render(data), JSONRenderer().render(data))
+        self.assertEqual(ORJSONRenderer().render(data, "application/json; indent=2"),
+                         JSONRenderer().render(data, "application/json; indent=2"))
+        self.assertEqual(MessagePackRenderer().render(None), b"")
+
+
+@override_settings(THROTTLE_RATES={}, CONCURRENCY_LIMITS={})
+class RateLimitTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.carol = User.objects.create_user("carol", password="pass12345")
+        self.conv = Conversation.objects.create(is_group=True, name="team")
+        self.conv.members.set([self.alice, self.bob])
+
+    def send(self, user, conv=None):
+        self.client.force_authenticate(user)
+        return self.client.post(
+            "/api/chat/messages/send/", {"conversation_id": (conv or self.conv).id, "text": "x"}, format="json"
+        )
+
+    def test_token_bucket(self):
+        self.assertEqual(throttling.parse_rate("30/min"), (0.5, 30))
+        self.assertEqual(throttling.parse_rate(("10/s", 3)), (10, 3))
+        store = throttling.LocalThrottleStore()
+        self.assertEqual([store.take("k", 20, 2) for _ in range(2)], [0, 0])
+        wait = store.take("k", 20, 2)
+        self.assertGreater(wait, 0)
+        self.assertLessEqual(wait, 0.05)
+        time.sleep(wait + 0.01)
+        self.assertEqual(store.take("k", 20, 2), 0)
+        self.assertEqual(store.take("other", 20, 2), 0)
+
+    @override_settings(THROTTLE_RATES={"send_conversation": "2/min", "send_user": "100/min"})
+    def test_send_is_limited_per_conversation(self):
+        # outsiders are rejected without draining the conversation's bucket
+        for _ in range(3):
+            self.assertEqual(self.send(self.carol).status_code, 400)
+        self.assertEqual(self.send(self.alice).status_code, 201)
+        self.assertEqual(self.send(self.bob).status_code, 201)
+        self.assertEqual(self.send(self.alice).status_code, 429)
+
+        other = Conversation.objects.create()
+        other.members.set([self.alice, self.carol])
+        self.assertEqual(self.send(self.alice, other).status_code, 201)
+
+    @override_settings(THROTTLE_RATES={"send_user": "5/min"})
+    def test_batch_send_costs_one_token_per_message(self):
+        self.client.force_authenticate(self.alice)
+
+        def batch(n):
+            messages = [{"conversation_id": self.conv.id, "text": str(i)} for i in range(n)]
+            return self.client.post("/api/chat/messages/send/batch/", {"messages": messages}, format="json")
+
+        self.assertEqual(batch(4).status_code, 201)
+        self.assertEqual(batch(2).status_code, 429)
+        self.assertEqual(self.send(self.alice).status_code, 201)
+        self.assertEqual(self.send(self.bob).status_code, 201)
+
+    @override_settings(CONCURRENCY_LIMITS={"send": 1})
+    def test_concurrency_cap_answers_503(self):
+        self.assertEqual(self.send(self.alice).status_code, 201)
+        self.assertEqual(self.send(self.alice).status_code, 201)
+
+        store = throttling.get_throttle_store()
+        slot = store.acquire("send", 1, 60)
+        resp = self.send(self.bob)
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp["Retry-After"], "1")
+        store.release("send", slot)
+        self.assertEqual(self.send(self.bob).status_code, 201)
+
+        with patch("chat.views.send_message", side_effect=RuntimeError("boom")):
+            with self.assertRaises(RuntimeError):
+                self.send(self.alice)
+        self.assertEqual(store.slots["send"], {})
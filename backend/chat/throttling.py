@@ -0,0 +1,25 @@
+from core.throttling import BucketThrottle
+
+from .membership import is_member
+
+
+class ConversationBucketThrottle(BucketThrottle):
+    """
+    Per target conversation, shared by all its members, so one busy bot
+    can't flood a room. Only members draw from it (membership is cached):
+    outsiders' requests are rejected by the view and must not drain it.
+    """
+
+    kind = "conversation"
+
+    def get_key(self, request, view):
+        conversation_id = view.kwargs.get("conversation_id")
+        if conversation_id is None and hasattr(request.data, "get"):
+            conversation_id = request.data.get("conversation_id")
+        try:
+            conversation_id = int(conversation_id)
+        except (TypeError, ValueError):
+            return None
+        if not request.user.is_authenticated or not is_member(request.user.id, conversation_id):
+            return None
+        return conversation_id
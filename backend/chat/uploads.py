@@ -0,0 +1,130 @@
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+from pathlib import Path
+
+from django.conf import settings
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+# حجم هر بار خواندن/نوشتن؛ کل فایل هیچ‌وقت در حافظه نیست
+CHUNK_SIZE = 64 * 1024
+
+
+class UploadOverflow(Exception):
+    """The client sent more bytes than the upload declared."""
+
+
+class UploadBusy(Exception):
+    """Another request is writing the same upload."""
+
+
+def partial_path(upload):
+    return Path(settings.CHUNKED_UPLOAD_DIR) / f"{upload.pk}.part"
+
+
+@contextmanager
+def locked_partial(upload):
+    """
+    Open the partial file for writing under an exclusive lock, so two
+    requests for the same upload never write it at once. Raises UploadBusy
+    instead of waiting when another request holds the lock.
+    """
+    path = partial_path(upload)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT, 0o600)
+    with os.fdopen(fd, "wb") as fh:
+        try:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadBusy()
+        yield fh
+
+
+def write_chunk(fh, upload, stream, offset):
+    """
+    Write ``stream`` into the locked partial file ``fh`` starting at
+    ``offset`` and return the number of bytes written. If the connection
+    drops half-way, whatever reached the disk is kept and counted so the
+    client can resume from it.
+    """
+    remaining = upload.size - offset
+    written = 0
+    # bytes past the confirmed offset belong to an aborted request
+    fh.truncate(offset)
+    fh.seek(offset)
+    while stream is not None:
+        try:
+            data = stream.read(CHUNK_SIZE)
+        except OSError:  # includes UnreadablePostError
+            break
+        if not data:
+            break
+        if written + len(data) > remaining:
+            raise UploadOverflow()
+        fh.write(data)
+        written += len(data)
+    fh.flush()
+    os.fsync(fh.fileno())
+    return written
+
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for block in iter(lambda: fh.read(CHUNK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def discard_partial(upload):
+    partial_path(upload).unlink(missing_ok=True)
+
+
+class HashingMemoryFileUploadHandler(MemoryFileUploadHandler):
+    """Small multipart files, with ``.sha256`` computed as the bytes arrive."""
+
+    def new_file(self, *args, **kwargs):
+        # before super(): it raises StopFutureHandlers once it takes the file
+        self.digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        if self.activated:
+            self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.digest.hexdigest()
+        return file
+
+
+class HashingTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """Large multipart files (spooled to disk), with ``.sha256`` computed on the way."""
+
+    def new_file(self, *args, **kwargs):
+        self.digest = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.digest.hexdigest()
+        return file
+
+
+def uploaded_file_sha256(file):
+    """SHA-256 of an UploadedFile; read again only if no hashing handler saw it."""
+    digest = getattr(file, "sha256", None)
+    if digest is None:
+        hasher = hashlib.sha256()
+        for chunk in file.chunks(CHUNK_SIZE):
+            hasher.update(chunk)
+        digest = hasher.hexdigest()
+        file.seek(0)
+    return digest
@@ -1,13 +1,79 @@
+from django.conf import settings
 from django.urls import path
-from .views import ConversationListCreateView, MessageListView, MessageSendView
+from .async_views import AsyncMessageListView, AsyncMessageSendView
+from .views import (
+    AttachmentDownloadView,
+    BlobDetailView,
+    ConversationExportView,
+    ConversationListCreateView,
+    InboxView,
+    MarkReadView,
+    MessageBatchSendView,
+    MessageListView,
+    MessagePollView,
+    MessageSearchView,
+    MessageSendView,
+    PresenceHeartbeatView,
+    PresenceView,
+    SyncView,
+    TypingView,
+    UploadCompleteView,
+    UploadCreateView,
+    UploadDetailView,
+)
+
+# زیر ASGI نسخه‌ی async ویوهای پرترافیک سرو می‌شود
+if settings.CHAT_ASYNC_VIEWS:
+    message_list_view, message_send_view = AsyncMessageListView, AsyncMessageSendView
+else:
+    message_list_view, message_send_view = MessageListView, MessageSendView
 
 urlpatterns = [
     # GET = لیست گفتگوها، POST = ساخت DM/گروه
     path("conversations/", ConversationListCreateView.as_view(), name="conversation-list-create"),
 
+    # GET اینباکس: گفتگوها با آخرین پیام و تعداد نخوانده‌ها
+    path("inbox/", InboxView.as_view(), name="inbox"),
+
+    # GET/POST همگام‌سازی یک‌جای شروع اپ (پیام‌ها + گفتگوهای تغییرکرده، با cursor)
+    path("sync/", SyncView.as_view(), name="sync"),
+
+    # GET خروجی کامل تاریخچه (NDJSON/CSV، اختیاری gzip)
+    path("conversations/<int:conversation_id>/export/", ConversationExportView.as_view(), name="conversation-export"),
+
+    # POST در حال تایپ (ادغام‌شده، با سقف نرخ)
+    path("conversations/<int:conversation_id>/typing/", TypingView.as_view(), name="conversation-typing"),
+
+    # GET حضور مخاطبان یک‌جا، POST heartbeat برای کلاینت بدون سوکت
+    path("presence/", PresenceView.as_view(), name="presence"),
+    path("presence/heartbeat/", PresenceHeartbeatView.as_view(), name="presence-heartbeat"),
+
+    # POST علامت خوانده‌شده
+    path("conversations/<int:conversation_id>/read/", MarkReadView.as_view(), name="conversation-read"),
+
     # GET پیام‌های یک گفتگو
-    path("messages/<int:conversation_id>/", MessageListView.as_view(), name="message-list"),
+    path("messages/<int:conversation_id>/", message_list_view.as_view(), name="message-list"),
+
+    # GET long-poll روی چند گفتگو (after=conv:id,... و wait)
+    path("messages/poll/", MessagePollView.as_view(), name="message-poll"),
+
+    # GET جستجوی پیام‌ها
+    path("messages/search/", MessageSearchView.as_view(), name="message-search"),
 
     # POST ارسال پیام
-    path("messages/send/", MessageSendView.as_view(), name="message-send"),
+    path("messages/send/", message_send_view.as_view(), name="message-send"),
+
+    # POST ارسال دسته‌ای
+    path("messages/send/batch/", MessageBatchSendView.as_view(), name="message-send-batch"),
+
+    # GET دانلود پیوست (Range / ETag / X-Accel-Redirect)
+    path("attachments/<int:attachment_id>/download/", AttachmentDownloadView.as_view(), name="attachment-download"),
+
+    # آپلود تکه‌ای: شروع، PUT تکه‌ها، پایان
+    path("uploads/", UploadCreateView.as_view(), name="upload-create"),
+    path("uploads/<uuid:upload_id>/", UploadDetailView.as_view(), name="upload-detail"),
+    path("uploads/<uuid:upload_id>/complete/", UploadCompleteView.as_view(), name="upload-complete"),
+
+    # GET/HEAD محتوای تکراری: اگر سرور این sha256 را دارد، بدون آپلود با blobs بفرست
+    path("blobs/<str:sha256>/", BlobDetailView.as_view(), name="blob-detail"),
 ]
@@ -1,15 +1,60 @@
+from django.contrib.postgres.search import TrigramWordSimilarity
+from django.conf import settings
+from django.core.files import File
+from django.db import connection, connections, transaction
+from django.db.models import (
+    Count, F, FilteredRelation, FloatField, OuterRef, Q, Subquery, Value, prefetch_related_objects,
+)
+from django.db.models.functions import Cast, Coalesce
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+from django.utils.http import content_disposition_header
 from rest_framework import generics, permissions, status
+from rest_framework.exceptions import NotFound, ValidationError
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.parsers import MultiPartParser, FormParser, JSONParser
 
-from .models import Conversation, Message, MessageAttachment
+from .blobs import accessible_blobs, add_refs, store_blob
+from .compact import CompactListMixin, compact_context, users_table
+from .downloads import serve_attachment, serve_variant
+from .events import publish_conversation, publish_message, publish_presence, publish_typing
+from .export import EXPORT_FORMATS, export_stream
+from core.streaming import streaming_body
+from core.throttling import ConcurrencyLimitMixin, UserBucketThrottle
+from core.versions import USERS_SCOPE, VersionedListMixin
+
+from .membership import conversations_scope, get_contact_ids, get_conversation_ids, is_member
+from .models import Conversation, Message, MessageAttachment, ReadCursor, Upload
+from .notify import wait_for_messages
+from .push import enqueue_push
+from .presence import allow_typing, heartbeat, presence_of
+from .pagination import InboxCursorPagination, MessageCursorPagination, MessageSearchPagination
+from .previews import schedule_previews
 from .serializers import (
     ConversationSerializer,
     ConversationCreateSerializer,
+    InboxConversationSerializer,
+    MarkReadSerializer,
+    MessageBatchSerializer,
     MessageSerializer,
     MessageCreateSerializer,
+    SyncSerializer,
+    UploadCompleteSerializer,
+    UploadSerializer,
+)
+from .throttling import ConversationBucketThrottle
+from .sync import DeltaSync, InvalidSyncCursor, decode_sync_cursor
+from .uploads import (
+    UploadBusy,
+    UploadOverflow,
+    discard_partial,
+    file_sha256,
+    locked_partial,
+    partial_path,
+    uploaded_file_sha256,
+    write_chunk,
 )
 
 class IsAuthenticated(permissions.IsAuthenticated):
@@ -19,13 +64,18 @@ class DefaultLimitOffsetPagination(LimitOffsetPagination):
     default_limit = 50
     max_limit = 200
 
-class ConversationListCreateView(generics.ListCreateAPIView):
+class ConversationListCreateView(VersionedListMixin, CompactListMixin, generics.ListCreateAPIView):
     """
-    GET: لیست کانورسیشن‌های کاربر
+    GET: لیست کانورسیشن‌های کاربر (compact=1 و fields=... مثل لیست پیام‌ها)
+    ETag بر اساس نسخه‌ی گفتگوهای کاربر و users؛ با If-None-Match برابر، 304
     POST: ساخت کانورسیشن (DM یا گروه) — سازنده خودکار عضو می‌شود
     """
     permission_classes = [IsAuthenticated]
     pagination_class = DefaultLimitOffsetPagination
+    per_user_cache = True
+
+    def get_version_scopes(self):
+        return [conversations_scope(self.request.user.id), USERS_SCOPE]
 
     def get_queryset(self):
         return (
@@ -33,6 +83,8 @@ class ConversationListCreateView(generics.ListCreateAPIView):
             .filter(members=self.request.user)
             .distinct()
             .order_by("-created_at")
+            # members و members_detail هر دو از همین prefetch می‌خوانند
+            .prefetch_related("members")
         )
 
     def get_serializer_class(self):
@@ -43,78 +95,773 @@ class ConversationListCreateView(generics.ListCreateAPIView):
         ctx["request"] = self.request
         return ctx
 
+    def create(self, request, *args, **kwargs):
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        conv = serializer.save()
+        created = getattr(conv, "created_now", False)
+
+        # خروجی با ConversationSerializer (ورودی فقط برای validate است)
+        data = ConversationSerializer(conv, context=self.get_serializer_context()).data
+        if created:
+            # گفتگوی تازه را به سوکت‌های باز اعضا خبر بده
+            publish_conversation(data["members"], data)
+        return Response(data, status=status.HTTP_201_CREATED if created else status.HTTP_200_OK)
+
 
-class MessageListView(generics.ListAPIView):
+class MessageListView(CompactListMixin, generics.ListAPIView):
     """
     GET: پیام‌های یک کانورسیشن (فقط اگر عضو باشی)
-    پارامتر after_id برای Pull اینکریمنتال
+    برای موبایل: compact=1 فرستنده‌ها را یک‌بار در users می‌دهد (به‌جای sender_detail تکراری)،
+    fields=id,text,... فقط همان فیلدها؛ Accept: application/msgpack خروجی باینری
+    صفحه‌بندی keyset روی id: پارامترهای cursor یا before_id / after_id و limit
+    (after_id برای Pull اینکریمنتال، before_id برای تاریخچه‌ی قدیمی‌تر)
+    long-poll: با wait=N (ثانیه) و after_id/cursor رو به جلو، اگر پیام تازه‌ای
+    نباشد درخواست تا N ثانیه منتظر اعلان پیام جدید می‌ماند و بعد فقط یک‌بار دیگر کوئری می‌زند.
     """
     permission_classes = [IsAuthenticated]
     serializer_class = MessageSerializer
-    pagination_class = DefaultLimitOffsetPagination
+    pagination_class = MessageCursorPagination
 
     def get_queryset(self):
         conv_id = self.kwargs["conversation_id"]
 
-        # اجازه فقط به اعضا
-        if not Conversation.objects.filter(id=conv_id, members=self.request.user).exists():
+        # اجازه فقط به اعضا (از cache عضویت، بدون کوئری)
+        if not is_member(self.request.user.id, conv_id):
             return Message.objects.none()
 
-        qs = Message.objects.filter(conversation_id=conv_id).order_by("id")
+        return conversation_messages(conv_id)
 
-        after_id = self.request.query_params.get("after_id")
-        if after_id:
-            try:
-                qs = qs.filter(id__gt=int(after_id))
-            except (ValueError, TypeError):
-                pass
+    def list(self, request, *args, **kwargs):
+        response = super().list(request, *args, **kwargs)
+        wait = longpoll_wait(request)
+        conv_id = self.kwargs["conversation_id"]
+        if (
+            wait
+            and not response.data["results"]
+            and self.paginator.direction == "after"
+            and is_member(request.user.id, conv_id)
+        ):
+            release_connections()
+            if wait_for_messages({conv_id: self.paginator.position}, wait):
+                response = super().list(request, *args, **kwargs)
+        return response
+
+
+def conversation_messages(conv_id):
+    # ترتیب و برش را paginator روی ایندکس (conversation, id) انجام می‌دهد
+    return (
+        Message.objects.filter(conversation_id=conv_id)
+        .select_related("sender")
+        .prefetch_related("attachments__variants")
+    )
+
+
+def longpoll_wait(request):
+    """مقدار wait (ثانیه) محدود به CHAT_LONGPOLL_MAX_WAIT؛ نامعتبر یعنی بدون انتظار"""
+    try:
+        wait = float(request.query_params.get("wait") or 0)
+    except ValueError:
+        return 0
+    return min(max(wait, 0), settings.CHAT_LONGPOLL_MAX_WAIT)
+
+
+def release_connections():
+    # در طول انتظار اتصال دیتابیس (یا جای آن در pool) را نگه ندار
+    for conn in connections.all(initialized_only=True):
+        if not conn.in_atomic_block:
+            conn.close()
+
+
+def parse_after_pairs(raw):
+    """after=12:340,15:99 → {12: 340, 15: 99}"""
+    after = {}
+    for item in filter(None, (raw or "").split(",")):
+        conv, sep, last = item.partition(":")
+        try:
+            after[int(conv)] = int(last or 0)
+        except ValueError:
+            raise ValidationError({"after": "Expected conversation:message_id pairs."})
+    return after
+
+
+class MessagePollView(APIView):
+    """
+    GET: long-poll روی چند گفتگو با هم
+    پارامترها: after=12:340,15:99 (گفتگو:آخرین id دیده‌شده) و wait=N (ثانیه)
+    خروجی: پیام‌های جدیدتر همه‌ی گفتگوها به ترتیب id، و after به‌روزشده برای درخواست بعدی
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        after = self.parse_after(request)
+        wait = longpoll_wait(request)
 
-        # اختیاری: limit دستی (کنار pagination)
-        limit = self.request.query_params.get("limit")
-        if limit:
+        messages, has_more = self.fetch(after)
+        if not messages and wait:
+            release_connections()
+            if wait_for_messages(after, wait):
+                messages, has_more = self.fetch(after)
+
+        latest = dict(after)
+        for message in messages:
+            latest[message.conversation_id] = message.id
+        context = {"request": request, **compact_context(request)}
+        data = {
+            "results": MessageSerializer(messages, many=True, context=context).data,
+            "after": {str(c): last for c, last in latest.items()},
+            "has_more": has_more,
+        }
+        if "users" in context:
+            data["users"] = users_table(context["users"])
+        return Response(data)
+
+    def parse_after(self, request):
+        after = parse_after_pairs(request.query_params.get("after"))
+        if not after:
+            raise ValidationError({"after": "This field is required."})
+        if len(after) > settings.CHAT_POLL_MAX_CONVERSATIONS:
+            raise ValidationError(
+                {"after": f"At most {settings.CHAT_POLL_MAX_CONVERSATIONS} conversations per poll."}
+            )
+
+        # گفتگوهایی که کاربر عضوشان نیست بی‌صدا کنار می‌روند
+        mine = get_conversation_ids(request.user.id)
+        return {conv: last for conv, last in after.items() if conv in mine}
+
+    def fetch(self, after):
+        if not after:
+            return [], False
+        condition = Q()
+        for conv, last in after.items():
+            condition |= Q(conversation_id=conv, id__gt=last)
+        limit = settings.CHAT_POLL_MAX_MESSAGES
+        rows = list(
+            Message.objects.filter(condition)
+            .select_related("sender")
+            .prefetch_related("attachments__variants")
+            .order_by("id")[: limit + 1]
+        )
+        return rows[:limit], len(rows) > limit
+
+
+class MessageSearchView(CompactListMixin, generics.ListAPIView):
+    """
+    GET: جستجو در متن پیام‌های همه‌ی گفتگوهای کاربر
+    پارامترها: q (حداقل ۳ کاراکتر)، conversation (اختیاری)، cursor، limit
+    روی PostgreSQL از ایندکس GIN trigram استفاده می‌شود و نتایج بر اساس شباهت مرتب‌اند.
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = MessageSerializer
+    pagination_class = MessageSearchPagination
+    # کوتاه‌تر از یک trigram نمی‌تواند از ایندکس استفاده کند
+    min_query_length = 3
+
+    def get_queryset(self):
+        query = (self.request.query_params.get("q") or "").strip()
+        if len(query) < self.min_query_length:
+            raise ValidationError(
+                {"q": f"Search query must be at least {self.min_query_length} characters."}
+            )
+
+        conv_ids = Conversation.members.through.objects.filter(
+            user_id=self.request.user.id
+        ).values("conversation_id")
+        qs = Message.objects.filter(conversation_id__in=conv_ids, text__icontains=query)
+
+        conversation = self.request.query_params.get("conversation")
+        if conversation:
             try:
-                qs = qs[: int(limit)]
+                qs = qs.filter(conversation_id=int(conversation))
             except (ValueError, TypeError):
-                pass
+                raise ValidationError({"conversation": "Must be an integer."})
+
+        if connection.vendor == "postgresql":
+            rank = Cast(TrigramWordSimilarity(query, "text"), FloatField())
+        else:
+            # SQLite (تست‌ها): بدون رتبه‌بندی، فقط جدیدترها اول
+            rank = Value(0.0, output_field=FloatField())
 
-        return qs
+        return (
+            qs.annotate(rank=rank)
+            .select_related("sender")
+            .prefetch_related("attachments__variants")
+        )
 
 
-class MessageSendView(APIView):
+class MessageSendView(ConcurrencyLimitMixin, APIView):
     """
     POST: ارسال پیام متنی + آپلود فایل (تکی/چندتا)
+    سقف نرخ برای هر کاربر و هر گفتگو (429) و سقف ارسال همزمان (503)، هر دو با Retry-After
     بدنه JSON یا فرم/مالتی‌پارت:
       - conversation_id (الزامی)
       - text (اختیاری)
       - file=... (اختیاری، تکی)
       - files=... (اختیاری، چندتا)
+      - upload_ids (آپلودهای تکه‌ای complete شده)
+      - blobs=[{"sha256", "name", "content_type"}] (JSON؛ فایلی که سرور از قبل دارد، بدون آپلود دوباره)
     """
     permission_classes = [IsAuthenticated]
     parser_classes = [MultiPartParser, FormParser, JSONParser]
+    throttle_classes = [UserBucketThrottle, ConversationBucketThrottle]
+    throttle_scope = "send"
+    concurrency_scope = "send"
 
     def post(self, request):
         serializer = MessageCreateSerializer(data=request.data, context={"request": request})
         serializer.is_valid(raise_exception=True)
+        data = send_message(request, serializer.validated_data)
+        return Response(data, status=status.HTTP_201_CREATED)
 
-        msg = Message.objects.create(
-            conversation=serializer.validated_data["conversation"],
-            sender=serializer.validated_data["sender"],
-            text=serializer.validated_data.get("text", "") or "",
-        )
 
-        # فایل‌ها
-        files = []
-        files += request.FILES.getlist("file")
-        files += request.FILES.getlist("files")
+def send_message(request, validated_data):
+    """
+    ساخت پیام + پیوست‌ها در یک تراکنش و برگرداندن خروجی MessageSerializer.
+    (مشترک بین نسخه‌ی sync و async از MessageSendView)
+    """
+    conv = validated_data["conversation"]
+
+    # فایل‌ها
+    files = []
+    files += request.FILES.getlist("file")
+    files += request.FILES.getlist("files")
 
+    with transaction.atomic():
+        msg = Message.objects.create(
+            conversation=conv,
+            sender=validated_data["sender"],
+            text=validated_data.get("text", "") or "",
+        )
+        attachments = []
         for f in files:
-            MessageAttachment.objects.create(
-                message=msg,
-                file=f,
-                content_type=getattr(f, "content_type", "") or "",
-                size=getattr(f, "size", 0) or 0,
+            content_type = getattr(f, "content_type", "") or ""
+            # محتوای تکراری دوباره ذخیره نمی‌شود
+            blob = store_blob(f, uploaded_file_sha256(f), f.size, content_type)
+            attachments.append(
+                MessageAttachment(
+                    message=msg, blob=blob, file=blob.file.name, name=f.name or "",
+                    content_type=content_type, size=blob.size,
+                )
             )
+        # آپلودهای تکه‌ای و ارسال با hash: فایل از قبل در storage است، فقط وصل می‌شود
+        attachments += attachments_from_uploads(msg, validated_data.get("uploads"))
+        attachments += attachments_from_blobs(msg, validated_data.get("blobs"))
+        create_attachments(attachments, [validated_data.get("uploads")])
+
+        # آخرین پیام / فعالیت، در همان تراکنش (هزینه‌اش به اندازه‌ی گروه بستگی ندارد)
+        conv.register_message(msg)
+        # نوتیفیکیشن: فقط یک ردیف outbox، هر چقدر گروه بزرگ باشد؛ پخش با send_push_notifications
+        enqueue_push([msg])
 
         # مهم: حتماً request رو به serializer پاس بده تا URLهای فایل‌ها درست ساخته بشن
+        prefetch_related_objects([msg], "attachments__variants")
         data = MessageSerializer(msg, context={"request": request}).data
-        return Response(data, status=status.HTTP_201_CREATED)
+        # push به اعضای آنلاین گفتگو از طریق WebSocket (بعد از commit)
+        publish_message(msg.conversation_id, data)
+    return data
+
+
+class MessageBatchSendView(ConcurrencyLimitMixin, APIView):
+    """
+    POST: ارسال دسته‌ای پیام (برای بات‌ها/یکپارچه‌سازی‌ها)
+    بدنه JSON: {"messages": [{"conversation_id", "text", "upload_ids"}, ...]}
+    عضویت یک بار برای همه بررسی می‌شود و همه‌چیز با bulk insert در یک تراکنش نوشته می‌شود.
+    از سهمیه‌ی ارسال کاربر به تعداد پیام‌ها کم می‌شود.
+    """
+    permission_classes = [IsAuthenticated]
+    parser_classes = [JSONParser]
+    throttle_classes = [UserBucketThrottle]
+    throttle_scope = "send"
+    concurrency_scope = "send"
+
+    def get_throttle_cost(self, request):
+        messages = request.data.get("messages") if isinstance(request.data, dict) else None
+        return len(messages) if isinstance(messages, list) else 1
+
+    def post(self, request):
+        serializer = MessageBatchSerializer(data=request.data, context={"request": request})
+        serializer.is_valid(raise_exception=True)
+        items = serializer.validated_data["messages"]
+
+        with transaction.atomic():
+            messages = Message.objects.bulk_create([
+                Message(
+                    conversation_id=item["conversation_id"],
+                    sender=request.user,
+                    text=item.get("text", "") or "",
+                )
+                for item in items
+            ])
+            attachments = []
+            for msg, item in zip(messages, items):
+                attachments += attachments_from_uploads(msg, item.get("uploads"))
+                attachments += attachments_from_blobs(msg, item.get("blobs"))
+            create_attachments(attachments, [item.get("uploads") for item in items])
+
+            # فقط آخرین پیام هر گفتگو
+            last_per_conversation = {msg.conversation_id: msg for msg in messages}
+            for conv_id, last in last_per_conversation.items():
+                Conversation(pk=conv_id).register_message(last)
+            enqueue_push(messages)
+
+            prefetch_related_objects(messages, "attachments__variants")
+            data = MessageSerializer(messages, many=True, context={"request": request}).data
+            for item in data:
+                publish_message(item["conversation"], item)
+        return Response({"results": data}, status=status.HTTP_201_CREATED)
+
+
+class SyncView(APIView):
+    """
+    GET/POST: همگام‌سازی یک‌جا در شروع اپ (به‌جای لیست گفتگوها و یک MessageListView برای هر گفتگو)
+    ورودی: after (گفتگو → آخرین id دیده‌شده؛ در GET به شکل 12:340,15:99)،
+    since (آخرین id سراسری برای بقیه‌ی گفتگوها) یا cursor پاسخ قبلی.
+    خروجی stream می‌شود و حجمش سقف دارد؛ اگر has_more بود با cursor ادامه بده.
+    بدون cursor همه‌ی گفتگوها برمی‌گردند، با cursor فقط آن‌هایی که اعضایشان عوض شده.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        data = {key: request.query_params[key] for key in ("since", "cursor") if request.query_params.get(key)}
+        if request.query_params.get("after"):
+            data["after"] = parse_after_pairs(request.query_params["after"])
+        return self.sync(request, data)
+
+    def post(self, request):
+        return self.sync(request, request.data)
+
+    def sync(self, request, data):
+        serializer = SyncSerializer(data=data)
+        serializer.is_valid(raise_exception=True)
+        params = serializer.validated_data
+
+        since, after, changed_since = params["since"], params["after"], None
+        if params.get("cursor"):
+            try:
+                since, after, changed_since = decode_sync_cursor(params["cursor"])
+            except InvalidSyncCursor:
+                raise ValidationError({"cursor": "Invalid cursor"})
+
+        sync = DeltaSync(
+            request,
+            get_conversation_ids(request.user.id),
+            since=since,
+            after=after,
+            changed_since=changed_since,
+        )
+        # زیر ASGI به‌صورت async iterator، وگرنه Django کل بدنه را قبل از ارسال جمع می‌کند
+        response = StreamingHttpResponse(streaming_body(request, sync.stream()), content_type="application/json")
+        response["Cache-Control"] = "no-store"
+        return response
+
+
+class InboxView(CompactListMixin, generics.ListAPIView):
+    """
+    GET: اینباکس کاربر — هر گفتگو با آخرین پیام و تعداد نخوانده‌ها،
+    مرتب بر اساس آخرین فعالیت (صفحه‌بندی cursor، بدون COUNT)
+    compact=1: اعضا و فرستنده‌ی آخرین پیام فقط با id، کاربران یک‌بار در users
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = InboxConversationSerializer
+    pagination_class = InboxCursorPagination
+
+    def get_queryset(self):
+        user = self.request.user
+        # نخوانده‌ها هنگام خواندن شمرده می‌شوند، فقط برای گفتگوهای همین صفحه (ایندکس conversation, id)
+        unread = (
+            Message.objects
+            .filter(conversation=OuterRef("pk"), id__gt=OuterRef("last_read_message_id"))
+            .exclude(sender=user)
+            .order_by()
+            .values("conversation")
+            .annotate(n=Count("id"))
+            .values("n")
+        )
+        # از ReadCursorهای کاربر شروع می‌شود (ایندکس user, last_activity_at)، نه از همه‌ی عضویت‌ها
+        return (
+            Conversation.objects
+            .annotate(
+                my_cursor=FilteredRelation("read_cursors", condition=Q(read_cursors__user=user)),
+            )
+            .filter(my_cursor__id__isnull=False)
+            .annotate(
+                inbox_activity_at=F("my_cursor__last_activity_at"),
+                last_read_message_id=F("my_cursor__last_read_message_id"),
+            )
+            .annotate(unread_count=Coalesce(Subquery(unread), 0))
+            .select_related("last_message__sender")
+            .prefetch_related("members", "last_message__attachments__variants")
+        )
+
+
+class PresenceView(APIView):
+    """
+    GET: وضعیت آنلاین و last_seen همه‌ی کسانی که با تو گفتگوی مشترک دارند، در یک درخواست
+    (اختیاری users=1,2,3 برای محدود کردن). از presence store خوانده می‌شود، نه دیتابیس.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request):
+        user_ids = get_contact_ids(request.user.id)
+        if request.query_params.get("users"):
+            try:
+                wanted = {int(u) for u in request.query_params["users"].split(",") if u}
+            except ValueError:
+                raise ValidationError({"users": "Expected comma-separated user ids."})
+            user_ids = user_ids & wanted
+        return Response({"results": presence_of(sorted(user_ids))})
+
+
+class PresenceHeartbeatView(APIView):
+    """
+    POST: heartbeat برای کلاینت‌های بدون WebSocket (هر کمتر از CHAT_PRESENCE_TTL ثانیه)
+    بدنه‌ی اختیاری: device تا چند دستگاه همدیگر را آفلاین نکنند.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        device = str(request.data.get("device") or "default")[:64]
+        if heartbeat(request.user.id, f"http:{device}"):
+            publish_presence(request.user.id, True, get_contact_ids(request.user.id))
+        return Response({"ttl": settings.CHAT_PRESENCE_TTL})
+
+
+class TypingView(APIView):
+    """
+    POST: «در حال تایپ» در یک گفتگو؛ بدنه‌ی اختیاری {"typing": false} برای توقف
+    رویدادهای پشت‌سرهم ادغام می‌شوند و سقف نرخ دارند؛ sent=false یعنی این یکی پخش نشد.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, conversation_id):
+        if not is_member(request.user.id, conversation_id):
+            raise NotFound()
+        typing = request.data.get("typing", True) not in (False, "false", "0", 0)
+        sent = allow_typing(request.user.id, conversation_id, typing)
+        if sent:
+            publish_typing(conversation_id, request.user.id, typing)
+        return Response({"sent": sent}, status=status.HTTP_202_ACCEPTED)
+
+
+class MarkReadView(APIView):
+    """
+    POST: علامت‌گذاری پیام‌ها به‌عنوان خوانده‌شده تا message_id
+    (بدون message_id = تا آخرین پیام)
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, conversation_id):
+        conv = generics.get_object_or_404(
+            Conversation.objects.filter(members=request.user), id=conversation_id
+        )
+        serializer = MarkReadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        message_id = serializer.validated_data.get("message_id") or conv.last_message_id or 0
+
+        with transaction.atomic():
+            cursor, _ = ReadCursor.objects.select_for_update().get_or_create(
+                conversation=conv, user=request.user
+            )
+            if message_id > cursor.last_read_message_id:
+                cursor.last_read_message_id = message_id
+                cursor.save(update_fields=["last_read_message_id", "updated_at"])
+
+        # فقط پیام‌های بعد از cursor شمرده می‌شوند (ایندکس conversation, id)
+        unread_count = (
+            Message.objects.filter(conversation=conv, id__gt=cursor.last_read_message_id)
+            .exclude(sender=request.user)
+            .count()
+        )
+        return Response(
+            {
+                "conversation": conv.id,
+                "last_read_message_id": cursor.last_read_message_id,
+                "unread_count": unread_count,
+            },
+            status=status.HTTP_200_OK,
+        )
+
+
+class UploadCreateView(APIView):
+    """
+    POST: شروع آپلود تکه‌ای (resumable)
+      - filename، size (الزامی)، content_type و sha256 (اختیاری)
+    سپس PUT تکه‌ها روی uploads/<id>/ با هدر Upload-Offset و در آخر POST .../complete/
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [UserBucketThrottle]
+    throttle_scope = "upload"
+
+    def post(self, request):
+        serializer = UploadSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        upload = serializer.save(user=request.user)
+        return Response(serializer.data, status=status.HTTP_201_CREATED, headers=upload_headers(upload))
+
+
+class UploadDetailView(ConcurrencyLimitMixin, APIView):
+    """
+    GET/HEAD: وضعیت آپلود و offset تأییدشده (برای ادامه بعد از قطع اتصال)
+    PUT: بدنه‌ی خام = تکه‌ی بعدی؛ هدر Upload-Offset باید با offset فعلی برابر باشد
+    DELETE: لغو آپلود
+    نرخ و تعداد همزمان تکه‌ها برای هر کاربر/کل سرور محدود است (429/503 با Retry-After)
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [UserBucketThrottle]
+    throttle_scope = "upload"
+    concurrency_scope = "upload"
+
+    def get_upload(self, request, upload_id):
+        return generics.get_object_or_404(Upload, id=upload_id, user=request.user)
+
+    def get(self, request, upload_id):
+        upload = self.get_upload(request, upload_id)
+        return Response(UploadSerializer(upload).data, headers=upload_headers(upload))
+
+    def put(self, request, upload_id):
+        upload = self.get_upload(request, upload_id)
+        if upload.status != Upload.PENDING:
+            return Response({"detail": "Upload is already complete."}, status=status.HTTP_409_CONFLICT)
+
+        raw_offset = request.headers.get("Upload-Offset", request.query_params.get("offset"))
+        try:
+            offset = int(raw_offset)
+        except (TypeError, ValueError):
+            raise ValidationError({"offset": "Upload-Offset header is required."})
+        if offset != upload.offset:
+            return self.offset_conflict(upload)
+
+        try:
+            # یک نویسنده در هر لحظه؛ PUT همزمان دوم به‌جای نوشتن روی همان فایل 409 می‌گیرد
+            with locked_partial(upload) as fh:
+                # offset زیر قفل دوباره خوانده می‌شود؛ شاید درخواست قبلی همین حالا تمام شده باشد
+                upload.refresh_from_db(fields=["offset", "status"])
+                if upload.status != Upload.PENDING or offset != upload.offset:
+                    return self.offset_conflict(upload)
+                # بدنه مستقیم از stream خوانده می‌شود (نه request.body) تا در حافظه بافر نشود
+                try:
+                    written = write_chunk(fh, upload, request.stream, offset)
+                except UploadOverflow:
+                    raise ValidationError({"detail": "Chunk exceeds the declared upload size."})
+
+                # هر چه روی دیسک نشسته تأیید می‌شود؛ کلاینت از همان‌جا ادامه می‌دهد
+                updated = Upload.objects.filter(pk=upload.pk, offset=offset, status=Upload.PENDING).update(
+                    offset=offset + written, updated_at=timezone.now()
+                )
+        except UploadBusy:
+            return Response(
+                {"detail": "Another request is writing this upload.", "offset": upload.offset},
+                status=status.HTTP_409_CONFLICT,
+                headers=upload_headers(upload),
+            )
+        except Upload.DoesNotExist:
+            raise NotFound()
+        if not updated:
+            # در این فاصله کامل یا از نو شروع شده؛ این تکه تأیید نمی‌شود
+            upload.refresh_from_db(fields=["offset", "status"])
+            return self.offset_conflict(upload)
+
+        upload.offset = offset + written
+        return Response(UploadSerializer(upload).data, headers=upload_headers(upload))
+
+    def offset_conflict(self, upload):
+        if upload.status != Upload.PENDING:
+            return Response({"detail": "Upload is already complete."}, status=status.HTTP_409_CONFLICT)
+        return Response(
+            {"detail": "Offset mismatch.", "offset": upload.offset},
+            status=status.HTTP_409_CONFLICT,
+            headers=upload_headers(upload),
+        )
+
+    def delete(self, request, upload_id):
+        upload = self.get_upload(request, upload_id)
+        if upload.status == Upload.ATTACHED:
+            return Response({"detail": "Upload is attached to a message."}, status=status.HTTP_409_CONFLICT)
+        discard_partial(upload)
+        if upload.file and upload.blob_id is None:
+            upload.file.delete(save=False)
+        # blob شاید مشترک باشد؛ اگر بی‌استفاده بماند collect_blobs پاکش می‌کند
+        upload.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class BlobDetailView(APIView):
+    """
+    GET/HEAD: آیا سرور این محتوا را دارد؟ (قبل از آپلود، با sha256 فایل)
+    200 یعنی بدون آپلود در blobs ارسال پیام بفرست؛ 404 یعنی آپلود کن.
+    فقط blobهایی که خودت آپلود کرده‌ای یا در گفتگوهایت دیده می‌شوند.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, sha256):
+        blob = accessible_blobs(request.user, [sha256.lower()]).get(sha256.lower())
+        if blob is None:
+            raise NotFound()
+        return Response({"sha256": blob.sha256, "size": blob.size, "content_type": blob.content_type})
+
+
+class UploadCompleteView(ConcurrencyLimitMixin, APIView):
+    """
+    POST: پایان آپلود — بررسی حجم و sha256، انتقال فایل به storage
+    بعد از این، id آپلود در upload_ids ارسال پیام قابل استفاده است.
+    """
+    permission_classes = [IsAuthenticated]
+    throttle_classes = [UserBucketThrottle]
+    throttle_scope = "upload"
+    concurrency_scope = "upload"
+
+    def post(self, request, upload_id):
+        upload = generics.get_object_or_404(Upload, id=upload_id, user=request.user)
+        if upload.status != Upload.PENDING:
+            return Response(UploadSerializer(upload).data)
+
+        serializer = UploadCompleteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        try:
+            # زیر همان قفل PUT، تا فایل وسط نوشتن hash یا منتقل نشود
+            with locked_partial(upload):
+                upload.refresh_from_db()
+                if upload.status != Upload.PENDING:
+                    return Response(UploadSerializer(upload).data)
+                return self.complete(upload, serializer.validated_data.get("sha256"))
+        except UploadBusy:
+            return Response(
+                {"detail": "Another request is writing this upload.", "offset": upload.offset},
+                status=status.HTTP_409_CONFLICT,
+                headers=upload_headers(upload),
+            )
+        except Upload.DoesNotExist:
+            raise NotFound()
+
+    def complete(self, upload, sha256):
+        if upload.offset != upload.size:
+            return Response(
+                {"detail": "Upload is incomplete.", "offset": upload.offset},
+                status=status.HTTP_409_CONFLICT,
+                headers=upload_headers(upload),
+            )
+
+        expected = (sha256 or upload.sha256).lower()
+        actual = file_sha256(partial_path(upload))
+        if expected and expected != actual:
+            # فایل خراب است؛ از اول باید فرستاده شود
+            discard_partial(upload)
+            Upload.objects.filter(pk=upload.pk).update(offset=0)
+            return Response(
+                {"detail": "Checksum mismatch, upload restarted.", "offset": 0},
+                status=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            )
+
+        # اگر همین محتوا قبلاً ذخیره شده، فقط به همان blob وصل می‌شود
+        with open(partial_path(upload), "rb") as fh:
+            blob = store_blob(File(fh), actual, upload.size, upload.content_type)
+        discard_partial(upload)
+        upload.blob = blob
+        upload.file = blob.file.name
+        upload.sha256 = actual
+        upload.status = Upload.COMPLETE
+        upload.save(update_fields=["blob", "file", "sha256", "status", "updated_at"])
+        return Response(UploadSerializer(upload).data, status=status.HTTP_200_OK)
+
+
+class AttachmentDownloadView(APIView):
+    """
+    GET/HEAD: دانلود فایل پیوست (فقط برای اعضای گفتگو)
+    پشتیبانی از Range (ادامه‌ی دانلود / پخش ویدیو)، ETag و Last-Modified (304)
+    و در صورت تنظیم ATTACHMENT_SENDFILE، سپردن انتقال به nginx/Apache
+    ?download=1 → Content-Disposition: attachment
+    ?variant=thumb → نسخه‌ی کوچک‌شده‌ی تصویر
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, attachment_id):
+        attachment = generics.get_object_or_404(
+            MessageAttachment.objects.filter(message__conversation__members=request.user),
+            id=attachment_id,
+        )
+        as_attachment = request.query_params.get("download") == "1"
+        variant_name = request.query_params.get("variant")
+        if variant_name:
+            variant = generics.get_object_or_404(attachment.variants, name=variant_name)
+            return serve_variant(request, variant, as_attachment=as_attachment)
+        return serve_attachment(request, attachment, as_attachment=as_attachment)
+
+
+class ConversationExportView(APIView):
+    """
+    GET: خروجی کامل تاریخچه‌ی گفتگو (برای compliance) به صورت stream
+    ?as=ndjson (پیش‌فرض) یا ?as=csv، و ?gzip=1 برای فایل فشرده
+    فقط اعضای گفتگو یا کاربران staff؛ حافظه مستقل از طول تاریخچه است.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, conversation_id):
+        user = request.user
+        if user.is_staff:
+            allowed = Conversation.objects.filter(pk=conversation_id).exists()
+        else:
+            allowed = is_member(user.id, conversation_id)
+        if not allowed:
+            raise NotFound()
+
+        fmt = request.query_params.get("as") or "ndjson"
+        if fmt not in EXPORT_FORMATS:
+            raise ValidationError({"as": f"Expected one of: {', '.join(EXPORT_FORMATS)}."})
+        compress = request.query_params.get("gzip") == "1"
+
+        content_type, ext = EXPORT_FORMATS[fmt]
+        filename = f"conversation-{conversation_id}.{ext}"
+        if compress:
+            content_type, filename = "application/gzip", filename + ".gz"
+        # زیر ASGI هر بلوک (و هر batch کلیدی که لازم دارد) با sync_to_async ساخته می‌شود، نه همه یک‌جا
+        response = StreamingHttpResponse(
+            streaming_body(request, export_stream(conversation_id, fmt, compress=compress)),
+            content_type=content_type,
+        )
+        response["Content-Disposition"] = content_disposition_header(True, filename)
+        response["Cache-Control"] = "no-store"
+        return response
+
+
+def attachments_from_uploads(msg, uploads):
+    return [
+        MessageAttachment(
+            message=msg, blob_id=up.blob_id, file=up.file.name, name=up.filename,
+            content_type=up.content_type, size=up.size,
+        )
+        for up in uploads or []
+    ]
+
+
+def attachments_from_blobs(msg, refs):
+    """refs: [(blob, name, content_type), ...] از MessageCreateSerializer"""
+    return [
+        MessageAttachment(
+            message=msg, blob=blob, file=blob.file.name, name=name,
+            content_type=content_type or blob.content_type, size=blob.size,
+        )
+        for blob, name, content_type in refs or []
+    ]
+
+
+def create_attachments(attachments, upload_groups):
+    """
+    آپلودهای کامل را (یک‌بار) برمی‌دارد، همه‌ی پیوست‌ها را با یک insert می‌سازد
+    و پیش‌نمایش‌ها را صف می‌کند. فقط داخل تراکنش ارسال صدا زده شود.
+    """
+    upload_ids = [up.id for group in upload_groups for up in group or []]
+    if upload_ids:
+        claimed = Upload.objects.filter(
+            id__in=upload_ids, status=Upload.COMPLETE
+        ).update(status=Upload.ATTACHED)
+        if claimed != len(upload_ids):
+            raise ValidationError({"upload_ids": "Upload already attached."})
+    if attachments:
+        MessageAttachment.objects.bulk_create(attachments)
+        add_refs(a.blob_id for a in attachments)
+        # thumbnail / placeholder در پس‌زمینه، بعد از commit
+        schedule_previews(a.id for a in attachments)
+
+
+def upload_headers(upload):
+    return {"Upload-Offset": str(upload.offset), "Upload-Length": str(upload.size)}
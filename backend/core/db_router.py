@@ -0,0 +1,114 @@
+import hashlib
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.decorators import sync_and_async_middleware
+
+# True while the current request/task must read from the primary
+_pinned = ContextVar("db_pinned", default=False)
+
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+def replica_aliases():
+    return getattr(settings, "DATABASE_REPLICAS", [])
+
+
+def is_pinned():
+    return _pinned.get()
+
+
+@contextmanager
+def use_primary():
+    """Route every read inside the block to ``default``."""
+    token = _pinned.set(True)
+    try:
+        yield
+    finally:
+        _pinned.reset(token)
+
+
+class ReplicaRouter:
+    """
+    Writes go to ``default``; reads go to a random alias from
+    ``DATABASE_REPLICAS`` unless the current context is pinned to the
+    primary. Without replicas every call falls through to ``default``.
+    """
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get("instance")
+        if instance is not None and instance._state.db:
+            # related lookups follow the object they start from
+            return instance._state.db
+        replicas = replica_aliases()
+        if not replicas or is_pinned():
+            return "default"
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        return "default"
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == "default"
+
+
+def pin_key(request):
+    credential = request.headers.get("Authorization") or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    if not credential:
+        return None
+    return "db:pin:" + hashlib.sha256(credential.encode()).hexdigest()
+
+
+@sync_and_async_middleware
+def ReplicaPinningMiddleware(get_response):
+    """
+    Read-your-writes: an unsafe request reads from the primary for its whole
+    duration, and a successful one keeps the same client (token or session)
+    on the primary for ``DATABASE_REPLICA_PIN_SECONDS`` so the message it
+    just sent is visible on the next history fetch despite replica lag.
+    """
+
+    def should_pin(response, key, writing):
+        return writing and key is not None and response.status_code < 400
+
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            if not replica_aliases():
+                return await get_response(request)
+            key = pin_key(request)
+            writing = request.method not in SAFE_METHODS
+            token = _pinned.set(writing or (key is not None and await cache.aget(key) is not None))
+            try:
+                response = await get_response(request)
+            finally:
+                _pinned.reset(token)
+            if should_pin(response, key, writing):
+                await cache.aset(key, 1, settings.DATABASE_REPLICA_PIN_SECONDS)
+            return response
+
+    else:
+
+        def middleware(request):
+            if not replica_aliases():
+                return get_response(request)
+            key = pin_key(request)
+            writing = request.method not in SAFE_METHODS
+            token = _pinned.set(writing or (key is not None and cache.get(key) is not None))
+            try:
+                response = get_response(request)
+            finally:
+                _pinned.reset(token)
+            if should_pin(response, key, writing):
+                cache.set(key, 1, settings.DATABASE_REPLICA_PIN_SECONDS)
+            return response
+
+    return middleware
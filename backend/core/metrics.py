@@ -0,0 +1,280 @@
+"""
+Per-view request metrics kept in process memory and exported in the
+Prometheus text format at ``/metrics``.
+
+Every request records wall time, status and response size. A sampled share
+(``METRICS_SAMPLE_RATE``) also records DB query count/time, through an
+execute wrapper on each connection, and serializer time. Sampled requests
+slower than ``METRICS_SLOW_REQUEST_MS`` are logged with their slowest
+queries. Numbers are per worker process; scrape each worker (or run one
+per container) to see them all.
+"""
+import logging
+import random
+import threading
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.http import HttpResponse, HttpResponseForbidden
+from django.utils.decorators import sync_and_async_middleware
+
+logger = logging.getLogger("core.metrics")
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+# stats of the request being handled in this context (None outside requests)
+_current = ContextVar("request_metrics", default=None)
+
+
+class Counter:
+    def __init__(self, name, help_text, labels):
+        self.name, self.help, self.labels = name, help_text, labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for label_values, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{{{format_labels(self.labels, label_values)}}} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels, buckets):
+        self.name, self.help, self.labels, self.buckets = name, help_text, labels, buckets
+        self.values = {}  # label values -> [bucket counts..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, label_values, value):
+        index = bisect_left(self.buckets, value)
+        with self.lock:
+            row = self.values.get(label_values)
+            if row is None:
+                row = self.values[label_values] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                row[index] += 1
+            row[-2] += value
+            row[-1] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, row in sorted(self.values.items()):
+                labels = format_labels(self.labels, label_values)
+                cumulative = 0
+                for bound, count in zip(self.buckets, row):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_bucket{{{labels},le="+Inf"}} {row[-1]}')
+                lines.append(f"{self.name}_sum{{{labels}}} {round(row[-2], 6)}")
+                lines.append(f"{self.name}_count{{{labels}}} {row[-1]}")
+        return lines
+
+
+def format_labels(names, values):
+    return ",".join(f'{name}="{escape_label(value)}"' for name, value in zip(names, values))
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+REQUESTS = Counter("http_requests_total", "Requests by view, method and status.", ("view", "method", "status"))
+DURATION = Histogram("http_request_duration_seconds", "Wall time per request.", ("view", "method"), TIME_BUCKETS)
+RESPONSE_SIZE = Histogram("http_response_size_bytes", "Response body size.", ("view", "method"), SIZE_BUCKETS)
+DB_QUERIES = Histogram("db_queries_per_request", "DB queries per sampled request.", ("view", "method"), COUNT_BUCKETS)
+DB_TIME = Histogram("db_time_seconds", "DB time per sampled request.", ("view", "method"), TIME_BUCKETS)
+SERIALIZER_TIME = Histogram(
+    "serializer_time_seconds", "Serializer time per sampled request.", ("view", "method"), TIME_BUCKETS
+)
+METRICS = [REQUESTS, DURATION, RESPONSE_SIZE, DB_QUERIES, DB_TIME, SERIALIZER_TIME]
+
+
+class RequestStats:
+    __slots__ = ("queries", "db_time", "serializer_time", "serializer_depth", "slowest")
+
+    def __init__(self):
+        self.queries = 0
+        self.db_time = 0.0
+        self.serializer_time = 0.0
+        self.serializer_depth = 0
+        self.slowest = []  # (seconds, sql), trimmed to METRICS_SLOW_QUERY_COUNT
+
+    def record_query(self, sql, seconds):
+        self.queries += 1
+        self.db_time += seconds
+        keep = settings.METRICS_SLOW_QUERY_COUNT
+        if len(self.slowest) < keep or seconds > self.slowest[-1][0]:
+            self.slowest.append((seconds, sql))
+            self.slowest.sort(key=lambda item: item[0], reverse=True)
+            del self.slowest[keep:]
+
+
+# ---- instrumentation hooks ----
+
+def db_wrapper(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        stats.record_query(sql, time.perf_counter() - started)
+
+
+def install_db_wrapper(connection, **kwargs):
+    if db_wrapper not in connection.execute_wrappers:
+        # innermost, and out of the way of execute_wrapper()'s append/pop
+        connection.execute_wrappers.insert(0, db_wrapper)
+
+
+_serializers_patched = False
+
+
+def instrument_serializers():
+    """Time the outermost ``serializer.data`` evaluation of each request."""
+    global _serializers_patched
+    if _serializers_patched:
+        return
+    from rest_framework.serializers import BaseSerializer
+
+    original = BaseSerializer.data.fget
+
+    def timed_data(self):
+        stats = _current.get()
+        if stats is None or hasattr(self, "_data"):
+            return original(self)
+        stats.serializer_depth += 1
+        started = time.perf_counter()
+        try:
+            return original(self)
+        finally:
+            stats.serializer_depth -= 1
+            if stats.serializer_depth == 0:
+                stats.serializer_time += time.perf_counter() - started
+
+    BaseSerializer.data = property(timed_data)
+    _serializers_patched = True
+
+
+# ---- middleware ----
+
+def view_label(request):
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return "unmatched"
+    return match.view_name or match.route or "unnamed"
+
+
+def begin(request):
+    if random.random() >= settings.METRICS_SAMPLE_RATE:
+        return None, None
+    # connections opened earlier in this thread predate the signal handler
+    for conn in connections.all(initialized_only=True):
+        install_db_wrapper(conn)
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def finish(request, response, started, stats, token):
+    elapsed = time.perf_counter() - started
+    if token is not None:
+        _current.reset(token)
+    labels = (view_label(request), request.method)
+
+    REQUESTS.inc(labels + (response.status_code,))
+    DURATION.observe(labels, elapsed)
+    if not response.streaming:
+        RESPONSE_SIZE.observe(labels, len(response.content))
+    elif response.has_header("Content-Length"):
+        RESPONSE_SIZE.observe(labels, int(response["Content-Length"]))
+
+    if stats is None:
+        return
+    DB_QUERIES.observe(labels, stats.queries)
+    DB_TIME.observe(labels, stats.db_time)
+    SERIALIZER_TIME.observe(labels, stats.serializer_time)
+    if elapsed * 1000 >= settings.METRICS_SLOW_REQUEST_MS:
+        logger.warning(
+            "slow request %s %s view=%s status=%s total=%.1fms db=%.1fms/%d queries serializer=%.1fms\n%s",
+            request.method,
+            request.path,
+            labels[0],
+            response.status_code,
+            elapsed * 1000,
+            stats.db_time * 1000,
+            stats.queries,
+            stats.serializer_time * 1000,
+            "\n".join(f"  {seconds * 1000:.1f}ms {sql[:500]}" for seconds, sql in stats.slowest),
+        )
+
+
+@sync_and_async_middleware
+def MetricsMiddleware(get_response):
+    if not settings.METRICS_ENABLED:
+        return get_response
+    connection_created.connect(install_db_wrapper, dispatch_uid="core.metrics.db_wrapper")
+    instrument_serializers()
+
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            started = time.perf_counter()
+            stats, token = begin(request)
+            try:
+                response = await get_response(request)
+            except BaseException:
+                if token is not None:
+                    _current.reset(token)
+                raise
+            finish(request, response, started, stats, token)
+            return response
+
+    else:
+
+        def middleware(request):
+            started = time.perf_counter()
+            stats, token = begin(request)
+            try:
+                response = get_response(request)
+            except BaseException:
+                if token is not None:
+                    _current.reset(token)
+                raise
+            finish(request, response, started, stats, token)
+            return response
+
+    return middleware
+
+
+# ---- export ----
+
+def render_metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    """Prometheus scrape target; bearer METRICS_TOKEN or an allowed address."""
+    token = settings.METRICS_TOKEN
+    authorized = (
+        token and request.headers.get("Authorization") == f"Bearer {token}"
+    ) or request.META.get("REMOTE_ADDR") in settings.METRICS_ALLOWED_IPS
+    if not authorized:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type="text/plain; version=0.0.4; charset=utf-8")
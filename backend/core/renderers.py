@@ -0,0 +1,50 @@
+"""
+Faster response encoders, picked by content negotiation.
+
+``ORJSONRenderer`` serves ``application/json`` with the same bytes as DRF's
+JSONRenderer (compact, UTF-8, DRF's encoding of dates/decimals/lazy strings)
+at a fraction of the encode time; it falls back to DRF when orjson is not
+installed or indented output is asked for. ``MessagePackRenderer`` serves
+``Accept: application/msgpack`` (or ``?format=msgpack``) for clients that
+can decode it: smaller than JSON and cheaper to parse on phones.
+"""
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - optional speed-up
+    orjson = None
+
+
+class ORJSONRenderer(JSONRenderer):
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        if (
+            orjson is None
+            or not (self.compact and not self.ensure_ascii)
+            or self.get_indent(accepted_media_type, renderer_context or {}) is not None
+        ):
+            return super().render(data, accepted_media_type, renderer_context)
+        ret = orjson.dumps(
+            data,
+            default=self.encoder_class().default,
+            # datetimes through DRF's encoder, so they render exactly as before
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME,
+        )
+        return ret.replace("\u2028".encode(), b"\\u2028").replace("\u2029".encode(), b"\\u2029")
+
+
+class MessagePackRenderer(BaseRenderer):
+    media_type = "application/msgpack"
+    format = "msgpack"
+    charset = None
+    render_style = "binary"
+    encoder_class = JSONRenderer.encoder_class
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b""
+        import msgpack
+
+        return msgpack.packb(data, default=self.encoder_class().default, use_bin_type=True)
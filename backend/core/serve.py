@@ -0,0 +1,51 @@
+"""
+Production entry point: ``python -m core.serve``.
+
+Runs the ASGI application (HTTP + WebSocket) with a pool of worker
+processes. Configured through the environment:
+
+    WEB_SERVER       uvicorn (default) or daphne
+    HOST / PORT      bind address, default 0.0.0.0:8000
+    WEB_CONCURRENCY  worker processes for uvicorn, default 2 x CPUs + 1
+    WEB_KEEPALIVE    keep-alive timeout in seconds, default 5
+    FORWARDED_ALLOW_IPS  proxies whose X-Forwarded-For gives the client
+                     address (what per-IP rate limits see), default 127.0.0.1
+
+With more than one worker, REDIS_URL must be set so the Channels layer
+and caches are shared between processes. daphne has no worker pool;
+run several instances behind the proxy instead.
+"""
+
+import multiprocessing
+import os
+
+
+def main():
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "core.settings")
+    server = os.getenv("WEB_SERVER", "uvicorn")
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8000"))
+
+    if server == "daphne":
+        os.execvp("daphne", [
+            "daphne", "--bind", host, "--port", str(port), "--proxy-headers",
+            "core.asgi:application",
+        ])
+
+    import uvicorn
+
+    uvicorn.run(
+        "core.asgi:application",
+        host=host,
+        port=port,
+        workers=int(os.getenv("WEB_CONCURRENCY", str(multiprocessing.cpu_count() * 2 + 1))),
+        timeout_keep_alive=int(os.getenv("WEB_KEEPALIVE", "5")),
+        proxy_headers=True,
+        forwarded_allow_ips=os.getenv("FORWARDED_ALLOW_IPS", "127.0.0.1"),
+        # the Channels router does not speak the lifespan protocol
+        lifespan="off",
+    )
+
+
+if __name__ == "__main__":
+    main()
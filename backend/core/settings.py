@@ -40,13 +40,17 @@ INSTALLED_APPS = [
     'django.contrib.staticfiles',
     'rest_framework',
     'rest_framework.authtoken',
+    'channels',
     'users',
     'chat',
 
 ]
 
 MIDDLEWARE = [
+    'core.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'core.db_router.ReplicaPinningMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -73,19 +77,90 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'core.wsgi.application'
+ASGI_APPLICATION = 'core.asgi.application'
+
+# Channels: Redis in production (REDIS_URL), in-memory for dev/tests.
+# The in-memory layer only works within a single process.
+REDIS_URL = os.getenv("REDIS_URL", "")
+if REDIS_URL:
+    CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [REDIS_URL]},
+        }
+    }
+else:
+    CHANNEL_LAYERS = {
+        "default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}
+    }
 
 
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-DATABASES = {
-    "default": dj_database_url.config(
-        env="DATABASE_URL",
-        default=f"sqlite:///{BASE_DIR / 'db.sqlite3'}",
-        conn_max_age=600,
+# DB_POOL_MAX_SIZE > 0 switches Postgres to psycopg 3's native pool;
+# pooled connections replace persistent ones (CONN_MAX_AGE must be 0).
+# Without the pool connections close after each request: under ASGI every
+# request runs in its own thread, so a persistent connection would never be
+# reused and they would pile up. DB_CONN_MAX_AGE only pays off under WSGI.
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "0"))
+DB_CONN_MAX_AGE = 0 if DB_POOL_MAX_SIZE else int(os.getenv("DB_CONN_MAX_AGE", "0"))
+
+
+def database_config(url):
+    config = dj_database_url.parse(
+        url,
+        conn_max_age=DB_CONN_MAX_AGE,
+        conn_health_checks=True,
     )
+    if DB_POOL_MAX_SIZE and config.get("ENGINE") == "django.db.backends.postgresql":
+        config.setdefault("OPTIONS", {})["pool"] = {
+            "min_size": int(os.getenv("DB_POOL_MIN_SIZE", "2")),
+            "max_size": DB_POOL_MAX_SIZE,
+            "timeout": float(os.getenv("DB_POOL_TIMEOUT", "10")),
+        }
+    return config
+
+
+DATABASES = {
+    "default": database_config(os.getenv("DATABASE_URL") or f"sqlite:///{BASE_DIR / 'db.sqlite3'}"),
 }
 
+# Read replicas: comma-separated URLs in DATABASE_REPLICA_URLS become the
+# aliases replica1, replica2, ... Reads are spread over them by
+# core.db_router.ReplicaRouter; writes and pinned requests use default.
+DATABASE_REPLICAS = []
+for index, url in enumerate(filter(None, os.getenv("DATABASE_REPLICA_URLS", "").split(",")), start=1):
+    alias = f"replica{index}"
+    DATABASES[alias] = database_config(url.strip())
+    # the test runner points replicas at the test primary instead of creating copies
+    DATABASES[alias]["TEST"] = {"MIRROR": "default"}
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ["core.db_router.ReplicaRouter"]
+
+# How long a client keeps reading from the primary after a successful write
+DATABASE_REPLICA_PIN_SECONDS = int(os.getenv("DATABASE_REPLICA_PIN_SECONDS", "5"))
+
+# Cache: shared Redis when REDIS_URL is set, per-process memory otherwise.
+# Holds token->user lookups, per-user conversation membership sets and the
+# version counters / serialized pages of the user and conversation lists.
+if REDIS_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+
+AUTH_TOKEN_CACHE_TTL = int(os.getenv("AUTH_TOKEN_CACHE_TTL", "300"))
+MEMBERSHIP_CACHE_TTL = int(os.getenv("MEMBERSHIP_CACHE_TTL", "600"))
+LIST_RESPONSE_CACHE_TTL = int(os.getenv("LIST_RESPONSE_CACHE_TTL", "600"))
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 
@@ -121,6 +196,14 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/5.2/howto/static-files/
 
 STATIC_URL = 'static/'
+STATIC_ROOT = BASE_DIR / "staticfiles"
+
+# whitenoise serves collected static files (compressed, hashed names)
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {"BACKEND": "whitenoise.storage.CompressedManifestStaticFilesStorage"},
+}
+WHITENOISE_MANIFEST_STRICT = False
 
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
@@ -128,12 +211,152 @@ STATIC_URL = 'static/'
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 REST_FRAMEWORK = {
     "DEFAULT_AUTHENTICATION_CLASSES": [
-        "rest_framework.authentication.TokenAuthentication",
+        "users.authentication.CachedTokenAuthentication",
     ],
     "DEFAULT_PERMISSION_CLASSES": [
         "rest_framework.permissions.IsAuthenticated",
     ],
+    # orjson for application/json (same output as DRF's), MessagePack on request
+    "DEFAULT_RENDERER_CLASSES": [
+        "core.renderers.ORJSONRenderer",
+        "core.renderers.MessagePackRenderer",
+        "rest_framework.renderers.BrowsableAPIRenderer",
+    ],
+    # per-IP rate limits key on REMOTE_ADDR, never on a client-supplied
+    # X-Forwarded-For; the ASGI server already sets REMOTE_ADDR from the
+    # header when the peer is in FORWARDED_ALLOW_IPS (see core.serve)
+    "NUM_PROXIES": int(os.getenv("NUM_PROXIES", "0")),
 }
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "media"
+
+# Attachment downloads: "" streams from Django, "nginx" sends X-Accel-Redirect
+# to ATTACHMENT_ACCEL_PREFIX + file name (an `internal` location aliased to
+# MEDIA_ROOT), "xsendfile" sends X-Sendfile with the absolute path.
+ATTACHMENT_SENDFILE = os.getenv("ATTACHMENT_SENDFILE", "")
+ATTACHMENT_ACCEL_PREFIX = os.getenv("ATTACHMENT_ACCEL_PREFIX", "/protected-media/")
+
+# Image previews: variant name -> longest edge in px (smallest first).
+# Generated off the request path in a thread pool; SYNC runs them inline.
+ATTACHMENT_PREVIEW_SIZES = {"thumb": 320, "medium": 1280}
+ATTACHMENT_PREVIEW_WORKERS = int(os.getenv("ATTACHMENT_PREVIEW_WORKERS", "2"))
+ATTACHMENT_PREVIEW_SYNC = os.getenv("ATTACHMENT_PREVIEW_SYNC", "0") == "1"
+
+# Serve the async variants of MessageListView / MessageSendView (use under ASGI).
+CHAT_ASYNC_VIEWS = os.getenv("CHAT_ASYNC_VIEWS", "0") == "1"
+
+# Upper bound on messages per batch send request.
+MESSAGE_BATCH_MAX = int(os.getenv("MESSAGE_BATCH_MAX", "500"))
+
+# Chunked uploads: partial files live here until they are completed;
+# expire_uploads deletes pending uploads that received no chunk, and
+# completed ones not attached to a message, for CHUNKED_UPLOAD_EXPIRE_SECONDS.
+CHUNKED_UPLOAD_DIR = os.getenv("CHUNKED_UPLOAD_DIR", str(BASE_DIR / "uploads_partial"))
+CHUNKED_UPLOAD_MAX_SIZE = int(os.getenv("CHUNKED_UPLOAD_MAX_SIZE", str(8 * 1024 ** 3)))
+CHUNKED_UPLOAD_EXPIRE_SECONDS = int(os.getenv("CHUNKED_UPLOAD_EXPIRE_SECONDS", str(24 * 3600)))
+
+# Attachments are stored once per content hash (chat.blobs). Multipart files
+# are hashed while they stream in; collect_blobs deletes blobs unused for
+# BLOB_GC_GRACE_SECONDS.
+FILE_UPLOAD_HANDLERS = [
+    "chat.uploads.HashingMemoryFileUploadHandler",
+    "chat.uploads.HashingTemporaryFileUploadHandler",
+]
+BLOB_GC_GRACE_SECONDS = int(os.getenv("BLOB_GC_GRACE_SECONDS", str(24 * 3600)))
+
+# Long-poll (?wait=N on message sync): upper bound on N in seconds, and how
+# waiting requests are woken ("redis" across workers, "local" in-process).
+CHAT_LONGPOLL_MAX_WAIT = int(os.getenv("CHAT_LONGPOLL_MAX_WAIT", "30"))
+CHAT_NOTIFIER = os.getenv("CHAT_NOTIFIER", "redis" if REDIS_URL else "local")
+
+# Multi-conversation poll: most conversations per request, most messages returned.
+CHAT_POLL_MAX_CONVERSATIONS = 100
+CHAT_POLL_MAX_MESSAGES = 200
+
+# Inbox order lives on each member's ReadCursor. A send moves the
+# conversation up for at most CHAT_INBOX_INLINE_BUMP members in its own
+# transaction (all of them in small groups); the push worker does the rest.
+CHAT_INBOX_INLINE_BUMP = int(os.getenv("CHAT_INBOX_INLINE_BUMP", "50"))
+
+# Presence / typing (chat.presence): kept only in the presence store ("redis"
+# across workers, "local" in-process), never in the database. A connection
+# is online for CHAT_PRESENCE_TTL seconds after its last heartbeat (the
+# expire_presence worker announces users whose last one lapsed); typing
+# events are coalesced to one per CHAT_TYPING_COALESCE seconds per
+# conversation, capped at CHAT_TYPING_RATE per user per minute, and shown
+# by clients for CHAT_TYPING_TTL seconds.
+CHAT_PRESENCE_STORE = os.getenv("CHAT_PRESENCE_STORE", "redis" if REDIS_URL else "local")
+CHAT_PRESENCE_TTL = int(os.getenv("CHAT_PRESENCE_TTL", "60"))
+CHAT_TYPING_TTL = 6
+CHAT_TYPING_COALESCE = 3
+CHAT_TYPING_RATE = 30
+
+# Push notifications (chat.push): the send transaction writes one outbox row
+# per message; the send_push_notifications worker fans it out to members in
+# CHAT_PUSH_CHUNK_SIZE chunks on CHAT_PUSH_WORKERS threads, retrying failures
+# with exponential backoff (CHAT_PUSH_RETRY_BASE doubling up to
+# CHAT_PUSH_RETRY_MAX seconds) for CHAT_PUSH_MAX_ATTEMPTS attempts. A claim
+# holds rows for CHAT_PUSH_LEASE_SECONDS, renewed while chunks are in flight.
+# CHAT_PUSH_NOTIFIER is the dotted path of a class with send(user_ids, payload).
+CHAT_PUSH_NOTIFIER = os.getenv("CHAT_PUSH_NOTIFIER", "chat.push.LocalPushNotifier")
+CHAT_PUSH_WEBHOOK_URL = os.getenv("CHAT_PUSH_WEBHOOK_URL", "")
+CHAT_PUSH_TIMEOUT = 10
+CHAT_PUSH_BATCH_SIZE = 50
+CHAT_PUSH_CHUNK_SIZE = 500
+CHAT_PUSH_WORKERS = int(os.getenv("CHAT_PUSH_WORKERS", "8"))
+CHAT_PUSH_MAX_ATTEMPTS = 10
+CHAT_PUSH_RETRY_BASE = 5
+CHAT_PUSH_RETRY_MAX = 3600
+CHAT_PUSH_LEASE_SECONDS = 300
+CHAT_PUSH_PREVIEW_CHARS = 100
+
+# Rate limits (core.throttling): token buckets per "<scope>_<kind>", as
+# "N/period" (burst N) or ("N/period", burst); a missing entry means no
+# limit. Over the limit answers 429 with Retry-After. CONCURRENCY_LIMITS caps
+# requests in flight per scope (503 with Retry-After past it). With the
+# "redis" store both are shared by all workers, with "local" per process.
+THROTTLE_STORE = os.getenv("THROTTLE_STORE", "redis" if REDIS_URL else "local")
+THROTTLE_RATES = {
+    "login_ip": "30/min",
+    "login_username": "10/min",
+    "register_ip": "20/hour",
+    "send_user": ("120/min", 60),
+    "send_conversation": "600/min",
+    "upload_user": "600/min",
+}
+CONCURRENCY_LIMITS = {
+    "auth": int(os.getenv("CONCURRENCY_LIMIT_AUTH", "8")),
+    "send": int(os.getenv("CONCURRENCY_LIMIT_SEND", "64")),
+    "upload": int(os.getenv("CONCURRENCY_LIMIT_UPLOAD", "32")),
+}
+CONCURRENCY_SLOT_TTL = 120
+CONCURRENCY_RETRY_AFTER = 1
+
+# Delta sync: one response carries at most this many messages / bytes of
+# message JSON (whichever comes first); the rest is fetched with its cursor.
+CHAT_SYNC_MAX_MESSAGES = int(os.getenv("CHAT_SYNC_MAX_MESSAGES", "1000"))
+CHAT_SYNC_MAX_BYTES = int(os.getenv("CHAT_SYNC_MAX_BYTES", str(1024 * 1024)))
+CHAT_SYNC_BATCH_SIZE = 200
+
+# Request metrics (core.metrics): exported at /metrics in Prometheus format.
+# Wall time/status/size are recorded for every request; DB and serializer
+# breakdowns only for the sampled share. /metrics answers requests carrying
+# "Authorization: Bearer <METRICS_TOKEN>" or coming from METRICS_ALLOWED_IPS.
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+METRICS_SAMPLE_RATE = float(os.getenv("METRICS_SAMPLE_RATE", "0.1"))
+METRICS_SLOW_REQUEST_MS = int(os.getenv("METRICS_SLOW_REQUEST_MS", "500"))
+METRICS_SLOW_QUERY_COUNT = 5
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+METRICS_ALLOWED_IPS = os.getenv("METRICS_ALLOWED_IPS", "127.0.0.1,::1").split(",")
+
+# chat_message partitioning on PostgreSQL (chat.partitions): id ranges of
+# CHAT_MESSAGE_PARTITION_SIZE, with CHAT_MESSAGE_PARTITIONS_AHEAD empty ones
+# kept ready by create_message_partitions. archive_message_partitions moves
+# partitions idle for CHAT_MESSAGE_ARCHIVE_AFTER_DAYS to the archive
+# tablespace (e.g. one on a compressed volume). Ignored on other databases.
+CHAT_MESSAGE_PARTITIONING = os.getenv("CHAT_MESSAGE_PARTITIONING", "1") == "1"
+CHAT_MESSAGE_PARTITION_SIZE = int(os.getenv("CHAT_MESSAGE_PARTITION_SIZE", "5000000"))
+CHAT_MESSAGE_PARTITIONS_AHEAD = int(os.getenv("CHAT_MESSAGE_PARTITIONS_AHEAD", "2"))
+CHAT_MESSAGE_ARCHIVE_AFTER_DAYS = int(os.getenv("CHAT_MESSAGE_ARCHIVE_AFTER_DAYS", "180"))
+CHAT_MESSAGE_ARCHIVE_TABLESPACE = os.getenv("CHAT_MESSAGE_ARCHIVE_TABLESPACE", "")
@@ -0,0 +1,52 @@
+"""
+Streamed response bodies that actually stream under both servers.
+
+Django consumes a ``StreamingHttpResponse`` over an iterator of the wrong
+kind in one go: under ASGI a sync iterator is collected with
+``sync_to_async(list)`` before the first byte goes out, and under WSGI an
+async one is collected the same way. ``streaming_body`` hands the view's
+sync iterator over as is under WSGI and, under ASGI, wraps it in an async
+iterator that advances it in Django's sync thread (so database work stays
+on the request's connection) one block of about ``BLOCK_SIZE`` bytes at a
+time. Memory stays at a block however large the body.
+"""
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
+
+BLOCK_SIZE = 64 * 1024
+
+_done = object()
+
+
+def is_asgi(request):
+    return isinstance(getattr(request, "_request", request), ASGIRequest)
+
+
+def next_block(iterator, size):
+    """Up to ``size`` bytes from ``iterator`` (more if one chunk is bigger); ``_done`` at the end."""
+    parts, length = [], 0
+    for chunk in iterator:
+        parts.append(chunk)
+        length += len(chunk)
+        if length >= size:
+            break
+    return b"".join(parts) if parts else _done
+
+
+async def async_blocks(iterator, size=BLOCK_SIZE):
+    step = sync_to_async(next_block)
+    try:
+        while True:
+            block = await step(iterator, size)
+            if block is _done:
+                return
+            yield block
+    finally:
+        close = getattr(iterator, "close", None)
+        if close is not None:
+            await sync_to_async(close)()
+
+
+def streaming_body(request, iterator, size=BLOCK_SIZE):
+    """``iterator`` (of bytes) in the form the server serving ``request`` streams."""
+    return async_blocks(iter(iterator), size) if is_asgi(request) else iterator
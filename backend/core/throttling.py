@@ -0,0 +1,249 @@
+"""
+Token-bucket rate limits and concurrency caps for expensive endpoints.
+
+A view names a ``throttle_scope`` and lists bucket throttles; each throttle
+looks up ``THROTTLE_RATES["<scope>_<kind>"]`` (``"30/min"``, or
+``("30/min", burst)``) and does nothing if there is none. A bucket holds up
+to ``burst`` tokens (the per-period count by default) and refills at the
+rate, so short bursts pass and sustained overuse gets 429 with Retry-After.
+
+``ConcurrencyLimitMixin`` caps how many requests of a scope run at once
+(``CONCURRENCY_LIMITS``); past the cap it answers 503 with Retry-After at
+once instead of queueing behind the busy ones. Slots are leases, so a worker
+that dies mid-request frees its slot after ``CONCURRENCY_SLOT_TTL``.
+
+State lives in ``THROTTLE_STORE``: ``"local"`` (per process) or ``"redis"``
+(shared by all workers, so limits and caps are global).
+"""
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from rest_framework import status
+from rest_framework.exceptions import APIException
+from rest_framework.throttling import BaseThrottle
+
+PERIODS = {"s": 1, "sec": 1, "m": 60, "min": 60, "h": 3600, "hour": 3600, "d": 86400, "day": 86400}
+
+
+def parse_rate(rate):
+    """``"30/min"`` or ``("30/min", burst)`` -> (tokens per second, burst)."""
+    burst = None
+    if isinstance(rate, (tuple, list)):
+        rate, burst = rate
+    count, _, period = rate.partition("/")
+    count = int(count)
+    return count / PERIODS[period], burst or count
+
+
+class LocalThrottleStore:
+    """In-process: each worker enforces its own limits."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.buckets = {}  # key -> [tokens, updated_at]
+        self.slots = {}  # key -> {slot: expires_at}
+
+    def take(self, key, rate, burst, cost=1):
+        """Take ``cost`` tokens; 0 if they were there, else seconds until they will be."""
+        now = time.monotonic()
+        with self.lock:
+            if len(self.buckets) > 10000:
+                # full buckets carry no state
+                for stale in [k for k, (tokens, at) in self.buckets.items() if now - at > burst / rate]:
+                    del self.buckets[stale]
+            tokens, updated = self.buckets.get(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            wait = 0
+            if tokens >= cost:
+                tokens -= cost
+            else:
+                wait = (cost - tokens) / rate
+            self.buckets[key] = [tokens, now]
+            return wait
+
+    def acquire(self, key, limit, ttl):
+        now = time.monotonic()
+        with self.lock:
+            slots = self.slots.setdefault(key, {})
+            for slot in [s for s, expires in slots.items() if expires <= now]:
+                del slots[slot]
+            if len(slots) >= limit:
+                return None
+            slot = uuid.uuid4().hex
+            slots[slot] = now + ttl
+            return slot
+
+    def release(self, key, slot):
+        with self.lock:
+            self.slots.get(key, {}).pop(slot, None)
+
+
+# KEYS[1] bucket; ARGV rate, burst, cost. Server time, so workers' clocks don't matter.
+TAKE_SCRIPT = """
+local now = redis.call('TIME')
+now = tonumber(now[1]) + tonumber(now[2]) / 1000000
+local rate, burst, cost = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'at')
+local tokens = tonumber(state[1]) or burst
+local at = tonumber(state[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - at) * rate)
+local wait = 0
+if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return tostring(wait)
+"""
+
+# KEYS[1] slot set; ARGV now, limit, expires_at, slot, ttl
+ACQUIRE_SCRIPT = """
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[1])
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then return 0 end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[4])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+
+
+class RedisThrottleStore:
+    """Shared across workers; every check is one atomic script call."""
+
+    def __init__(self, url):
+        import redis
+
+        self.redis = redis.Redis.from_url(url)
+        self.take_script = self.redis.register_script(TAKE_SCRIPT)
+        self.acquire_script = self.redis.register_script(ACQUIRE_SCRIPT)
+
+    def take(self, key, rate, burst, cost=1):
+        return float(self.take_script(keys=[f"throttle:{key}"], args=[rate, burst, cost]))
+
+    def acquire(self, key, limit, ttl):
+        now = time.time()
+        slot = uuid.uuid4().hex
+        acquired = self.acquire_script(
+            keys=[f"concurrency:{key}"], args=[now, limit, now + ttl, slot, int(ttl) + 1]
+        )
+        return slot if acquired else None
+
+    def release(self, key, slot):
+        self.redis.zrem(f"concurrency:{key}", slot)
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_throttle_store():
+    global _store
+    with _store_lock:
+        if _store is None:
+            if settings.THROTTLE_STORE == "redis":
+                _store = RedisThrottleStore(settings.REDIS_URL)
+            else:
+                _store = LocalThrottleStore()
+    return _store
+
+
+# ---- rate limits ----
+
+class BucketThrottle(BaseThrottle):
+    """Base for the per-user / per-IP / per-conversation token buckets."""
+
+    kind = None
+
+    def get_key(self, request, view):
+        """What the bucket is per; None skips the check."""
+        raise NotImplementedError
+
+    def get_cost(self, request, view):
+        get_cost = getattr(view, "get_throttle_cost", None)
+        return get_cost(request) if get_cost else 1
+
+    def allow_request(self, request, view):
+        self.delay = 0
+        scope = getattr(view, "throttle_scope", None)
+        rate = settings.THROTTLE_RATES.get(f"{scope}_{self.kind}") if scope else None
+        if rate is None:
+            return True
+        key = self.get_key(request, view)
+        if key is None:
+            return True
+        rate, burst = parse_rate(rate)
+        cost = max(1, self.get_cost(request, view))
+        if cost > burst:
+            # can never fit; charge a full bucket instead of refusing forever
+            cost = burst
+        self.delay = get_throttle_store().take(f"{scope}_{self.kind}:{key}", rate, burst, cost)
+        return self.delay == 0
+
+    def wait(self):
+        return self.delay
+
+
+class UserBucketThrottle(BucketThrottle):
+    """Per authenticated user (per IP for anonymous requests)."""
+
+    kind = "user"
+
+    def get_key(self, request, view):
+        if request.user and request.user.is_authenticated:
+            return request.user.pk
+        return f"ip:{self.get_ident(request)}"
+
+
+class IPBucketThrottle(BucketThrottle):
+    kind = "ip"
+
+    def get_key(self, request, view):
+        return self.get_ident(request)
+
+
+# ---- concurrency caps ----
+
+class Overloaded(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = "Server is busy, retry shortly."
+    default_code = "overloaded"
+
+    def __init__(self, wait, detail=None, code=None):
+        super().__init__(detail, code)
+        self.wait = wait
+
+
+class ConcurrencyLimitMixin:
+    """
+    For views: at most ``CONCURRENCY_LIMITS[concurrency_scope]`` requests of
+    the scope in flight. Checked after authentication and throttles, so only
+    requests that would otherwise run take a slot.
+    """
+
+    concurrency_scope = None
+    concurrency_slot = None
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        limit = settings.CONCURRENCY_LIMITS.get(self.concurrency_scope)
+        if not limit:
+            return
+        slot = get_throttle_store().acquire(self.concurrency_scope, limit, settings.CONCURRENCY_SLOT_TTL)
+        if slot is None:
+            raise Overloaded(settings.CONCURRENCY_RETRY_AFTER)
+        self.concurrency_slot = slot
+
+    def release_slot(self):
+        if self.concurrency_slot is not None:
+            get_throttle_store().release(self.concurrency_scope, self.concurrency_slot)
+            self.concurrency_slot = None
+
+    def handle_exception(self, exc):
+        try:
+            return super().handle_exception(exc)
+        except BaseException:
+            self.release_slot()
+            raise
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        self.release_slot()
+        return super().finalize_response(request, response, *args, **kwargs)
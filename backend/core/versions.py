@@ -0,0 +1,100 @@
+"""
+Version counters for list endpoints, and a list-view mixin that turns them
+into ETags / 304s and a cache of the serialized payload.
+
+A scope (``"users"``, ``"conversations:<user id>"``) is a counter in the
+cache that is bumped whenever data shown under it changes. A response's ETag
+is a hash of its URL and the current value of its scopes, so checking
+``If-None-Match`` costs one cache read and no queries or serialization, and
+the serialized payload can be cached under the ETag: bumping a scope is the
+invalidation. A counter that was evicted restarts from the clock, never from
+a value an old ETag could carry.
+"""
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.http import parse_etags, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from core.db_router import use_primary
+
+# every user's username/name, as shown by the user list and members_detail
+USERS_SCOPE = "users"
+
+
+def version_key(scope):
+    return f"version:{scope}"
+
+
+def get_versions(scopes):
+    keys = [version_key(scope) for scope in scopes]
+    found = cache.get_many(keys)
+    versions = []
+    for key in keys:
+        if key not in found:
+            cache.add(key, time.time_ns(), timeout=None)
+            found[key] = cache.get(key)
+        versions.append(found[key])
+    return versions
+
+
+def bump_versions(scopes):
+    for scope in scopes:
+        key = version_key(scope)
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.add(key, time.time_ns(), timeout=None)
+
+
+def bump_versions_on_commit(scopes):
+    """Bump now and again after commit, so a reader racing the write can't cache stale data."""
+    scopes = list(scopes)
+    if not scopes:
+        return
+    bump_versions(scopes)
+    transaction.on_commit(lambda: bump_versions(scopes))
+
+
+class VersionedListMixin:
+    """
+    For list views: answers ``If-None-Match`` with 304 while the view's
+    version scopes are unchanged, and serves the serialized page from the
+    cache. ``get_version_scopes()`` must cover everything the response shows;
+    set ``per_user_cache`` when the response depends on the requesting user
+    beyond those scopes.
+    """
+
+    per_user_cache = False
+
+    def get_version_scopes(self):
+        raise NotImplementedError
+
+    def get_etag(self, request):
+        parts = [
+            request.get_host(), request.path, sorted(request.query_params.lists()),
+            getattr(request, "accepted_media_type", None),
+        ]
+        if self.per_user_cache:
+            parts.append(request.user.pk)
+        parts += get_versions(self.get_version_scopes())
+        return hashlib.sha256(repr(parts).encode()).hexdigest()[:32]
+
+    def list(self, request, *args, **kwargs):
+        etag = self.get_etag(request)
+        headers = {"ETag": quote_etag(etag), "Cache-Control": "private, no-cache", "Vary": "Accept"}
+        if quote_etag(etag) in parse_etags(request.headers.get("If-None-Match", "")):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+        key = f"response:{etag}"
+        data = cache.get(key)
+        if data is None:
+            # from the primary: a lagging replica must not be cached under the new versions
+            with use_primary():
+                data = super().list(request, *args, **kwargs).data
+            cache.set(key, data, settings.LIST_RESPONSE_CACHE_TTL)
+        return Response(data, headers=headers)
@@ -0,0 +1,49 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from core.db_router import use_primary
+
+
+def token_cache_key(key):
+    # کلید خام توکن در cache نوشته نمی‌شود
+    return "auth:token:" + hashlib.sha256(key.encode()).hexdigest()
+
+
+def invalidate_token(key):
+    cache.delete(token_cache_key(key))
+
+
+def get_token(key):
+    """
+    The Token for ``key`` with its user, or None. Tokens of active users are
+    cached for ``AUTH_TOKEN_CACHE_TTL`` seconds; entries are dropped when the
+    token is deleted (logout) or its user is saved/deleted (see users.signals).
+    Shared by the REST and WebSocket authentication.
+    """
+    cache_key = token_cache_key(key)
+    token = cache.get(cache_key)
+    if token is None:
+        # از primary، تا replica عقب‌مانده کاربرِ تازه غیرفعال‌شده را در cache ننشاند
+        with use_primary():
+            token = Token.objects.select_related("user").filter(key=key).first()
+        if token is not None and token.user.is_active:
+            cache.set(cache_key, token, settings.AUTH_TOKEN_CACHE_TTL)
+    return token
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication with the token→user lookup cached (see ``get_token``)."""
+
+    def authenticate_credentials(self, key):
+        token = get_token(key)
+        if token is None:
+            raise exceptions.AuthenticationFailed(_("Invalid token."))
+        if not token.user.is_active:
+            raise exceptions.AuthenticationFailed(_("User inactive or deleted."))
+        return token.user, token
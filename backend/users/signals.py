@@ -0,0 +1,30 @@
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from core.versions import USERS_SCOPE, bump_versions_on_commit
+
+from .authentication import invalidate_token
+
+UserModel = get_user_model()
+
+
+@receiver(post_delete, sender=Token)
+def drop_deleted_token(sender, instance, **kwargs):
+    invalidate_token(instance.key)
+
+
+@receiver(post_save, sender=UserModel)
+@receiver(post_delete, sender=UserModel)
+def drop_user_tokens(sender, instance, **kwargs):
+    # کاربر کش‌شده ممکن است غیرفعال شده یا تغییر کرده باشد
+    for key in Token.objects.filter(user_id=instance.pk).values_list("key", flat=True):
+        invalidate_token(key)
+
+
+@receiver(post_save, sender=UserModel)
+@receiver(post_delete, sender=UserModel)
+def bump_user_lists(sender, instance, **kwargs):
+    # لیست کاربران و members_detail همه‌ی گفتگوها
+    bump_versions_on_commit([USERS_SCOPE])
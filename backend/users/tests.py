@@ -1,3 +1,98 @@
-from django.test import TestCase
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import override_settings
+from rest_framework.test import APITestCase as BaseAPITestCase
 
-# Create your tests here.
+from core import throttling
+
+User = get_user_model()
+
+
+class APITestCase(BaseAPITestCase):
+    # ids are reused after each test's rollback, so cached lists and buckets must not leak
+    def run(self, result=None):
+        cache.clear()
+        throttling._store = None
+        return super().run(result)
+
+
+class UserListTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345", first_name="Alice")
+        self.bob = User.objects.create_user("bob", password="pass12345", last_name="Builder")
+        self.carol = User.objects.create_user("carol", password="pass12345")
+        self.client.force_authenticate(self.alice)
+
+    def get(self, etag=None, **params):
+        headers = {"HTTP_IF_NONE_MATCH": etag} if etag else {}
+        return self.client.get("/api/chat/users/", params, **headers)
+
+    def test_user_list_is_paginated_and_searchable(self):
+        resp = self.get(limit=2)
+        self.assertEqual([u["username"] for u in resp.data["results"]], ["alice", "bob"])
+        resp = self.client.get(resp.data["next"])
+        self.assertEqual([u["username"] for u in resp.data["results"]], ["carol"])
+
+        resp = self.get(q="build")
+        self.assertEqual([u["username"] for u in resp.data["results"]], ["bob"])
+
+    def test_user_list_not_modified_until_users_change(self):
+        etag = self.get()["ETag"]
+        with self.assertNumQueries(0):
+            resp = self.get(etag)
+        self.assertEqual(resp.status_code, 304)
+        with self.assertNumQueries(0):
+            resp = self.get()  # served from the payload cache
+        self.assertEqual(len(resp.data["results"]), 3)
+
+        self.carol.first_name = "Carol"
+        self.carol.save()
+        resp = self.get(etag)
+        self.assertEqual(resp.status_code, 200)
+        self.assertNotEqual(resp["ETag"], etag)
+        self.assertEqual(resp.data["results"][2]["first_name"], "Carol")
+
+
+@override_settings(THROTTLE_RATES={}, CONCURRENCY_LIMITS={})
+class AuthRateLimitTests(APITestCase):
+    def setUp(self):
+        self.alice = User.objects.create_user("alice", password="pass12345")
+        self.bob = User.objects.create_user("bob", password="pass12345")
+        self.carol = User.objects.create_user("carol", password="pass12345")
+
+    def login(self, username, password="wrong"):
+        return self.client.post("/api/chat/login/", {"username": username, "password": password}, format="json")
+
+    def register(self, username, **headers):
+        data = {
+            "username": username,
+            "email": f"{username}@example.com",
+            "password": "Xy7!long-pass",
+            "password2": "Xy7!long-pass",
+        }
+        return self.client.post("/api/chat/register/", data, format="json", **headers)
+
+    @override_settings(THROTTLE_RATES={"login_username": "2/min", "login_ip": "5/min"})
+    def test_login_is_limited_per_username_and_ip(self):
+        self.assertEqual(self.login("alice").status_code, 400)
+        self.assertEqual(self.login("Alice").status_code, 400)
+        resp = self.login("alice", "pass12345")
+        self.assertEqual(resp.status_code, 429)
+        self.assertGreater(int(resp["Retry-After"]), 0)
+        self.assertEqual(self.login("bob", "pass12345").status_code, 200)
+        self.assertEqual(self.login("carol").status_code, 400)
+        self.assertEqual(self.login("dave").status_code, 429)
+
+    @override_settings(THROTTLE_RATES={"register_ip": "2/hour"})
+    def test_register_is_limited_per_ip(self):
+        self.assertEqual(self.register("dave").status_code, 201)
+        self.assertEqual(self.register("erin").status_code, 201)
+        self.assertEqual(self.register("frank").status_code, 429)
+        self.assertEqual(self.register("frank", REMOTE_ADDR="10.0.0.2").status_code, 201)
+
+    @override_settings(THROTTLE_RATES={"register_ip": "2/hour"})
+    def test_forwarded_for_header_does_not_pick_the_bucket(self):
+        # a client can send any X-Forwarded-For; only the address the server saw counts
+        for i, username in enumerate(["dave", "erin"]):
+            self.assertEqual(self.register(username, HTTP_X_FORWARDED_FOR=f"198.51.100.{i}").status_code, 201)
+        self.assertEqual(self.register("frank", HTTP_X_FORWARDED_FOR="198.51.100.9").status_code, 429)
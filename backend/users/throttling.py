@@ -0,0 +1,13 @@
+from core.throttling import BucketThrottle
+
+
+class UsernameBucketThrottle(BucketThrottle):
+    """Per attempted username, so guessing one account's password is slow from any number of IPs."""
+
+    kind = "username"
+
+    def get_key(self, request, view):
+        username = request.data.get("username") if hasattr(request.data, "get") else None
+        if not isinstance(username, str) or not username:
+            return None
+        return username.strip().lower()[:150]
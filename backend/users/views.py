@@ -1,23 +1,41 @@
 from django.contrib.auth import authenticate, get_user_model
+from django.db.models import Q
 from rest_framework import generics, status
 from rest_framework.authtoken.models import Token
+from rest_framework.pagination import CursorPagination
 from rest_framework.permissions import AllowAny, IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework.generics import ListAPIView
 
+from core.throttling import ConcurrencyLimitMixin, IPBucketThrottle
+from core.versions import USERS_SCOPE, VersionedListMixin
+
 from .serializers import RegisterSerializer, SimpleUserSerializer
+from .throttling import UsernameBucketThrottle
 
 UserModel = get_user_model()
 
-class RegisterView(generics.CreateAPIView):
+class RegisterView(ConcurrencyLimitMixin, generics.CreateAPIView):
     queryset = UserModel.objects.all()
     permission_classes = [AllowAny]
     serializer_class = RegisterSerializer
+    throttle_classes = [IPBucketThrottle]
+    throttle_scope = "register"
+    # هش کردن رمز عمداً کند است؛ با login یک سقف همزمانی مشترک دارند
+    concurrency_scope = "auth"
 
 
-class LoginView(APIView):
+class LoginView(ConcurrencyLimitMixin, APIView):
+    """
+    POST: ورود با username/password و گرفتن توکن
+    سقف نرخ برای هر IP و هر username (429)، و سقف authenticate همزمان (503)
+    تا موجی از درخواست‌ها CPU را با هش رمز پر نکند.
+    """
     permission_classes = [AllowAny]
+    throttle_classes = [IPBucketThrottle, UsernameBucketThrottle]
+    throttle_scope = "login"
+    concurrency_scope = "auth"
 
     def post(self, request):
         username = request.data.get("username")
@@ -37,10 +55,32 @@ class LogoutView(APIView):
         return Response({"success": "Logged out"}, status=status.HTTP_200_OK)
 
 
-class UserListView(ListAPIView):
+class UserCursorPagination(CursorPagination):
+    ordering = "id"
+    page_size = 100
+    page_size_query_param = "limit"
+    max_page_size = 500
+
+
+class UserListView(VersionedListMixin, ListAPIView):
+    """
+    GET: کاربران فعال، صفحه‌بندی cursor روی id (limit حداکثر ۵۰۰)
+    q= جستجو در username / نام / نام خانوادگی
+    ETag بر اساس نسخه‌ی users؛ با If-None-Match برابر، 304 بدون کوئری و serialize
+    """
     serializer_class = SimpleUserSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = UserCursorPagination
+
+    def get_version_scopes(self):
+        return [USERS_SCOPE]
 
     def get_queryset(self):
-        return UserModel.objects.filter(is_active=True).order_by("id")
+        qs = UserModel.objects.filter(is_active=True)
+        query = (self.request.query_params.get("q") or "").strip()
+        if query:
+            qs = qs.filter(
+                Q(username__icontains=query) | Q(first_name__icontains=query) | Q(last_name__icontains=query)
+            )
+        return qs
 